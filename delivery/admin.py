@@ -2,7 +2,7 @@ from django.contrib import admin
 from .models import (
     Item, Part, Shipper, Destination, ShippingOrder, 
     OrderItem, Truck, DeliveryPlan, PlanOrderDetail, PlanItemLoad,
-    PalletConfiguration
+    PalletConfiguration, OptimizationJob
 )
 
 
@@ -13,7 +13,7 @@ class PartInline(admin.TabularInline):
 
 @admin.register(Item)
 class ItemAdmin(admin.ModelAdmin):
-    list_display = ['item_code', 'name', 'width', 'depth', 'height', 'weight', 'parts_count']
+    list_display = ['item_code', 'name', 'width', 'depth', 'height', 'weight', 'parts_count', 'this_side_up', 'stackable']
     search_fields = ['item_code', 'name']
     inlines = [PartInline]
 
@@ -46,7 +46,7 @@ class ShippingOrderAdmin(admin.ModelAdmin):
 
 @admin.register(Truck)
 class TruckAdmin(admin.ModelAdmin):
-    list_display = ['shipping_company', 'truck_class', 'model', 'width', 'depth', 'height', 'payload']
+    list_display = ['shipping_company', 'truck_class', 'model', 'width', 'depth', 'height', 'payload', 'max_layers']
     list_filter = ['shipping_company', 'truck_class']
     search_fields = ['shipping_company', 'model']
 
@@ -101,4 +101,11 @@ class PalletConfigurationAdmin(admin.ModelAdmin):
             PalletConfiguration.objects.filter(is_default=True).exclude(pk=obj.pk).update(is_default=False)
             super().save_model(request, obj, form, change)
         else:
-            super().save_model(request, obj, form, change)
\ No newline at end of file
+            super().save_model(request, obj, form, change)
+
+
+@admin.register(OptimizationJob)
+class OptimizationJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'job_type', 'target_date', 'status', 'progress', 'created_at', 'started_at', 'finished_at']
+    list_filter = ['job_type', 'status', 'target_date']
+    readonly_fields = ['created_at', 'started_at', 'heartbeat_at', 'finished_at']
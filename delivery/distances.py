@@ -0,0 +1,187 @@
+"""
+配送先間距離のキャッシュ
+
+配送先（Destination）の組ごとの距離をDB（DestinationDistance）に保存してワーカー・再起動をまたいで共有し、
+プロセス内では配送先ごとに番号を振った距離行列に保持する。
+行列にない組のみDBから読み込み、DBにもない組のみ計算して保存する。
+計算時の座標と現在の座標が異なる場合は再計算する。
+"""
+
+import threading
+from typing import Iterable, List, Tuple
+
+import numpy as np
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Destination, DestinationDistance
+
+
+class DistanceCache:
+    """配送先間距離のキャッシュ（プロセス内の距離行列 + DB）"""
+
+    # プロセス内の距離行列に保持する配送先の数（超える場合は破棄して作り直す）
+    MAX_DESTINATIONS = 4000
+    # DBに1回のINSERTで保存する組の数（DBのパラメータ数の上限も超えない範囲）
+    BATCH_SIZE = 1000
+
+    # 配送先ID → 距離行列の番号、番号ごとの座標、距離行列（未知の組はNaN）。プロセス内で共有
+    _slots = {}
+    _coords = np.empty((0, 2))
+    _distances = np.empty((0, 0))
+    # 距離行列を作り直した回数（作り直す前に読み出した番号で書き戻さないため）
+    _generation = 0
+    _lock = threading.Lock()
+
+    def __init__(self, route_optimizer=None):
+        """
+        Args:
+            route_optimizer: 距離計算に使う RouteOptimizer。Noneの場合は既定の設定で作成
+        """
+        if route_optimizer is None:
+            from .optimization import RouteOptimizer
+            route_optimizer = RouteOptimizer()
+        self.route_optimizer = route_optimizer
+
+    def matrix(self, destinations: List[Destination]) -> np.ndarray:
+        """配送先の距離行列（km）。緯度・経度が登録された配送先のみ指定すること"""
+        if not destinations:
+            return np.zeros((0, 0), dtype=self.route_optimizer.dtype)
+
+        # 同じ配送先が複数回現れる場合があるため、配送先IDごとに1度だけ座標を取り出す
+        ids = np.fromiter((destination.id for destination in destinations), dtype=np.int64, count=len(destinations))
+        unique_ids, first, inverse = np.unique(ids, return_index=True, return_inverse=True)
+        coords = np.array(
+            [(float(destinations[i].latitude), float(destinations[i].longitude)) for i in first], dtype=np.float64
+        )
+
+        with self._lock:
+            generation, slots = self._assign_slots(unique_ids, coords)
+            distances = self._distances[np.ix_(slots, slots)]
+
+        missing = np.isnan(distances)
+        if missing.any():
+            self._load_from_db(unique_ids, coords, distances, missing)
+            if missing.any():
+                self._compute(unique_ids, coords, distances, missing)
+            with self._lock:
+                if self._generation == generation:
+                    self._distances[np.ix_(slots, slots)] = distances
+
+        return distances[np.ix_(inverse, inverse)].astype(self.route_optimizer.dtype, copy=False)
+
+    @classmethod
+    def clear(cls):
+        """プロセス内のキャッシュを破棄（DBの距離は残す）"""
+        with cls._lock:
+            cls._reset(0)
+
+    @classmethod
+    def _reset(cls, capacity: int):
+        """プロセス内の距離行列を空にする（ロックを取得済みであること）"""
+        cls._slots = {}
+        cls._coords = np.empty((capacity, 2))
+        cls._distances = np.full((capacity, capacity), np.nan)
+        cls._generation += 1
+
+    @classmethod
+    def _assign_slots(cls, ids: np.ndarray, coords: np.ndarray):
+        """配送先に距離行列の番号を振り、(作り直した回数, 番号) を返す（ロックを取得済みであること）
+
+        新しい配送先と座標が変わった配送先は、行・列を未知（NaN）にする
+        """
+        new_ids = [destination_id for destination_id in ids.tolist() if destination_id not in cls._slots]
+        size = len(cls._slots) + len(new_ids)
+        if size > cls.MAX_DESTINATIONS:
+            cls._reset(0)
+            new_ids = ids.tolist()
+            size = len(new_ids)
+        if size > len(cls._coords):
+            # 容量を倍々で拡張
+            capacity = max(size, 2 * len(cls._coords), 64)
+            coords_grown = np.empty((capacity, 2))
+            distances_grown = np.full((capacity, capacity), np.nan)
+            count = len(cls._slots)
+            coords_grown[:count] = cls._coords[:count]
+            distances_grown[:count, :count] = cls._distances[:count, :count]
+            cls._coords, cls._distances = coords_grown, distances_grown
+        for destination_id in new_ids:
+            cls._slots[destination_id] = len(cls._slots)
+
+        slots = np.fromiter((cls._slots[destination_id] for destination_id in ids.tolist()),
+                            dtype=np.intp, count=len(ids))
+        stale = slots[np.isin(ids, new_ids) | (cls._coords[slots] != coords).any(axis=1)]
+        if len(stale):
+            cls._distances[stale, :] = np.nan
+            cls._distances[:, stale] = np.nan
+            cls._distances[stale, stale] = 0.0
+            cls._coords[slots] = coords
+        return cls._generation, slots
+
+    def _load_from_db(self, ids: np.ndarray, coords: np.ndarray, distances: np.ndarray, missing: np.ndarray):
+        """DBに保存済みで座標が変わっていない距離で distances を埋め、missing を更新"""
+        # 未知の組を含む配送先と、指定された配送先との組のみ読み込む
+        pending = ids[missing.any(axis=1)].tolist()
+        id_list = ids.tolist()
+        query = DestinationDistance.objects.filter(origin_id__in=id_list, destination_id__in=id_list)
+        if len(pending) < len(id_list):
+            query = query.filter(Q(origin_id__in=pending) | Q(destination_id__in=pending))
+        rows = np.array(list(query.values_list(
+            'origin_id', 'destination_id', 'origin_latitude', 'origin_longitude',
+            'destination_latitude', 'destination_longitude', 'distance_km'
+        )), dtype=np.float64).reshape(-1, 7)
+        if len(rows) == 0:
+            return
+
+        i = np.searchsorted(ids, rows[:, 0].astype(np.int64))
+        j = np.searchsorted(ids, rows[:, 1].astype(np.int64))
+        valid = (
+            missing[i, j]
+            & (coords[i] == rows[:, 2:4]).all(axis=1)
+            & (coords[j] == rows[:, 4:6]).all(axis=1)
+        )
+        i, j, values = i[valid], j[valid], rows[valid, 6]
+        distances[i, j] = distances[j, i] = values
+        missing[i, j] = missing[j, i] = False
+
+    def _compute(self, ids: np.ndarray, coords: np.ndarray, distances: np.ndarray, missing: np.ndarray):
+        """未知の組（i < j）のみまとめて計算し、distances を埋めてDBに保存"""
+        i, j = np.nonzero(np.triu(missing, k=1))
+        radians = np.radians(coords)
+        values = self.route_optimizer._haversine_arrays(
+            radians[i, 0], radians[i, 1], radians[j, 0], radians[j, 1]
+        )
+        distances[i, j] = distances[j, i] = values
+        missing[:] = False
+
+        self._save(zip(
+            ids[i].tolist(), ids[j].tolist(), coords[i, 0].tolist(), coords[i, 1].tolist(),
+            coords[j, 0].tolist(), coords[j, 1].tolist(), values.tolist()
+        ))
+
+    def _save(self, rows: Iterable[Tuple]):
+        """(配送先1のID, 配送先2のID, 配送先1の緯度・経度, 配送先2の緯度・経度, 距離) を保存し、座標が変わった組は上書き
+
+        組の数は配送先の数の2乗で増えるため、モデルのインスタンスを作らず複数行の INSERT ... ON CONFLICT で保存する
+        """
+        fields = [DestinationDistance._meta.get_field(name) for name in (
+            'origin', 'destination', 'origin_latitude', 'origin_longitude',
+            'destination_latitude', 'destination_longitude', 'distance_km', 'updated_at'
+        )]
+        columns = [connection.ops.quote_name(field.column) for field in fields]
+        updates = ', '.join(f'{column} = excluded.{column}' for column in columns[2:])
+        row_sql = f"({', '.join(['%s'] * len(columns))})"
+        updated_at = fields[-1].get_db_prep_save(timezone.now(), connection)
+        rows = [row + (updated_at,) for row in rows]
+
+        batch_size = min(self.BATCH_SIZE, connection.ops.bulk_batch_size(fields, rows))
+        with transaction.atomic(), connection.cursor() as cursor:
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                cursor.execute(
+                    f"INSERT INTO {connection.ops.quote_name(DestinationDistance._meta.db_table)} "
+                    f"({', '.join(columns)}) VALUES {', '.join([row_sql] * len(batch))} "
+                    f"ON CONFLICT ({columns[0]}, {columns[1]}) DO UPDATE SET {updates}",
+                    [value for row in batch for value in row]
+                )
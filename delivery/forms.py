@@ -50,7 +50,8 @@ class OrderItemForm(forms.ModelForm):
 class TruckForm(forms.ModelForm):
     class Meta:
         model = Truck
-        fields = ['width', 'depth', 'height', 'payload', 'shipping_company', 'truck_class', 'model']
+        fields = ['width', 'depth', 'height', 'payload', 'max_layers', 'layer_weight_limit',
+                  'shipping_company', 'truck_class', 'model']
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -69,6 +70,11 @@ class TruckForm(forms.ModelForm):
                 Column('payload', css_class='form-group col-md-3 mb-0'),
                 css_class='form-row'
             ),
+            Row(
+                Column('max_layers', css_class='form-group col-md-6 mb-0'),
+                Column('layer_weight_limit', css_class='form-group col-md-6 mb-0'),
+                css_class='form-row'
+            ),
             Submit('submit', '保存', css_class='btn btn-primary')
         )
 
@@ -76,7 +82,7 @@ class TruckForm(forms.ModelForm):
 class ItemForm(forms.ModelForm):
     class Meta:
         model = Item
-        fields = ['item_code', 'name', 'width', 'depth', 'height', 'weight', 'parts_count']
+        fields = ['item_code', 'name', 'width', 'depth', 'height', 'weight', 'parts_count', 'this_side_up', 'stackable']
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -94,7 +100,12 @@ class ItemForm(forms.ModelForm):
                 Column('weight', css_class='form-group col-md-3 mb-0'),
                 css_class='form-row'
             ),
-            'parts_count',
+            Row(
+                Column('parts_count', css_class='form-group col-md-4 mb-0'),
+                Column('this_side_up', css_class='form-group col-md-4 mb-0'),
+                Column('stackable', css_class='form-group col-md-4 mb-0'),
+                css_class='form-row'
+            ),
             Submit('submit', '保存', css_class='btn btn-primary')
         )
 
@@ -0,0 +1,114 @@
+"""
+最適化ジョブの実行
+
+パレタイズ設計と配送最適化を OptimizationJob として登録し、ワーカー
+（manage.py run_optimization_jobs）で実行する。キューはDBのテーブルのみで、
+PostgreSQL・SQLite のどちらでも動作する。
+"""
+
+import threading
+import traceback
+from typing import List, Optional
+
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+
+from .models import ShippingOrder, DeliveryPlan, OptimizationJob
+from .optimization import DeliveryOptimizer
+from .services import ProgressCallback, palletize_orders
+
+
+class JobHeartbeat:
+    """実行中のジョブの進捗と最終応答日時を、別スレッド（別のDB接続）から一定間隔で保存する
+
+    最適化は長時間のトランザクション内で実行されるため、ワーカーの接続で保存した進捗は
+    終了まで他のワーカーから見えず、処理中でも応答なしとして中断される。
+    report は最新の進捗を記録するのみで、保存はスレッドが INTERVAL 秒ごとに行う
+    """
+
+    # 保存する間隔(秒)。run_optimization_jobs --stale-minutes より十分短くすること
+    INTERVAL = 10
+
+    def __init__(self, job: OptimizationJob, interval: float = None):
+        self.job = job
+        self.interval = self.INTERVAL if interval is None else interval
+        self.latest = (job.progress, job.message)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=f'job-{job.id}-heartbeat', daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def report(self, progress, message=''):
+        """進捗を記録（ProgressCallback）"""
+        self.latest = (progress, message)
+
+    def _run(self):
+        try:
+            while not self.stopped.wait(self.interval):
+                progress, message = self.latest
+                try:
+                    # ワーカーが結果を設定している job は更新せず、同じIDのインスタンスで保存する
+                    OptimizationJob(id=self.job.id).report_progress(progress, message)
+                except DatabaseError as e:
+                    # SQLite では書き込み中のトランザクションがある間は保存できない
+                    print(f"ジョブ {self.job.id} の進捗を保存できませんでした: {e}")
+        finally:
+            connection.close()
+
+
+def run_job(job: OptimizationJob):
+    """実行中にしたジョブを実行し、結果またはエラーを保存"""
+    plans = []
+    with JobHeartbeat(job) as heartbeat:
+        try:
+            if job.job_type == 'PALLETIZE':
+                job.palletize_plan = palletize_orders(job.target_date, heartbeat.report)
+                job.message = f'パレタイズ設計を保存しました。（ID: {job.palletize_plan.id}）'
+            elif job.job_type == 'DELIVERY':
+                plans = optimize_delivery(job.target_date, heartbeat.report)
+                if not plans:
+                    raise Exception('最適化に失敗しました。詳細はサーバーログをご確認ください。')
+                job.message = f'{len(plans)} 件の配送計画を作成しました。'
+            else:
+                raise ValueError(f"未対応のジョブ種別です: {job.job_type}")
+            job.status = 'SUCCEEDED'
+            job.progress = 100
+        except Exception as e:
+            traceback.print_exc()
+            job.progress = heartbeat.latest[0]
+            job.status = 'FAILED'
+            job.message = 'エラーが発生しました'
+            job.error = str(e)
+
+    job.finished_at = timezone.now()
+    # 応答がないとして他のワーカーが中断したジョブは、結果（作成した配送計画の関連付けを含む）で上書きしない
+    with transaction.atomic():
+        saved = OptimizationJob.objects.filter(id=job.id, status='RUNNING').update(
+            status=job.status, progress=job.progress, message=job.message, error=job.error,
+            palletize_plan=job.palletize_plan, finished_at=job.finished_at
+        )
+        if saved and plans:
+            job.delivery_plans.set(plans)
+    if not saved:
+        print(f"ジョブ {job.id} は実行中に中断されたため、結果を保存しませんでした")
+        job.refresh_from_db()
+
+
+def optimize_delivery(target_date, progress: Optional[ProgressCallback] = None) -> List[DeliveryPlan]:
+    """指定日の未配送依頼から配送計画を作成（統一パレットシステムを使用）"""
+    pending_orders = ShippingOrder.objects.filter(
+        delivery_deadline=target_date,
+        planorderdetail__isnull=True
+    ).select_related('shipper', 'destination').prefetch_related('order_items__item')
+
+    if progress:
+        progress(5, f'未配送依頼 {pending_orders.count()}件を最適化しています')
+
+    optimizer = DeliveryOptimizer()
+    return optimizer.optimize_with_unified_pallets(pending_orders, target_date, progress=progress)
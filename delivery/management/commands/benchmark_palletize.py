@@ -0,0 +1,141 @@
+"""
+パレタイズ性能計測コマンド
+
+ランダムに生成した出荷依頼（DB不要）でPalletOptimizerを実行し、
+配置方法ごとのパレット数と1個あたりの配置時間を表示する。
+--compare-summed-totals を指定すると、パレットの重量・体積・個数を配置のたびに
+積載済みの箱から合計する従来の方式でも計測し、集計を保持する現在の方式と比べる
+"""
+import contextlib
+import io
+import random
+import time
+from dataclasses import replace
+
+from django.core.management.base import BaseCommand, CommandError
+
+from delivery.models import PalletConfiguration
+from delivery.optimization import PalletOptimizer, Pallet, Box
+
+
+class SummedTotalsPallet(Pallet):
+    """重量・体積・個数を参照のたびに積載済みの箱から合計するパレット（集計を保持する前の方式）"""
+
+    @property
+    def total_weight(self):
+        return sum(box.weight * box.quantity for box in self.boxes)
+
+    @total_weight.setter
+    def total_weight(self, value):
+        pass
+
+    @property
+    def used_volume(self):
+        return sum(box.width * box.depth * box.height * box.quantity for box in self.boxes)
+
+    @used_volume.setter
+    def used_volume(self, value):
+        pass
+
+    @property
+    def box_count(self):
+        return sum(box.quantity for box in self.boxes)
+
+    @box_count.setter
+    def box_count(self, value):
+        pass
+
+
+class SummedTotalsPalletOptimizer(PalletOptimizer):
+    """SummedTotalsPallet に詰める PalletOptimizer（配置結果は PalletOptimizer と同一）"""
+    pallet_class = SummedTotalsPallet
+
+
+class Command(BaseCommand):
+    help = 'ランダムな出荷依頼でパレタイズの処理時間を計測します'
+
+    # 計測する構成: (表示名, PalletOptimizer の引数)
+    SCENARIOS = {
+        'grid': {'placement_strategy': 'grid'},
+        'extreme_point': {'placement_strategy': 'extreme_point'},
+        'extreme_point_rotation': {'placement_strategy': 'extreme_point', 'allow_rotation': True},
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=20, help='出荷依頼数')
+        parser.add_argument('--lines', type=int, default=3, help='出荷依頼あたりの商品種類数')
+        parser.add_argument('--max-quantity', type=int, default=50, help='商品1種類あたりの最大数量')
+        parser.add_argument('--seed', type=int, default=0, help='乱数シード')
+        parser.add_argument('--workers', type=int, default=1, help='並列処理のプロセス数')
+        parser.add_argument('--time-budget-ms', type=int, default=None, help='詰め直しを含む処理時間の上限(ms)')
+        parser.add_argument('--repeat', type=int, default=1, help='繰り返し回数（最短時間を採用）')
+        parser.add_argument(
+            '--compare-summed-totals', action='store_true',
+            help='パレットの集計を配置のたびに合計する従来の方式でも計測して比べる（--workers 1 のみ）'
+        )
+        parser.add_argument(
+            '--scenario', action='append', choices=list(self.SCENARIOS),
+            help='計測する構成（複数指定可、省略時は全て）'
+        )
+
+    def handle(self, *args, **options):
+        config = PalletConfiguration(width=110, depth=110, max_height=150, max_weight=1000.0)
+        boxes = self._generate_boxes(options)
+        total_units = sum(box.quantity for box in boxes)
+        self.stdout.write(
+            f"出荷依頼 {options['orders']}件 / 商品 {len(boxes)}種類 / 合計 {total_units}個"
+        )
+
+        compare = options['compare_summed_totals']
+        if compare and options['workers'] > 1:
+            raise CommandError('--compare-summed-totals は --workers 1 で指定してください')
+
+        for name in options['scenario'] or list(self.SCENARIOS):
+            best_time, pallets, remaining = self._measure(config, boxes, name, options)
+            placed = sum(pallet.box_count for pallet in pallets)
+            per_unit_us = best_time / placed * 1e6 if placed else 0
+            line = (
+                f"{name:<24} パレット {len(pallets):>4}  バラ積み {len(remaining):>4}  "
+                f"{best_time * 1000:>9.1f} ms  {per_unit_us:>8.1f} µs/個"
+            )
+
+            if compare:
+                # 同じ箱を従来の方式のパレットで詰める（配置結果は同一になる）
+                summed_time, summed_pallets, _ = self._measure(
+                    config, boxes, name, options, SummedTotalsPalletOptimizer
+                )
+                summed_us = summed_time / placed * 1e6 if placed else 0
+                line += f"  （合計方式 {summed_us:>8.1f} µs/個, {summed_time / best_time:.2f}倍）"
+                if len(summed_pallets) != len(pallets):
+                    line += '  ※パレット数が異なります'
+            self.stdout.write(line)
+
+    def _measure(self, config, boxes, name, options, optimizer_class=PalletOptimizer):
+        """構成 name でパレタイズし、(最短の処理時間(秒), パレット, バラ積みの箱) を返す"""
+        best_time = None
+        for _ in range(options['repeat']):
+            optimizer = optimizer_class(config, workers=options['workers'], **self.SCENARIOS[name])
+            trial = [replace(box) for box in boxes]
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                pallets, remaining = optimizer.pack_pallet(trial, time_budget_ms=options['time_budget_ms'])
+            elapsed = time.perf_counter() - start
+            best_time = elapsed if best_time is None else min(best_time, elapsed)
+        return best_time, pallets, remaining
+
+    def _generate_boxes(self, options):
+        """出荷依頼ごとに商品種類と数量をランダムに生成"""
+        rng = random.Random(options['seed'])
+        boxes = []
+        for order_id in range(1, options['orders'] + 1):
+            for line in range(options['lines']):
+                boxes.append(Box(
+                    width=rng.randint(15, 60),
+                    depth=rng.randint(15, 60),
+                    height=rng.randint(10, 50),
+                    weight=round(rng.uniform(1, 20), 1),
+                    item_code=f'BENCH-{order_id}-{line}',
+                    quantity=rng.randint(1, options['max_quantity']),
+                    shipping_order_id=order_id,
+                ))
+        return boxes
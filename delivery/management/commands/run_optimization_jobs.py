@@ -0,0 +1,54 @@
+"""
+最適化ジョブのワーカー
+
+待機中の OptimizationJob を登録順に取り出して実行する。
+ジョブのキューはDBのテーブルのため、複数のワーカーを起動してもよい
+"""
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from delivery.jobs import run_job
+from delivery.models import OptimizationJob
+
+
+class Command(BaseCommand):
+    help = '待機中の最適化ジョブ（パレタイズ設計・配送最適化）を実行します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='待機中のジョブを全て実行したら終了')
+        parser.add_argument('--poll-interval', type=float, default=2.0, help='待機中のジョブがない場合の確認間隔(秒)')
+        parser.add_argument(
+            '--stale-minutes', type=int, default=60,
+            help='実行中のまま進捗が報告されないジョブを失敗とみなすまでの時間(分)'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write('最適化ジョブのワーカーを開始しました')
+        while True:
+            close_old_connections()
+            self._fail_stale_jobs(options['stale_minutes'])
+
+            job = OptimizationJob.claim_next()
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['poll_interval'])
+                continue
+
+            self.stdout.write(f'ジョブ {job.id} を開始: {job}')
+            run_job(job)
+            style = self.style.SUCCESS if job.status == 'SUCCEEDED' else self.style.ERROR
+            self.stdout.write(style(f'ジョブ {job.id} を終了: {job.get_status_display()} {job.message} {job.error}'))
+
+    def _fail_stale_jobs(self, minutes):
+        """ワーカーの停止などで実行中のまま残ったジョブ（最後の進捗報告から minutes 分経過）を失敗にする"""
+        now = timezone.now()
+        stale = OptimizationJob.objects.filter(status='RUNNING', heartbeat_at__lt=now - timedelta(minutes=minutes)).update(
+            status='FAILED', error='ワーカーが応答しないため中断しました', finished_at=now
+        )
+        if stale:
+            self.stdout.write(self.style.WARNING(f'{stale}件のジョブを中断しました'))
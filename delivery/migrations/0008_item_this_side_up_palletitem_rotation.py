@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-17 04:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('delivery', '0007_remove_palletloadhistory_unique_pallet_plan_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='this_side_up',
+            field=models.BooleanField(default=False, help_text='パレタイズ時に横倒し・前倒しを行わない', verbose_name='天地無用'),
+        ),
+        migrations.AddField(
+            model_name='palletitem',
+            name='rotation',
+            field=models.IntegerField(choices=[(0, 'そのまま'), (1, '水平90°'), (2, '前倒し'), (3, '前倒し＋水平90°'), (4, '横倒し＋水平90°'), (5, '横倒し')], default=0, verbose_name='向き'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-17 04:35
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('delivery', '0008_item_this_side_up_palletitem_rotation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loadpallet',
+            name='layer',
+            field=models.IntegerField(default=1, validators=[django.core.validators.MinValueValidator(1)], verbose_name='段'),
+        ),
+        migrations.AddField(
+            model_name='loadpallet',
+            name='position_z',
+            field=models.IntegerField(default=0, validators=[django.core.validators.MinValueValidator(0)], verbose_name='積載位置Z座標(cm)'),
+        ),
+        migrations.AddField(
+            model_name='unifiedpallet',
+            name='stackable',
+            field=models.BooleanField(default=True, help_text='トラック積載時に上に他のパレットを積めるか', verbose_name='段積み可'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.7 on 2026-10-17 04:47
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('delivery', '0009_unifiedpallet_stackable_loadpallet_layer'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OptimizationJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_type', models.CharField(choices=[('PALLETIZE', 'パレタイズ設計'), ('DELIVERY', '配送最適化')], max_length=20, verbose_name='ジョブ種別')),
+                ('target_date', models.DateField(verbose_name='対象日')),
+                ('status', models.CharField(choices=[('PENDING', '待機中'), ('RUNNING', '実行中'), ('SUCCEEDED', '完了'), ('FAILED', '失敗')], db_index=True, default='PENDING', max_length=20, verbose_name='ステータス')),
+                ('progress', models.IntegerField(default=0, validators=[django.core.validators.MinValueValidator(0)], verbose_name='進捗(%)')),
+                ('message', models.CharField(blank=True, max_length=256, verbose_name='進捗メッセージ')),
+                ('error', models.TextField(blank=True, verbose_name='エラー内容')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='登録日時')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='開始日時')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='終了日時')),
+                ('delivery_plans', models.ManyToManyField(blank=True, related_name='+', to='delivery.deliveryplan', verbose_name='配送計画')),
+                ('palletize_plan', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='delivery.palletizeplan', verbose_name='パレタイズ設計')),
+            ],
+            options={
+                'verbose_name': '最適化ジョブ',
+                'verbose_name_plural': '最適化ジョブ',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-17 05:10
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('delivery', '0010_optimizationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='stackable',
+            field=models.BooleanField(default=True, help_text='トラック積載時に上に他の荷物を積めるか（上積み厳禁の場合は外す）', verbose_name='上積み可'),
+        ),
+        migrations.AddField(
+            model_name='truck',
+            name='layer_weight_limit',
+            field=models.FloatField(blank=True, help_text='2段目以上の各段に積める総重量。空欄の場合は制限なし', null=True, validators=[django.core.validators.MinValueValidator(0)], verbose_name='上段の積載重量上限(kg)'),
+        ),
+        migrations.AddField(
+            model_name='truck',
+            name='max_layers',
+            field=models.IntegerField(default=2, help_text='荷台高さが登録されている場合に積み重ねる段数の上限', validators=[django.core.validators.MinValueValidator(1)], verbose_name='段積みの段数上限'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 05:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('delivery', '0011_item_stackable_truck_layer_limits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='optimizationjob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, help_text='実行中のワーカーが最後に進捗を報告した日時', null=True, verbose_name='最終応答日時'),
+        ),
+    ]
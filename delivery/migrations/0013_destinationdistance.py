@@ -0,0 +1,34 @@
+# Generated by Django 4.2.7 on 2026-10-17 05:36
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('delivery', '0012_optimizationjob_heartbeat_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DestinationDistance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('origin_latitude', models.FloatField(verbose_name='配送先1の緯度')),
+                ('origin_longitude', models.FloatField(verbose_name='配送先1の経度')),
+                ('destination_latitude', models.FloatField(verbose_name='配送先2の緯度')),
+                ('destination_longitude', models.FloatField(verbose_name='配送先2の経度')),
+                ('distance_km', models.FloatField(validators=[django.core.validators.MinValueValidator(0)], verbose_name='距離(km)')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日時')),
+                ('destination', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='delivery.destination', verbose_name='配送先2')),
+                ('origin', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='delivery.destination', verbose_name='配送先1')),
+            ],
+            options={
+                'verbose_name': '配送先間距離',
+                'verbose_name_plural': '配送先間距離',
+                'unique_together': {('origin', 'destination')},
+            },
+        ),
+    ]
@@ -12,6 +12,8 @@ class Item(models.Model):
     height = models.IntegerField('高さ(cm)', null=True, blank=True, validators=[MinValueValidator(0)])
     weight = models.FloatField('質量(kg)', null=True, blank=True, validators=[MinValueValidator(0)])
     parts_count = models.IntegerField('セット品PCS数', default=1, validators=[MinValueValidator(1)])
+    this_side_up = models.BooleanField('天地無用', default=False, help_text='パレタイズ時に横倒し・前倒しを行わない')
+    stackable = models.BooleanField('上積み可', default=True, help_text='トラック積載時に上に他の荷物を積めるか（上積み厳禁の場合は外す）')
     
     class Meta:
         verbose_name = '製品'
@@ -79,6 +81,31 @@ class Destination(models.Model):
         return f"{self.name} - {self.address}"
 
 
+class DestinationDistance(models.Model):
+    """配送先間距離テーブル（距離計算のキャッシュ。ワーカー・再起動をまたいで共有）
+    
+    origin_id < destination_id の組のみ保存する。計算時の座標を保持し、
+    配送先の緯度・経度が変わった場合は無効として再計算する。
+    座標は配列でまとめて照合するため浮動小数点で保存する
+    """
+    origin = models.ForeignKey(Destination, on_delete=models.CASCADE, related_name='+', verbose_name='配送先1')
+    destination = models.ForeignKey(Destination, on_delete=models.CASCADE, related_name='+', verbose_name='配送先2')
+    origin_latitude = models.FloatField('配送先1の緯度')
+    origin_longitude = models.FloatField('配送先1の経度')
+    destination_latitude = models.FloatField('配送先2の緯度')
+    destination_longitude = models.FloatField('配送先2の経度')
+    distance_km = models.FloatField('距離(km)', validators=[MinValueValidator(0)])
+    updated_at = models.DateTimeField('更新日時', auto_now=True)
+    
+    class Meta:
+        verbose_name = '配送先間距離'
+        verbose_name_plural = '配送先間距離'
+        unique_together = ['origin', 'destination']
+        
+    def __str__(self):
+        return f"{self.origin_id} - {self.destination_id}: {self.distance_km:.1f}km"
+
+
 class ShippingOrder(models.Model):
     """出荷依頼テーブル"""
     order_number = models.CharField('出荷依頼番号', max_length=100, unique=True)
@@ -117,6 +144,10 @@ class Truck(models.Model):
     depth = models.IntegerField('荷台奥行(cm)', default=0, validators=[MinValueValidator(0)])
     height = models.IntegerField('荷台高さ(cm)', default=0, validators=[MinValueValidator(0)])
     payload = models.IntegerField('最大積載量(kg)', default=0, validators=[MinValueValidator(0)])
+    max_layers = models.IntegerField('段積みの段数上限', default=2, validators=[MinValueValidator(1)],
+                                     help_text='荷台高さが登録されている場合に積み重ねる段数の上限')
+    layer_weight_limit = models.FloatField('上段の積載重量上限(kg)', null=True, blank=True, validators=[MinValueValidator(0)],
+                                           help_text='2段目以上の各段に積める総重量。空欄の場合は制限なし')
     shipping_company = models.CharField('運送会社名', max_length=256, blank=True)
     truck_class = models.CharField('車格', max_length=100, blank=True)
     model = models.CharField('車種', max_length=100, blank=True)
@@ -266,6 +297,16 @@ class PalletDetail(models.Model):
 
 class PalletItem(models.Model):
     """パレット積載商品"""
+    # 向き（width/depth/height は回転後の寸法）
+    ROTATION_CHOICES = [
+        (0, 'そのまま'),
+        (1, '水平90°'),
+        (2, '前倒し'),
+        (3, '前倒し＋水平90°'),
+        (4, '横倒し＋水平90°'),
+        (5, '横倒し'),
+    ]
+    
     pallet = models.ForeignKey(PalletDetail, on_delete=models.CASCADE, related_name='items')
     shipping_order = models.ForeignKey(ShippingOrder, on_delete=models.PROTECT, verbose_name='出荷依頼')
     item = models.ForeignKey(Item, on_delete=models.PROTECT, verbose_name='品目')
@@ -277,6 +318,7 @@ class PalletItem(models.Model):
     depth = models.IntegerField('奥行(cm)', validators=[MinValueValidator(0)])
     height = models.IntegerField('高さ(cm)', validators=[MinValueValidator(0)])
     weight = models.FloatField('重量(kg)', validators=[MinValueValidator(0)])
+    rotation = models.IntegerField('向き', default=0, choices=ROTATION_CHOICES)
     
     class Meta:
         verbose_name = 'パレット積載商品'
@@ -386,6 +428,8 @@ class UnifiedPallet(models.Model):
     item = models.ForeignKey(Item, on_delete=models.PROTECT, null=True, blank=True, verbose_name='品目')
     item_quantity = models.IntegerField('商品数量', null=True, blank=True, validators=[MinValueValidator(1)])
     
+    stackable = models.BooleanField('段積み可', default=True, help_text='トラック積載時に上に他のパレットを積めるか')
+    
     created_at = models.DateTimeField('作成日時', auto_now_add=True)
     
     class Meta:
@@ -429,6 +473,8 @@ class LoadPallet(models.Model):
     pallet = models.ForeignKey(UnifiedPallet, on_delete=models.PROTECT, verbose_name='パレット')
     position_x = models.IntegerField('積載位置X座標(cm)', validators=[MinValueValidator(0)])
     position_y = models.IntegerField('積載位置Y座標(cm)', validators=[MinValueValidator(0)])
+    position_z = models.IntegerField('積載位置Z座標(cm)', default=0, validators=[MinValueValidator(0)])
+    layer = models.IntegerField('段', default=1, validators=[MinValueValidator(1)])
     rotation = models.IntegerField('回転角度', default=0, choices=[(0, '0°'), (90, '90°'), (180, '180°'), (270, '270°')])
     load_sequence = models.IntegerField('積み込み順序', validators=[MinValueValidator(1)])
     
@@ -461,4 +507,78 @@ class PalletLoadHistory(models.Model):
         unique_together = ['pallet', 'plan']
         
     def __str__(self):
-        return f"{self.pallet.display_name} - {self.plan} ({self.get_status_display()})"
\ No newline at end of file
+        return f"{self.pallet.display_name} - {self.plan} ({self.get_status_display()})"
+
+class OptimizationJob(models.Model):
+    """最適化ジョブテーブル（パレタイズ設計・配送最適化をワーカーで実行する）"""
+    JOB_TYPE_CHOICES = [
+        ('PALLETIZE', 'パレタイズ設計'),
+        ('DELIVERY', '配送最適化'),
+    ]
+    STATUS_CHOICES = [
+        ('PENDING', '待機中'),
+        ('RUNNING', '実行中'),
+        ('SUCCEEDED', '完了'),
+        ('FAILED', '失敗'),
+    ]
+    
+    job_type = models.CharField('ジョブ種別', max_length=20, choices=JOB_TYPE_CHOICES)
+    target_date = models.DateField('対象日')
+    status = models.CharField('ステータス', max_length=20, choices=STATUS_CHOICES, default='PENDING', db_index=True)
+    progress = models.IntegerField('進捗(%)', default=0, validators=[MinValueValidator(0)])
+    message = models.CharField('進捗メッセージ', max_length=256, blank=True)
+    error = models.TextField('エラー内容', blank=True)
+    
+    # 実行結果
+    palletize_plan = models.ForeignKey(PalletizePlan, on_delete=models.SET_NULL, null=True, blank=True,
+                                       related_name='+', verbose_name='パレタイズ設計')
+    delivery_plans = models.ManyToManyField(DeliveryPlan, related_name='+', blank=True, verbose_name='配送計画')
+    
+    created_at = models.DateTimeField('登録日時', auto_now_add=True)
+    started_at = models.DateTimeField('開始日時', null=True, blank=True)
+    heartbeat_at = models.DateTimeField('最終応答日時', null=True, blank=True, help_text='実行中のワーカーが最後に進捗を報告した日時')
+    finished_at = models.DateTimeField('終了日時', null=True, blank=True)
+    
+    class Meta:
+        verbose_name = '最適化ジョブ'
+        verbose_name_plural = '最適化ジョブ'
+        ordering = ['-created_at']
+        
+    def __str__(self):
+        return f"{self.get_job_type_display()} {self.target_date} ({self.get_status_display()})"
+    
+    @property
+    def is_finished(self):
+        return self.status in ('SUCCEEDED', 'FAILED')
+    
+    @classmethod
+    def enqueue(cls, job_type, target_date):
+        """ジョブを登録（同じ種別・対象日の未完了のジョブがあればそれを返す）"""
+        job = cls.objects.filter(
+            job_type=job_type, target_date=target_date, status__in=['PENDING', 'RUNNING']
+        ).order_by('created_at').first()
+        return job or cls.objects.create(job_type=job_type, target_date=target_date)
+    
+    @classmethod
+    def claim_next(cls):
+        """最も古い待機中のジョブを実行中にして返す（なければNone）
+        
+        状態が待機中の場合のみ更新するため、複数のワーカーが同じジョブを取得することはない
+        """
+        for job_id in cls.objects.filter(status='PENDING').order_by('created_at').values_list('id', flat=True)[:10]:
+            now = timezone.now()
+            claimed = cls.objects.filter(id=job_id, status='PENDING').update(
+                status='RUNNING', started_at=now, heartbeat_at=now, message='開始しました'
+            )
+            if claimed:
+                return cls.objects.get(id=job_id)
+        return None
+    
+    def report_progress(self, progress, message=''):
+        """進捗と最終応答日時を保存（ジョブの他の項目は更新しない）"""
+        self.progress = max(0, min(100, int(progress)))
+        self.message = message[:256]
+        self.heartbeat_at = timezone.now()
+        OptimizationJob.objects.filter(id=self.id, status='RUNNING').update(
+            progress=self.progress, message=self.message, heartbeat_at=self.heartbeat_at
+        )
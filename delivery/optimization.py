@@ -6,11 +6,21 @@
 
 import numpy as np
 from typing import List, Tuple, Dict, Optional
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
 from datetime import datetime, timedelta
+import heapq
 import math
-from django.db import transaction
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+import django
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Prefetch, prefetch_related_objects
 
+from .distances import DistanceCache
+from .persistence import BulkWriter, PlanWriter
+from .spatial import DestinationIndex
 from .models import (
     ShippingOrder, OrderItem, Truck, DeliveryPlan, 
     PlanOrderDetail, PlanItemLoad, Item, PalletConfiguration,
@@ -19,7 +29,20 @@ from .models import (
 )
 
 
-@dataclass
+# 箱の向き: 回転コード（PalletItem.rotation）→ 元の(幅, 奥行, 高さ)の並べ替え
+BOX_ORIENTATIONS = {
+    0: (0, 1, 2),  # そのまま
+    1: (1, 0, 2),  # 水平90°
+    2: (0, 2, 1),  # 前倒し
+    3: (2, 0, 1),  # 前倒し＋水平90°
+    4: (1, 2, 0),  # 横倒し＋水平90°
+    5: (2, 1, 0),  # 横倒し
+}
+# 天地無用の商品に許可する向き（高さ方向を変えない）
+UPRIGHT_ROTATIONS = (0, 1)
+
+
+@dataclass(slots=True)
 class Box:
     """箱（商品）を表すクラス"""
     width: int
@@ -32,9 +55,47 @@ class Box:
     y: int = 0
     z: int = 0  # 高さ方向の位置
     shipping_order_id: int = None  # 出荷依頼ID
+    rotation: int = 0  # 向き（BOX_ORIENTATIONS のキー）。width/depth/height は回転後の寸法
+    this_side_up: bool = False  # 天地無用
+    stackable: bool = True  # トラック積載時に上に荷物を積めるか
+    source_idx: int = None  # 呼び出し元の商品情報の番号（1個単位に分けた箱・回転した箱にも引き継がれる）
+    
+    def base_dimensions(self) -> Tuple[int, int, int]:
+        """回転前の(幅, 奥行, 高さ)"""
+        placed = (self.width, self.depth, self.height)
+        base = [0, 0, 0]
+        for axis, source in enumerate(BOX_ORIENTATIONS[self.rotation]):
+            base[source] = placed[axis]
+        return tuple(base)
+    
+    def rotate(self, rotation: int):
+        """指定した向きに回転（寸法を置き換える）"""
+        base = self.base_dimensions()
+        self.width, self.depth, self.height = (base[i] for i in BOX_ORIENTATIONS[rotation])
+        self.rotation = rotation
+    
+    def allowed_rotations(self) -> List[int]:
+        """取り得る向き（寸法が同じになる向きは除く）"""
+        base = self.base_dimensions()
+        rotations = UPRIGHT_ROTATIONS if self.this_side_up else tuple(BOX_ORIENTATIONS)
+        seen = set()
+        allowed = []
+        for rotation in rotations:
+            dims = tuple(base[i] for i in BOX_ORIENTATIONS[rotation])
+            if dims not in seen:
+                seen.add(dims)
+                allowed.append(rotation)
+        return allowed
+
 
+# 配置済みの箱の占有範囲（パレット上の座標, cm）
+BOX_EXTENT_DTYPE = np.dtype([
+    ('x1', np.int32), ('y1', np.int32), ('z1', np.int32),
+    ('x2', np.int32), ('y2', np.int32), ('z2', np.int32),
+])
 
-@dataclass
+
+@dataclass(slots=True)
 class Pallet:
     """パレットを表すクラス"""
     width: int = 100  # パレット幅
@@ -43,10 +104,30 @@ class Pallet:
     max_weight: float = 100  # 最大重量
     boxes: List[Box] = None
     current_height: int = 0  # 現在の積み上げ高さ
+    # 積載済みの箱の集計（add_box で更新）
+    total_weight: float = 0.0
+    used_volume: int = 0
+    box_count: int = 0
+    extreme_points: List[Tuple[int, int, int]] = None  # 配置候補点（エクストリームポイント）
+    # 1cm四方ごとの積み上げ高さ（行: 奥行方向y, 列: 幅方向x）
+    height_map: np.ndarray = field(default=None, compare=False, repr=False)
+    # 積み上げ高さより下に空間がある（はみ出した箱の下の）セル
+    gap_map: np.ndarray = field(default=None, compare=False, repr=False)
+    # 配置済みの箱の占有範囲（先頭 extent_count 件が有効、容量は倍々で拡張）
+    extents: np.ndarray = field(default=None, compare=False, repr=False)
+    extent_count: int = field(default=0, compare=False, repr=False)
     
     def __post_init__(self):
         if self.boxes is None:
             self.boxes = []
+        if self.extreme_points is None:
+            self.extreme_points = [(0, 0, 0)]
+        if self.height_map is None:
+            self.height_map = np.zeros((self.depth, self.width), dtype=np.int32)
+        if self.gap_map is None:
+            self.gap_map = np.zeros((self.depth, self.width), dtype=bool)
+        if self.extents is None:
+            self.extents = np.zeros(16, dtype=BOX_EXTENT_DTYPE)
     
     @classmethod
     def from_config(cls, config: 'PalletConfiguration'):
@@ -58,16 +139,47 @@ class Pallet:
             max_weight=config.max_weight
         )
     
+    def add_box(self, box: Box):
+        """箱を積載し、重量・体積・個数・高さの集計を更新"""
+        self.boxes.append(box)
+        self.total_weight += box.weight * box.quantity
+        self.used_volume += box.width * box.depth * box.height * box.quantity
+        self.box_count += box.quantity
+        self.current_height = max(self.current_height, box.z + box.height)
+    
+    def copy(self) -> 'Pallet':
+        """積載状態を複製（配置済みの箱は共有する）"""
+        return replace(
+            self, boxes=list(self.boxes), extreme_points=list(self.extreme_points),
+            height_map=self.height_map.copy(), gap_map=self.gap_map.copy(), extents=self.extents.copy()
+        )
+    
+    def add_extent(self, box: Box):
+        """配置した箱の占有範囲を追加"""
+        if self.extent_count == len(self.extents):
+            grown = np.zeros(len(self.extents) * 2, dtype=BOX_EXTENT_DTYPE)
+            grown[:self.extent_count] = self.extents
+            self.extents = grown
+        self.extents[self.extent_count] = (
+            box.x, box.y, box.z,
+            box.x + box.width, box.y + box.depth, box.z + box.height
+        )
+        self.extent_count += 1
+    
+    def placed_extents(self) -> np.ndarray:
+        """配置済みの箱の占有範囲（ビュー）"""
+        return self.extents[:self.extent_count]
+    
     def get_total_weight(self) -> float:
         """パレット上の総重量を取得"""
-        return sum(b.weight * b.quantity for b in self.boxes)
+        return self.total_weight
     
     def get_used_volume(self) -> int:
         """使用済み体積を取得"""
-        return sum(b.width * b.depth * b.height * b.quantity for b in self.boxes)
+        return self.used_volume
 
 
-@dataclass
+@dataclass(slots=True)
 class Position:
     """位置を表すクラス"""
     x: int
@@ -75,34 +187,111 @@ class Position:
     width: int
     depth: int
     rotation: int = 0
+    z: int = 0  # 高さ方向の位置（3D積載）
+    layer: int = 1  # 段（床置きが1段目）
+
+
+@dataclass(slots=True)
+class PackingCheckpoint:
+    """BinPacking2D.try_add で仮配置する前の状態と、仮配置の結果"""
+    placed_count: int  # 仮配置前の配置済みアイテム数
+    state: object  # 仮配置前の空き領域（BinPacking2D._snapshot の戻り値）
+    positions: List[Optional[Position]]  # 追加したアイテムの位置（引数の順、配置できなければNone）
+    
+    @property
+    def all_placed(self) -> bool:
+        """追加したアイテムがすべて配置できたか"""
+        return all(position is not None for position in self.positions)
 
 
 class PalletOptimizer:
     """パレタイズ最適化クラス（3D配置対応）"""
     
-    def __init__(self, pallet_config=None):
+    # 配置位置の探索方法
+    #   grid: 床面をposition_step刻み＋既存の箱の上面を1cm刻みで走査
+    #   extreme_point: 配置済みの箱の角から生成した候補点のみを試す（向きの探索なしでは、grid の方が
+    #                  パレット数が少ない出荷依頼は grid の結果を使う）
+    PLACEMENT_STRATEGIES = ('grid', 'extreme_point')
+    
+    # 作成するパレットのクラス（集計方法の異なるパレットで比べる場合はサブクラスで差し替える）
+    pallet_class = Pallet
+    
+    # 上に積む箱の底面のうち、支えが必要な面積の割合
+    SUPPORT_RATIO = 0.7
+    
+    # 1個ずつ配置する箱の並び順（いずれも大きい順）。volume が通常の FFD
+    SORT_KEYS = {
+        'volume': lambda box: box.width * box.depth * box.height,
+        'footprint': lambda box: box.width * box.depth,
+        'height': lambda box: box.height,
+        'weight': lambda box: box.weight,
+    }
+    # 時間予算の残りで試すランダムな並び順の、体積に掛ける揺らぎの幅
+    PERTURBATION = 0.2
+    
+    def __init__(self, pallet_config=None, placement_strategy: str = 'grid', position_step: int = 5,
+                 allow_rotation: bool = False, workers: int = 1):
         """
         Args:
             pallet_config: PalletConfiguration インスタンス。Noneの場合はデフォルト設定を使用
+            placement_strategy: 配置位置の探索方法（PLACEMENT_STRATEGIES のいずれか）
+            position_step: grid で床面を走査する位置の刻み幅(cm)
+            allow_rotation: 箱の向き（最大6通り、天地無用は水平回転のみ）を探索するか。
+                向きの数だけ探索が増えるため、extreme_point との併用を推奨
+            workers: 出荷依頼グループを並列にパレタイズするプロセス数（1の場合は逐次処理）。
+                結果は逐次処理と同一
         """
         if pallet_config is None:
             pallet_config = PalletConfiguration.get_default()
         
+        if placement_strategy not in self.PLACEMENT_STRATEGIES:
+            raise ValueError(f"未対応の配置戦略です: {placement_strategy}")
+        if position_step < 1:
+            raise ValueError(f"位置の刻み幅は1cm以上を指定してください: {position_step}")
+        if workers < 1:
+            raise ValueError(f"プロセス数は1以上を指定してください: {workers}")
+        
         self.pallet_width = pallet_config.width     # cm
         self.pallet_depth = pallet_config.depth     # cm
         self.max_height = pallet_config.max_height  # cm
         self.max_weight = pallet_config.max_weight  # kg
+        self.max_volume = self.pallet_width * self.pallet_depth * self.max_height  # cm³
         self.config = pallet_config
+        self.placement_strategy = placement_strategy
+        self.position_step = position_step
+        self.allow_rotation = allow_rotation
+        self.workers = workers
     
     def can_palletize(self, box: Box) -> bool:
         """商品がパレタイズ可能かチェック"""
+        if self.allow_rotation:
+            # 取り得る向きのいずれかでパレットに収まるか
+            base = box.base_dimensions()
+            for rotation in box.allowed_rotations():
+                width, depth, height = (base[i] for i in BOX_ORIENTATIONS[rotation])
+                if width <= self.pallet_width and depth <= self.pallet_depth and height <= self.max_height:
+                    return True
+            return False
+        
         # 回転も考慮して、どちらかの向きで収まるかチェック
         fits_normal = (box.width <= self.pallet_width and box.depth <= self.pallet_depth)
         fits_rotated = (box.depth <= self.pallet_width and box.width <= self.pallet_depth)
         return (fits_normal or fits_rotated) and box.height <= self.max_height
     
-    def pack_pallet(self, boxes: List[Box]) -> Tuple[List[Pallet], List[Box]]:
-        """箱をパレットに詰める（3D First Fit Decreasing + 出荷依頼別分離）"""
+    def pack_pallet(self, boxes: List[Box], time_budget_ms: int = None) -> Tuple[List[Pallet], List[Box]]:
+        """箱をパレットに詰める（3D First Fit Decreasing + 出荷依頼別分離）
+        
+        quantity > 1 の箱は同一商品の集まりとして扱い、パレット1枚分の
+        ブロック（列 × 行 × 段）で満載できる分と、端数のうち段単位で揃う分を
+        先にブロックで積み付け、最後の1段に満たない分のみを1個ずつ配置する。戻り値のパレット上の箱とバラ積みの箱は1個単位（quantity=1）。
+        
+        Args:
+            boxes: 詰める箱
+            time_budget_ms: 処理時間の上限(ms)。指定した場合、FFDの結果を得た後の残り時間で
+                並び順（SORT_KEYS・ランダムな揺らぎ）を変えて詰め直し、パレット数が少なく、
+                同数なら積載率の高い結果を返す。FFDの処理時間が上限を超えた場合はFFDの結果を返す
+        """
+        start = time.perf_counter()
         pallets = []
         remaining_boxes = []
         
@@ -116,44 +305,351 @@ class PalletOptimizer:
         
         print(f"出荷依頼別グループ数: {len(order_groups)}")
         
-        # 各出荷依頼グループを個別にパレタイズ
-        for order_id, order_boxes in order_groups.items():
-            print(f"出荷依頼ID {order_id}: {len(order_boxes)}個の商品をパレタイズ")
+        # 詰め直し用に配置前の箱を保存（配置で位置・向きが書き換わるため）
+        if time_budget_ms:
+            originals = [[replace(box) for box in order_boxes] for order_boxes in order_groups.values()]
+        
+        # 各出荷依頼グループを個別にパレタイズ（グループ間でパレットは共有しない）
+        if self.workers > 1 and len(order_groups) > 1:
+            results = self._pack_order_groups_parallel(order_groups)
+        else:
+            results = [self._pack_order_group(order_id, order_boxes)
+                       for order_id, order_boxes in order_groups.items()]
+        
+        if time_budget_ms:
+            deadline = start + time_budget_ms / 1000
+            results = self._improve_within_budget(list(order_groups), originals, results, deadline)
+        
+        for order_pallets, order_remaining in results:
+            pallets.extend(order_pallets)
+            remaining_boxes.extend(order_remaining)
+        
+        print(f"総パレット数: {len(pallets)}")
+        return pallets, remaining_boxes
+    
+    def _pack_order_group(self, order_id, order_boxes: List[Box], sort_key=None,
+                          verbose: bool = True) -> Tuple[List[Pallet], List[Box]]:
+        """1つの出荷依頼の箱をパレットに詰める
+        
+        extreme_point（向きの探索なし）では候補点が限られるため、パレット数が下限に達しない場合は
+        grid でも詰め、grid の方がパレット数が少なければ grid の結果を返す（grid より多くのパレットを
+        使わない）。向きを探索する場合は grid の探索が向きの数だけ重くなるため行わない
+        
+        Args:
+            sort_key: 1個ずつ配置する箱の並び順（大きい順）。Noneの場合は体積
+            verbose: 進捗を表示するか（詰め直しの試行では表示しない）
+        """
+        if self.placement_strategy != 'extreme_point' or self.allow_rotation:
+            return self._pack_order_group_boxes(order_id, order_boxes, sort_key, verbose)
+        
+        originals = [replace(box) for box in order_boxes]
+        result = self._pack_order_group_boxes(order_id, order_boxes, sort_key, verbose)
+        order_pallets = result[0]
+        if len(order_pallets) <= self._pallet_lower_bound(order_pallets):
+            return result
+        
+        grid = type(self)(self.config, placement_strategy='grid', position_step=self.position_step)
+        grid_result = grid._pack_order_group_boxes(order_id, originals, sort_key, verbose=False)
+        if len(grid_result[0]) < len(order_pallets):
+            if verbose:
+                print(f"出荷依頼ID {order_id}: grid の方がパレットが少ないため grid の結果を使用 "
+                      f"({len(order_pallets)} → {len(grid_result[0])}パレット)")
+            return grid_result
+        return result
+    
+    def _pack_order_group_boxes(self, order_id, order_boxes: List[Box], sort_key=None,
+                                verbose: bool = True) -> Tuple[List[Pallet], List[Box]]:
+        """1つの出荷依頼の箱を placement_strategy でパレットに詰める
+        
+        配置先の候補は積載中（オープン）のパレットのみで、残り容量の少ない順に試す。
+        残りの箱のうち最も軽い・低い箱も載らなくなったパレットはクローズし、以降は参照しない。
+        
+        Args:
+            sort_key: 1個ずつ配置する箱の並び順（大きい順）。Noneの場合は体積
+            verbose: 進捗を表示するか（詰め直しの試行では表示しない）
+        """
+        if verbose:
+            print(f"出荷依頼ID {order_id}: {sum(b.quantity for b in order_boxes)}個の商品をパレタイズ")
+        order_pallets = []
+        open_pallets = []
+        remaining_boxes = []
+        
+        # 同一商品はブロック単位（満載のパレットと端数の段）で積み、1段に満たない分のみ個別に配置
+        unit_boxes = []
+        for box in order_boxes:
+            if box.quantity > 1:
+                block_pallets, rest_boxes = self._pack_full_blocks(box, verbose)
+                order_pallets.extend(block_pallets)
+                open_pallets.extend(block_pallets)
+                unit_boxes.extend(rest_boxes)
+            else:
+                unit_boxes.append(box)
+        
+        # 体積順でソート（大きい順）- より効率的なパッキングのため
+        sorted_boxes = sorted(unit_boxes, key=sort_key or self.SORT_KEYS['volume'], reverse=True)
+        
+        # i番目以降の箱の最小重量・最小高さ（パレットのクローズ判定用）
+        min_weights = [0.0] * len(sorted_boxes)
+        min_heights = [0] * len(sorted_boxes)
+        lightest, lowest = float('inf'), float('inf')
+        for i in range(len(sorted_boxes) - 1, -1, -1):
+            lightest = min(lightest, sorted_boxes[i].weight)
+            lowest = min(lowest, self._min_height(sorted_boxes[i]))
+            min_weights[i], min_heights[i] = lightest, lowest
+        
+        for i, box in enumerate(sorted_boxes):
+            if not self.can_palletize(box):
+                remaining_boxes.append(box)
+                continue
             
-            # 体積順でソート（大きい順）- より効率的なパッキングのため
-            sorted_boxes = sorted(order_boxes, key=lambda b: b.width * b.depth * b.height, reverse=True)
+            # 満載のパレットをクローズ
+            open_pallets = [
+                pallet for pallet in open_pallets
+                if pallet.total_weight + min_weights[i] <= self.max_weight
+                and pallet.current_height + min_heights[i] <= self.max_height
+            ]
+            # 残り容量（体積）の少ないパレットから試す
+            open_pallets.sort(key=lambda pallet: self.max_volume - pallet.used_volume)
             
-            for box in sorted_boxes:
-                if not self.can_palletize(box):
-                    remaining_boxes.append(box)
+            placed = False
+            for pallet in open_pallets:
+                placement = self._find_placement(pallet, box)
+                if placement:
+                    self._place_box(pallet, box, *placement)
+                    placed = True
+                    break
+            
+            # 新しいパレットが必要
+            if not placed:
+                new_pallet = self.pallet_class.from_config(self.config)
+                placement = self._find_placement(new_pallet, box) or ((0, 0, 0), box.rotation)
+                self._place_box(new_pallet, box, *placement)
+                order_pallets.append(new_pallet)
+                open_pallets.append(new_pallet)
+                if verbose:
+                    print(f"出荷依頼ID {order_id} 用の新しいパレット #{len(order_pallets)} を作成")
+        
+        return order_pallets, remaining_boxes
+    
+    def _improve_within_budget(self, order_ids: List[int], originals: List[List[Box]],
+                               results: List[Tuple[List[Pallet], List[Box]]],
+                               deadline: float) -> List[Tuple[List[Pallet], List[Box]]]:
+        """期限まで並び順を変えて出荷依頼グループを詰め直し、グループごとに最良の結果を残す
+        
+        SORT_KEYS の各並び順を全グループで試した後は、体積にランダムな揺らぎを
+        掛けた並び順を繰り返す。前回の所要時間で期限を超えそうな試行は行わない。
+        """
+        best = [(self._packing_score(*result), result) for result in results]
+        # パレット数が下限（体積・重量から求めた枚数）に達したグループは詰め直さない
+        pending = [
+            index for index, (order_pallets, _) in enumerate(results)
+            if len(order_pallets) > self._pallet_lower_bound(order_pallets)
+        ]
+        durations = {}
+        attempts = {}
+        rng = random.Random(0)
+        sort_keys = [key for name, key in self.SORT_KEYS.items() if name != 'volume']
+        trials = 0
+        improved = 0
+        
+        while pending:
+            tried = False
+            for index in list(pending):
+                if time.perf_counter() + durations.get(index, 0) > deadline:
                     continue
+                attempt = attempts.get(index, 0)
+                attempts[index] = attempt + 1
+                if attempt < len(sort_keys):
+                    sort_key = sort_keys[attempt]
+                else:
+                    # 同じ商品（1個単位に分けた箱を含む）には同じ揺らぎを掛ける
+                    noise = {box.item_code: rng.uniform(1 - self.PERTURBATION, 1 + self.PERTURBATION)
+                             for box in originals[index]}
+                    sort_key = lambda box, noise=noise: box.width * box.depth * box.height * noise[box.item_code]
                 
-                placed = False
-                
-                # 既存パレットに配置可能かチェック（同じ出荷依頼のパレットのみ）
-                for pallet in pallets:
-                    # パレットが同じ出荷依頼の商品のみを含むかチェック
-                    if pallet.boxes and pallet.boxes[0].shipping_order_id == order_id:
-                        position = self._find_position_on_pallet(pallet, box)
-                        if position:
-                            box.x, box.y, box.z = position
-                            pallet.boxes.append(box)
-                            # パレットの現在の高さを更新
-                            pallet.current_height = max(pallet.current_height, box.z + box.height)
-                            placed = True
-                            break
+                trial_start = time.perf_counter()
+                trial_boxes = [replace(box) for box in originals[index]]
+                result = self._pack_order_group(order_ids[index], trial_boxes, sort_key, verbose=False)
+                durations[index] = time.perf_counter() - trial_start
+                trials += 1
+                tried = True
                 
-                # 新しいパレットが必要
-                if not placed:
-                    new_pallet = Pallet.from_config(self.config)
-                    box.x, box.y, box.z = 0, 0, 0
-                    new_pallet.boxes.append(box)
-                    new_pallet.current_height = box.height
-                    pallets.append(new_pallet)
-                    print(f"出荷依頼ID {order_id} 用の新しいパレット #{len(pallets)} を作成")
+                score = self._packing_score(*result)
+                if score < best[index][0]:
+                    best[index] = (score, result)
+                    improved += 1
+                    if len(result[0]) <= self._pallet_lower_bound(result[0]):
+                        pending.remove(index)
+            if not tried:
+                break
+        
+        print(f"時間内の詰め直し: {trials}回試行、{improved}回改善")
+        return [result for _, result in best]
+    
+    def _packing_score(self, pallets: List[Pallet], remaining: List[Box]) -> Tuple:
+        """詰め方の評価値（小さいほど良い）: パレット数、バラ積みの数、積載率
         
-        print(f"総パレット数: {len(pallets)}")
-        return pallets, remaining_boxes
+        箱の総体積は同じなので、積載率は各パレットの積載率の二乗和で比べる
+        （満載に近いパレットが多く、端数が少数のパレットにまとまっている方が良い）
+        """
+        utilization = sum((pallet.used_volume / self.max_volume) ** 2 for pallet in pallets)
+        return (len(pallets), len(remaining), -utilization)
+    
+    def _pallet_lower_bound(self, pallets: List[Pallet]) -> int:
+        """積載済みの箱の総体積・総重量から求めたパレット数の下限"""
+        volume = sum(pallet.used_volume for pallet in pallets)
+        weight = sum(pallet.total_weight for pallet in pallets)
+        return max(math.ceil(volume / self.max_volume), math.ceil(weight / self.max_weight), 1)
+    
+    def _pack_order_groups_parallel(self, order_groups: Dict[int, List[Box]]) -> List[Tuple[List[Pallet], List[Box]]]:
+        """出荷依頼グループをプロセスプールでパレタイズ
+        
+        ワーカーとの受け渡しは箱の寸法と配置結果のタプルのみとし、
+        結果は出荷依頼の順にこのプロセスの Box・Pallet に復元する。
+        """
+        options = (
+            (self.pallet_width, self.pallet_depth, self.max_height, self.max_weight),
+            self.placement_strategy, self.position_step, self.allow_rotation,
+        )
+        groups = list(order_groups.items())
+        tasks = [
+            (order_id, [_box_to_row(box) for box in order_boxes])
+            for order_id, order_boxes in groups
+        ]
+        
+        print(f"{min(self.workers, len(tasks))}プロセスで並列にパレタイズ")
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(tasks)),
+                                 initializer=django.setup) as executor:
+            packed = list(executor.map(_pack_order_group_in_worker, [options] * len(tasks), tasks))
+        
+        results = []
+        for (order_id, order_boxes), (pallet_rows, remaining_rows) in zip(groups, packed):
+            order_pallets = []
+            for rows in pallet_rows:
+                pallet = self.pallet_class.from_config(self.config)
+                for row in rows:
+                    box = _box_from_row(order_boxes, row)
+                    pallet.add_box(box)
+                    self._occupy(pallet, box, update_points=False)
+                order_pallets.append(pallet)
+            remaining = [_box_from_row(order_boxes, row) for row in remaining_rows]
+            results.append((order_pallets, remaining))
+        return results
+    
+    def _min_height(self, box: Box) -> int:
+        """取り得る向きのうち最も低い高さ"""
+        if not self.allow_rotation:
+            return box.height
+        base = box.base_dimensions()
+        return min(base[BOX_ORIENTATIONS[rotation][2]] for rotation in box.allowed_rotations())
+    
+    def _pack_full_blocks(self, box: Box, verbose: bool = True) -> Tuple[List[Pallet], List[Box]]:
+        """同一商品 box.quantity 個のうち、ブロックで積める分をパレットに積む
+        
+        パレット1枚分のブロック（列 × 行 × 段）で満載できる分を積み、端数のうち
+        段単位で揃う分（列 × 行 × ⌊端数 / (列 × 行)⌋）も1枚のパレットにブロックで積む。
+        最後の1段に満たない分のみを1個単位の箱として返す。
+        
+        Returns:
+            (ブロックを積んだパレット, 残りの箱（1個単位）)
+        """
+        layout = self._block_layout(box) if self.can_palletize(box) else None
+        if layout is None:
+            return [], self._split_units(box, box.quantity)
+        
+        rotation, columns, rows, layers = layout
+        per_layer = columns * rows
+        per_pallet = per_layer * layers
+        full_pallets, rest = divmod(box.quantity, per_pallet)
+        rest_layers = rest // per_layer
+        
+        pallets = []
+        for _ in range(full_pallets):
+            pallet = self.pallet_class.from_config(self.config)
+            self._place_block(pallet, box, rotation, columns, rows, layers)
+            pallets.append(pallet)
+        if rest_layers:
+            # 端数の段は上に他の箱を積めるよう、オープンなパレットとして返す
+            pallet = self.pallet_class.from_config(self.config)
+            self._place_block(pallet, box, rotation, columns, rows, rest_layers)
+            pallets.append(pallet)
+        
+        if full_pallets and verbose:
+            print(f"商品 {box.item_code}: {columns}×{rows}×{layers} のブロックで {full_pallets} パレットを満載")
+        if rest_layers and verbose:
+            print(f"商品 {box.item_code}: 端数を {columns}×{rows}×{rest_layers} のブロックで積載")
+        return pallets, self._split_units(box, rest - rest_layers * per_layer)
+    
+    def _block_layout(self, box: Box) -> Optional[Tuple[int, int, int, int]]:
+        """パレット1枚を同一商品で満載するブロック（向き, 列数, 行数, 段数）を計算
+        
+        どの向きでもパレットに1段も積めない場合はNone
+        """
+        rotations = box.allowed_rotations() if self.allow_rotation else [box.rotation]
+        base = box.base_dimensions()
+        
+        best = None
+        for rotation in rotations:
+            width, depth, height = (base[i] for i in BOX_ORIENTATIONS[rotation])
+            columns = self.pallet_width // width
+            rows = self.pallet_depth // depth
+            layers = self.max_height // height
+            if columns == 0 or rows == 0 or layers == 0:
+                continue
+            # 重量制限に収まる段数まで減らす
+            if box.weight > 0:
+                layers = min(layers, int(self.max_weight // (box.weight * columns * rows)))
+            units = columns * rows * layers
+            if units > 0 and (best is None or units > best[0]):
+                best = (units, rotation, columns, rows, layers)
+        
+        if best is None:
+            return None
+        return best[1:]
+    
+    def _place_block(self, pallet: Pallet, box: Box, rotation: int, columns: int, rows: int, layers: int):
+        """空のパレットに同一商品のブロックを原点から積み付ける"""
+        unit = replace(box, quantity=1)
+        unit.rotate(rotation)
+        for layer in range(layers):
+            for row in range(rows):
+                for column in range(columns):
+                    pallet.add_box(replace(
+                        unit, x=column * unit.width, y=row * unit.depth, z=layer * unit.height
+                    ))
+        
+        # 衝突・支持判定や候補点はブロック全体を1つの直方体として扱う
+        block = replace(unit, width=columns * unit.width, depth=rows * unit.depth,
+                        height=layers * unit.height)
+        self._occupy(pallet, block)
+    
+    def _split_units(self, box: Box, count: int) -> List[Box]:
+        """quantity個の箱を1個単位の箱に分ける"""
+        if box.quantity == 1 and count == 1:
+            return [box]
+        return [replace(box, quantity=1) for _ in range(count)]
+    
+    def _find_placement(self, pallet: Pallet, box: Box) -> Optional[Tuple[Tuple[int, int, int], int]]:
+        """箱の向きも含めて配置位置を探す（位置, 向き）"""
+        if not self.allow_rotation:
+            position = self._find_position_on_pallet(pallet, box)
+            return (position, box.rotation) if position else None
+        
+        best = None
+        best_key = None
+        for rotation in box.allowed_rotations():
+            oriented = replace(box)
+            oriented.rotate(rotation)
+            position = self._find_position_on_pallet(pallet, oriented)
+            if not position:
+                continue
+            # 低い位置、上面が低い向き（寝かせた安定な向き）、奥・左の順に優先
+            x, y, z = position
+            key = (z, z + oriented.height, y, x)
+            if best_key is None or key < best_key:
+                best = (position, rotation)
+                best_key = key
+        return best
     
     def _find_position_on_pallet(self, pallet: Pallet, box: Box) -> Optional[Tuple[int, int, int]]:
         """パレット上で箱を配置可能な位置を探す（3D）"""
@@ -165,92 +661,301 @@ class PalletOptimizer:
         if pallet.current_height + box.height > self.max_height:
             return None
         
-        # 可能な配置位置を探す
-        possible_positions = []
+        if self.placement_strategy == 'extreme_point':
+            return self._find_extreme_point_position(pallet, box)
+        
+        step = self.position_step
         
         # 床面（z=0）での配置を試す
-        for y in range(0, self.pallet_depth - box.depth + 1, 5):  # 5cm刻み
-            for x in range(0, self.pallet_width - box.width + 1, 5):
-                if self._can_place_at_3d(pallet, x, y, 0, box):
-                    possible_positions.append((x, y, 0))
+        position = self._first_position_on_grid(
+            pallet, box,
+            range(0, self.pallet_width - box.width + 1, step),
+            range(0, self.pallet_depth - box.depth + 1, step),
+            0
+        )
+        if position:
+            return position
         
-        # 既存の箱の上に配置を試す
+        # 既存の箱の上に配置を試す（最も低い位置を選択：安定性のため）
         for existing_box in pallet.boxes:
             # 既存の箱の上面の位置
             top_z = existing_box.z + existing_box.height
             
-            # 高さ制限チェック
+            # 高さ制限チェック（すでに見つかった位置より高い面は不要）
             if top_z + box.height > self.max_height:
                 continue
+            if position and top_z >= position[2]:
+                continue
             
             # 既存の箱の上での配置可能位置を探す
-            for y in range(existing_box.y, min(existing_box.y + existing_box.depth, self.pallet_depth - box.depth + 1)):
-                for x in range(existing_box.x, min(existing_box.x + existing_box.width, self.pallet_width - box.width + 1)):
-                    if self._can_place_at_3d(pallet, x, y, top_z, box):
-                        possible_positions.append((x, y, top_z))
+            candidate = self._first_position_on_grid(
+                pallet, box,
+                range(existing_box.x, min(existing_box.x + existing_box.width, self.pallet_width - box.width + 1)),
+                range(existing_box.y, min(existing_box.y + existing_box.depth, self.pallet_depth - box.depth + 1)),
+                top_z
+            )
+            if candidate:
+                position = candidate
         
-        # 最も低い位置を選択（安定性のため）
-        if possible_positions:
-            return min(possible_positions, key=lambda p: p[2])
+        return position
+    
+    def _first_position_on_grid(self, pallet: Pallet, box: Box, xs: range, ys: range,
+                                z: int) -> Optional[Tuple[int, int, int]]:
+        """格子 xs × ys 上で高さzに配置可能な最初の位置（y→xの順）を高さマップで一括判定"""
+        if not xs or not ys:
+            return None
         
-        return None
+        rows = slice(ys[0], ys[-1] + box.depth)
+        cols = slice(xs[0], xs[-1] + box.width)
+        region = pallet.height_map[rows, cols]
+        grid = (slice(None, None, ys.step), slice(None, None, xs.step))
+        # [j, i] は位置 (xs[i], ys[j]) に置いた箱の底面が覆う範囲での集計値
+        max_z = self._window_max(region, box.depth, box.width)[grid]
+        
+        # 底面下の最大高さがz以下なら衝突はなく、高さがちょうどzのセルが支えとなる
+        if z == 0:
+            placeable = max_z == 0
+        else:
+            support_area = self._window_sum(region == z, box.depth, box.width)[grid]
+            placeable = (max_z <= z) & (support_area >= box.width * box.depth * self.SUPPORT_RATIO)
+        # 底面下にzより高いセルがある場合、下に空間のないセルなら高さzは埋まっていて衝突する。
+        # 空間のあるセルだけの場合は、はみ出した箱の下に入る可能性があるため個別に判定
+        blocked = self._window_sum(
+            (region > z) & ~pallet.gap_map[rows, cols], box.depth, box.width
+        )[grid] > 0
+        undecided = (max_z > z) & ~blocked
+        
+        candidate_rows, candidate_cols = np.nonzero(placeable | undecided)
+        if len(candidate_rows) == 0:
+            return None
+        
+        feasible = placeable[candidate_rows, candidate_cols]
+        check = ~feasible
+        if check.any():
+            # 判定が必要な位置のみ、全ての箱との衝突・支持をまとめて判定
+            candidates = np.column_stack((
+                xs.start + candidate_cols[check] * xs.step,
+                ys.start + candidate_rows[check] * ys.step,
+                np.full(np.count_nonzero(check), z),
+            ))
+            feasible[check] = self._can_place_batch(pallet, box, candidates)
+        
+        if not feasible.any():
+            return None
+        first = np.argmax(feasible)
+        return (xs[candidate_cols[first]], ys[candidate_rows[first]], z)
+    
+    def _window_max(self, region: np.ndarray, depth: int, width: int) -> np.ndarray:
+        """depth × width の窓ごとの最大値（行方向・列方向に分けて計算）"""
+        row_max = np.lib.stride_tricks.sliding_window_view(region, width, axis=1).max(axis=2)
+        return np.lib.stride_tricks.sliding_window_view(row_max, depth, axis=0).max(axis=2)
+    
+    def _window_sum(self, mask: np.ndarray, depth: int, width: int) -> np.ndarray:
+        """depth × width の窓ごとの合計（累積和から計算）"""
+        table = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int32)
+        np.cumsum(mask, axis=0, out=table[1:, 1:])
+        np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+        return (table[depth:, width:] - table[:-depth, width:]
+                - table[depth:, :-width] + table[:-depth, :-width])
+    
+    def _find_extreme_point_position(self, pallet: Pallet, box: Box) -> Optional[Tuple[int, int, int]]:
+        """エクストリームポイントから配置可能な位置を探す（低い・奥・左の順）"""
+        candidates = np.array(
+            sorted(pallet.extreme_points, key=lambda p: (p[2], p[1], p[0])), dtype=np.int32
+        ).reshape(-1, 3)
+        feasible = self._can_place_batch(pallet, box, candidates)
+        if not feasible.any():
+            return None
+        x, y, z = candidates[np.argmax(feasible)]
+        return (int(x), int(y), int(z))
+    
+    def _place_box(self, pallet: Pallet, box: Box, position: Tuple[int, int, int], rotation: int = None):
+        """箱をパレット上の指定位置・向きに配置し、高さ・高さマップ・候補点を更新"""
+        if rotation is not None and rotation != box.rotation:
+            box.rotate(rotation)
+        box.x, box.y, box.z = position
+        pallet.add_box(box)
+        self._occupy(pallet, box)
+    
+    def _occupy(self, pallet: Pallet, box: Box, update_points: bool = True):
+        """配置した箱（またはブロック）の範囲で高さマップ・占有範囲・候補点を更新
+        
+        update_points=False の場合は候補点を更新しない（配置済みのパレットの復元用）
+        """
+        pallet.add_extent(box)
+        footprint = pallet.height_map[box.y:box.y + box.depth, box.x:box.x + box.width]
+        pallet.gap_map[box.y:box.y + box.depth, box.x:box.x + box.width] |= footprint < box.z
+        np.maximum(footprint, box.z + box.height, out=footprint)
+        if update_points:
+            self._update_extreme_points(pallet, box)
+    
+    def _update_extreme_points(self, pallet: Pallet, box: Box):
+        """配置した箱の角から新しい候補点を生成し、埋まった候補点を除く"""
+        x2, y2, z2 = box.x + box.width, box.y + box.depth, box.z + box.height
+        
+        # 箱の3つの角と、それぞれを他の2軸方向へ投影した点
+        new_points = [
+            (x2, box.y, box.z), self._project_point(pallet, (x2, box.y, box.z), 1),
+            self._project_point(pallet, (x2, box.y, box.z), 2),
+            (box.x, y2, box.z), self._project_point(pallet, (box.x, y2, box.z), 0),
+            self._project_point(pallet, (box.x, y2, box.z), 2),
+            (box.x, box.y, z2), self._project_point(pallet, (box.x, box.y, z2), 0),
+            self._project_point(pallet, (box.x, box.y, z2), 1),
+        ]
+        
+        points = set()
+        for point in pallet.extreme_points + new_points:
+            px, py, pz = point
+            if px >= self.pallet_width or py >= self.pallet_depth or pz >= self.max_height:
+                continue
+            if self._point_inside_box(point, box):
+                continue
+            points.add(point)
+        pallet.extreme_points = list(points)
+    
+    def _project_point(self, pallet: Pallet, point: Tuple[int, int, int], axis: int) -> Tuple[int, int, int]:
+        """候補点を指定軸（0:x, 1:y, 2:z）の原点方向へ、最初に当たる箱の面まで移動"""
+        extents = pallet.placed_extents()
+        lows = (extents['x1'], extents['y1'], extents['z1'])
+        highs = (extents['x2'], extents['y2'], extents['z2'])
+        
+        # 投影軸以外の2軸で点が箱の面の範囲内にあり、点より原点側にある箱
+        hits = highs[axis] <= point[axis]
+        for i in range(3):
+            if i != axis:
+                hits &= (lows[i] <= point[i]) & (point[i] < highs[i])
+        
+        coords = list(point)
+        coords[axis] = int(highs[axis][hits].max()) if hits.any() else 0
+        return tuple(coords)
+    
+    def _point_inside_box(self, point: Tuple[int, int, int], box: Box) -> bool:
+        """点が箱の内部（下面・左面・奥面を含む）にあるか"""
+        px, py, pz = point
+        return (box.x <= px < box.x + box.width and
+                box.y <= py < box.y + box.depth and
+                box.z <= pz < box.z + box.height)
     
     def _can_place_at_3d(self, pallet: Pallet, x: int, y: int, z: int, box: Box) -> bool:
         """3D空間で指定位置に配置可能かチェック"""
+        return bool(self._can_place_batch(pallet, box, np.array([[x, y, z]]))[0])
+    
+    def _can_place_batch(self, pallet: Pallet, box: Box, candidates: np.ndarray) -> np.ndarray:
+        """複数の候補位置 (k, 3) について配置可能かを一括判定"""
+        x1 = candidates[:, 0:1]
+        y1 = candidates[:, 1:2]
+        z1 = candidates[:, 2:3]
+        x2, y2, z2 = x1 + box.width, y1 + box.depth, z1 + box.height
+        
         # 境界チェック
-        if x + box.width > self.pallet_width or y + box.depth > self.pallet_depth:
-            return False
+        feasible = ((x2 <= self.pallet_width) & (y2 <= self.pallet_depth) &
+                    (z2 <= self.max_height)).ravel()
         
-        # 既存の箱との衝突チェック
-        for existing_box in pallet.boxes:
-            if self._boxes_overlap_3d(
-                x, y, z, x + box.width, y + box.depth, z + box.height,
-                existing_box.x, existing_box.y, existing_box.z,
-                existing_box.x + existing_box.width,
-                existing_box.y + existing_box.depth,
-                existing_box.z + existing_box.height
-            ):
-                return False
+        extents = pallet.placed_extents()
+        if len(extents) == 0:
+            return feasible
         
-        # 下に支えがあるかチェック（z > 0の場合）
-        if z > 0:
-            support_area = 0
-            box_area = box.width * box.depth
-            
-            for existing_box in pallet.boxes:
-                # 既存の箱の上面がこの箱の底面と接する場合
-                if existing_box.z + existing_box.height == z:
-                    # 重なり部分の面積を計算
-                    overlap_x1 = max(x, existing_box.x)
-                    overlap_y1 = max(y, existing_box.y)
-                    overlap_x2 = min(x + box.width, existing_box.x + existing_box.width)
-                    overlap_y2 = min(y + box.depth, existing_box.y + existing_box.depth)
-                    
-                    if overlap_x1 < overlap_x2 and overlap_y1 < overlap_y2:
-                        support_area += (overlap_x2 - overlap_x1) * (overlap_y2 - overlap_y1)
-            
-            # 少なくとも70%の面積が支えられている必要がある
-            if support_area < box_area * 0.7:
-                return False
+        # 既存の箱との衝突チェック（候補 × 箱）
+        overlap = ~((x2 <= extents['x1']) | (extents['x2'] <= x1) |
+                    (y2 <= extents['y1']) | (extents['y2'] <= y1) |
+                    (z2 <= extents['z1']) | (extents['z2'] <= z1))
+        feasible &= ~overlap.any(axis=1)
         
-        return True
+        # 下に支えがあるかチェック（z > 0の場合）
+        # 既存の箱の上面がこの箱の底面と接する部分の面積を合計
+        overlap_w = np.clip(np.minimum(x2, extents['x2']) - np.maximum(x1, extents['x1']), 0, None)
+        overlap_d = np.clip(np.minimum(y2, extents['y2']) - np.maximum(y1, extents['y1']), 0, None)
+        touching = extents['z2'] == z1
+        support_area = (overlap_w * overlap_d * touching).sum(axis=1)
+        
+        # 少なくとも70%の面積が支えられている必要がある
+        supported = (z1.ravel() == 0) | (support_area >= box.width * box.depth * self.SUPPORT_RATIO)
+        return feasible & supported
+
+
+def _box_to_row(box: Box) -> Tuple:
+    """ワーカーに渡す箱の情報（寸法・重量・数量・向き・天地無用）"""
+    return (box.width, box.depth, box.height, box.weight, box.quantity, box.rotation, box.this_side_up)
+
+
+def _box_from_row(order_boxes: List[Box], row: Tuple) -> Box:
+    """ワーカーの配置結果 (元の箱の番号, x, y, z, 向き) から箱を復元
     
-    def _boxes_overlap_3d(self, x1: int, y1: int, z1: int, x2: int, y2: int, z2: int,
-                          x3: int, y3: int, z3: int, x4: int, y4: int, z4: int) -> bool:
-        """3D空間での箱の重複チェック"""
-        return not (x2 <= x3 or x4 <= x1 or y2 <= y3 or y4 <= y1 or z2 <= z3 or z4 <= z1)
+    quantity=1 の箱は元の Box をそのまま使い、それ以外は1個単位に分けた箱を作る
+    （逐次処理の _split_units と同じ扱い）
+    """
+    index, x, y, z, rotation = row
+    source = order_boxes[index]
+    box = source if source.quantity == 1 else replace(source, quantity=1)
+    if rotation != box.rotation:
+        box.rotate(rotation)
+    box.x, box.y, box.z = x, y, z
+    return box
+
+
+def _pack_order_group_in_worker(options: Tuple, task: Tuple) -> Tuple[List[List[Tuple]], List[Tuple]]:
+    """ProcessPoolExecutor のワーカーで1つの出荷依頼グループをパレタイズ
+    
+    Returns:
+        (パレットごとの配置結果, バラ積みの箱)。箱は (元の箱の番号, x, y, z, 向き)
+    """
+    (width, depth, max_height, max_weight), placement_strategy, position_step, allow_rotation = options
+    order_id, rows = task
+    config = PalletConfiguration(width=width, depth=depth, max_height=max_height, max_weight=max_weight)
+    optimizer = PalletOptimizer(config, placement_strategy=placement_strategy, position_step=position_step,
+                                allow_rotation=allow_rotation)
+    
+    # item_code に元の箱の番号を入れておき、1個単位に分けた箱からも引けるようにする
+    order_boxes = [
+        Box(width=box_width, depth=box_depth, height=box_height, weight=weight,
+            item_code=str(index), quantity=quantity, shipping_order_id=order_id,
+            rotation=rotation, this_side_up=this_side_up)
+        for index, (box_width, box_depth, box_height, weight, quantity, rotation, this_side_up) in enumerate(rows)
+    ]
+    
+    def placement(box: Box) -> Tuple:
+        return (int(box.item_code), box.x, box.y, box.z, box.rotation)
+    
+    pallets, remaining = optimizer._pack_order_group(order_id, order_boxes)
+    return [[placement(box) for box in pallet.boxes] for pallet in pallets], [placement(box) for box in remaining]
 
 
 class BinPacking2D:
-    """2Dビンパッキング（トラック積載最適化）"""
+    """2Dビンパッキング（トラック積載最適化）
+    
+    空き領域を極大な空き矩形の集合（MaxRects）で管理し、cm単位で配置する。
+    try_add で仮配置し、commit で確定、rollback で仮配置前の状態に戻せる。
+    荷台は y=0 が奥（運転席側）、y=奥行が扉側
+    """
+    
+    # 空き矩形の選び方
+    #   best_short_side_fit: 配置後に残る短い方の辺が最小になる空き矩形
+    #   bottom_left: 奥（y）・左（x）に最も寄せられる位置
+    STRATEGIES = ('best_short_side_fit', 'bottom_left')
     
-    def __init__(self, truck_width: int, truck_depth: int):
+    def __init__(self, truck_width: int, truck_depth: int, strategy: str = 'best_short_side_fit',
+                 door_access: bool = False):
+        """
+        Args:
+            door_access: 扉側から積み込める位置（配置済みの荷物より手前にない位置）のみに配置する。
+                placed_items の順（配置した順）がそのまま積み込み順になる
+        """
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"未対応の配置戦略です: {strategy}")
+        
         self.truck_width = truck_width
         self.truck_depth = truck_depth
+        self.strategy = strategy
+        self.door_access = door_access
+        # 配置した順の (アイテム, 位置)
         self.placed_items = []
+        # 極大な空き矩形 (x, y, 幅, 奥行)
+        self.free_rects = [(0, 0, truck_width, truck_depth)]
+        # 確定していない仮配置（新しいものが末尾）
+        self.checkpoints = []
     
     def pack(self, items: List[Box]) -> List[Position]:
-        """Bottom-Left Fill アルゴリズムで配置"""
+        """MaxRects で配置（配置できたアイテムの位置を面積の大きい順に返す）"""
         positions = []
         
         # アイテムを面積の大きい順にソート
@@ -259,40 +964,129 @@ class BinPacking2D:
         for item in sorted_items:
             position = self._find_position(item)
             if position:
+                self._place(item, position)
                 positions.append(position)
                 self.placed_items.append((item, position))
         
         return positions
     
+    def try_add(self, items: List[Box]) -> PackingCheckpoint:
+        """アイテムを面積の大きい順に仮配置する
+        
+        戻り値のチェックポイントを commit すると確定、rollback すると仮配置前に戻る。
+        配置できたかは checkpoint.all_placed、位置は checkpoint.positions（引数の順）で確認する
+        """
+        checkpoint = PackingCheckpoint(len(self.placed_items), self._snapshot(), [None] * len(items))
+        
+        order = sorted(range(len(items)), key=lambda i: items[i].width * items[i].depth, reverse=True)
+        for index in order:
+            position = self._find_position(items[index])
+            if position:
+                self._place(items[index], position)
+                self.placed_items.append((items[index], position))
+                checkpoint.positions[index] = position
+        
+        self.checkpoints.append(checkpoint)
+        return checkpoint
+    
+    def commit(self, checkpoint: PackingCheckpoint):
+        """仮配置を確定"""
+        self._pop_checkpoint(checkpoint)
+    
+    def rollback(self, checkpoint: PackingCheckpoint):
+        """仮配置を取り消し、try_add の前の状態に戻す"""
+        self._pop_checkpoint(checkpoint)
+        del self.placed_items[checkpoint.placed_count:]
+        self._restore(checkpoint.state)
+    
+    def _pop_checkpoint(self, checkpoint: PackingCheckpoint):
+        """最新の仮配置であることを確認して取り出す"""
+        if not self.checkpoints or self.checkpoints[-1] is not checkpoint:
+            raise ValueError("確定・取り消しできるのは最新の仮配置のみです")
+        self.checkpoints.pop()
+    
+    def _snapshot(self):
+        """仮配置前に戻すための空き領域の状態"""
+        return list(self.free_rects)
+    
+    def _restore(self, state):
+        """_snapshot の状態に戻す"""
+        self.free_rects = state
+    
     def _find_position(self, item: Box) -> Optional[Position]:
-        """アイテムを配置可能な位置を探す"""
+        """アイテムを配置する空き矩形と向きを選ぶ"""
         # 回転も考慮
         orientations = [
             (item.width, item.depth, 0),
             (item.depth, item.width, 90)
         ]
         
-        for width, depth, rotation in orientations:
-            # トラックのサイズを超えないかチェック
-            if width > self.truck_width or depth > self.truck_depth:
-                continue
-                
-            for y in range(0, self.truck_depth - depth + 1, 10):  # 10cm刻み
-                for x in range(0, self.truck_width - width + 1, 10):
-                    if self._can_place_at(x, y, width, depth):
-                        return Position(x, y, width, depth, rotation)
+        best = None
+        best_score = None
+        for free_x, free_y, free_width, free_depth in self.free_rects:
+            for width, depth, rotation in orientations:
+                if width > free_width or depth > free_depth:
+                    continue
+                if self.door_access and self._behind_placed(free_x, free_y, width, depth):
+                    continue
+                if self.strategy == 'best_short_side_fit':
+                    leftover_width = free_width - width
+                    leftover_depth = free_depth - depth
+                    score = (min(leftover_width, leftover_depth), max(leftover_width, leftover_depth),
+                             free_y, free_x)
+                else:
+                    score = (free_y + depth, free_x)
+                if best_score is None or score < best_score:
+                    best = Position(free_x, free_y, width, depth, rotation)
+                    best_score = score
         
-        return None
+        return best
+    
+    def _behind_placed(self, x: int, y: int, width: int, depth: int) -> bool:
+        """配置済みの荷物が、この範囲と扉の間（手前の同じ幅の範囲）にあるか"""
+        return any(
+            position.y >= y + depth and position.x < x + width and x < position.x + position.width
+            for _, position in self.placed_items
+        )
     
-    def _can_place_at(self, x: int, y: int, width: int, depth: int) -> bool:
-        """指定位置に配置可能かチェック"""
-        for item, pos in self.placed_items:
-            if self._rectangles_overlap(
-                x, y, x + width, y + depth,
-                pos.x, pos.y, pos.x + pos.width, pos.y + pos.depth
+    def _place(self, item: Box, position: Position):
+        """配置した範囲と重なる空き矩形を分割し、他に含まれる空き矩形を除く"""
+        x1, y1 = position.x, position.y
+        x2, y2 = x1 + position.width, y1 + position.depth
+        
+        free_rects = []
+        for rect in self.free_rects:
+            rect_x, rect_y, rect_width, rect_depth = rect
+            rect_x2, rect_y2 = rect_x + rect_width, rect_y + rect_depth
+            if not self._rectangles_overlap(x1, y1, x2, y2, rect_x, rect_y, rect_x2, rect_y2):
+                free_rects.append(rect)
+                continue
+            # 配置した範囲の左・右・手前・奥に残る部分
+            if x1 > rect_x:
+                free_rects.append((rect_x, rect_y, x1 - rect_x, rect_depth))
+            if x2 < rect_x2:
+                free_rects.append((x2, rect_y, rect_x2 - x2, rect_depth))
+            if y1 > rect_y:
+                free_rects.append((rect_x, rect_y, rect_width, y1 - rect_y))
+            if y2 < rect_y2:
+                free_rects.append((rect_x, y2, rect_width, rect_y2 - y2))
+        
+        self.free_rects = self._prune_free_rects(free_rects)
+    
+    def _prune_free_rects(self, rects: List[Tuple[int, int, int, int]]) -> List[Tuple[int, int, int, int]]:
+        """他の空き矩形に含まれる（極大でない）空き矩形を除く"""
+        # 面積の大きい順に見れば、含む側は常に先に残っている
+        rects = sorted(set(rects), key=lambda rect: rect[2] * rect[3], reverse=True)
+        maximal = []
+        for rect in rects:
+            x, y, width, depth = rect
+            if not any(
+                other_x <= x and other_y <= y
+                and x + width <= other_x + other_width and y + depth <= other_y + other_depth
+                for other_x, other_y, other_width, other_depth in maximal
             ):
-                return False
-        return True
+                maximal.append(rect)
+        return maximal
     
     def _rectangles_overlap(self, x1: int, y1: int, x2: int, y2: int,
                            x3: int, y3: int, x4: int, y4: int) -> bool:
@@ -300,65 +1094,381 @@ class BinPacking2D:
         return not (x2 <= x3 or x4 <= x1 or y2 <= y3 or y4 <= y1)
 
 
+class TruckLoader3D(BinPacking2D):
+    """3Dトラック積載（荷台の高さを使った段積み）
+    
+    荷台を1つの Pallet として扱い、PalletOptimizer のエクストリームポイントと
+    衝突・支持判定で配置する。床面から埋め、床に置けない荷物は段積み可（Box.stackable）の
+    荷物の上に、直下の荷物より重くない場合のみ max_layers 段まで積む。
+    door_access の場合は奥から積むため、低い位置より奥の位置を優先する（奥・低い・左の順）。
+    pack / try_add / commit / rollback は BinPacking2D と同じ
+    """
+    
+    def __init__(self, truck_width: int, truck_depth: int, truck_height: int, payload: float,
+                 max_layers: int = 2, layer_weight_limit: float = None, door_access: bool = False):
+        """
+        Args:
+            max_layers: 段数の上限
+            layer_weight_limit: 2段目以上の各段に積める総重量(kg)。Noneの場合は制限なし
+            door_access: BinPacking2D と同じ
+        """
+        if max_layers < 1:
+            raise ValueError(f"段数の上限は1以上を指定してください: {max_layers}")
+        
+        super().__init__(truck_width, truck_depth, door_access=door_access)
+        self.truck_height = truck_height
+        self.max_layers = max_layers
+        self.layer_weight_limit = layer_weight_limit
+        
+        config = PalletConfiguration(width=truck_width, depth=truck_depth,
+                                     max_height=truck_height, max_weight=payload)
+        self.optimizer = PalletOptimizer(config, placement_strategy='extreme_point')
+        self.bed = Pallet.from_config(config)
+        # bed の占有範囲と同じ順の、荷物の重量と段
+        self.extent_weights = []
+        self.extent_layers = []
+        self.layer_weights = {}  # 段 → 総重量
+        # 仮配置の取り消し用に、配置で書き換えた高さマップの範囲と書き換え前の値（配置した順）
+        self.undo_log = []
+    
+    def commit(self, checkpoint: PackingCheckpoint):
+        super().commit(checkpoint)
+        if not self.checkpoints:
+            self.undo_log.clear()
+    
+    def _snapshot(self):
+        # 荷台全体は複製せず、取り消しは undo_log の範囲のみ書き戻す
+        bed = self.bed
+        return (
+            len(self.undo_log), len(bed.boxes), bed.total_weight, bed.used_volume, bed.box_count,
+            bed.current_height, bed.extent_count, bed.extreme_points,
+            len(self.extent_weights), dict(self.layer_weights),
+        )
+    
+    def _restore(self, state):
+        bed = self.bed
+        (undo_count, box_count, bed.total_weight, bed.used_volume, bed.box_count,
+         bed.current_height, bed.extent_count, bed.extreme_points,
+         extent_count, self.layer_weights) = state
+        while len(self.undo_log) > undo_count:
+            rows, cols, heights, gaps = self.undo_log.pop()
+            bed.height_map[rows, cols] = heights
+            bed.gap_map[rows, cols] = gaps
+        del bed.boxes[box_count:]
+        del self.extent_weights[extent_count:]
+        del self.extent_layers[extent_count:]
+    
+    def _find_position(self, item: Box) -> Optional[Position]:
+        """低い・奥・左の順（door_access の場合は奥・低い・左の順）に、段積みの条件を満たす位置を探す"""
+        if self.bed.total_weight + item.weight * item.quantity > self.bed.max_weight:
+            return None
+        
+        order = self._position_order
+        candidates = np.array(sorted(self.bed.extreme_points, key=order), dtype=np.int32).reshape(-1, 3)
+        
+        best = None
+        for width, depth, rotation in ((item.width, item.depth, 0), (item.depth, item.width, 90)):
+            if rotation and width == depth:
+                continue
+            oriented = replace(item, width=width, depth=depth)
+            feasible = self.optimizer._can_place_batch(self.bed, oriented, candidates)
+            for x, y, z in candidates[feasible].tolist():
+                if self.door_access and self._behind_placed(x, y, width, depth):
+                    continue
+                layer = self._stacking_layer(oriented, x, y, z)
+                if layer is None:
+                    continue
+                if best is None or order((x, y, z)) < order((best.x, best.y, best.z)):
+                    best = Position(x, y, width, depth, rotation, z, layer)
+                break
+        
+        return best
+    
+    def _position_order(self, point: Tuple[int, int, int]) -> Tuple[int, int, int]:
+        """配置位置の優先順（小さいほど優先）"""
+        x, y, z = point
+        return (y, z, x) if self.door_access else (z, y, x)
+    
+    def _stacking_layer(self, item: Box, x: int, y: int, z: int) -> Optional[int]:
+        """(x, y, z) に置いた場合の段。段積みの条件を満たさなければNone"""
+        if z == 0:
+            return 1
+        
+        extents = self.bed.placed_extents()
+        below = np.flatnonzero(
+            (extents['z2'] == z) &
+            (extents['x1'] < x + item.width) & (x < extents['x2']) &
+            (extents['y1'] < y + item.depth) & (y < extents['y2'])
+        )
+        if len(below) == 0:
+            return None
+        
+        layer = 1 + max(self.extent_layers[i] for i in below)
+        weight = item.weight * item.quantity
+        if layer > self.max_layers:
+            return None
+        # 重いものを下に
+        if weight > min(self.extent_weights[i] for i in below):
+            return None
+        if self.layer_weight_limit is not None and self.layer_weights.get(layer, 0) + weight > self.layer_weight_limit:
+            return None
+        return layer
+    
+    def _place(self, item: Box, position: Position):
+        """荷台に配置し、段積み不可の荷物は上の空間もふさぐ"""
+        placed = replace(item, x=position.x, y=position.y, z=position.z,
+                         width=position.width, depth=position.depth)
+        self.bed.add_box(placed)
+        if not item.stackable:
+            placed = replace(placed, height=self.truck_height - placed.z)
+        rows = slice(placed.y, placed.y + placed.depth)
+        cols = slice(placed.x, placed.x + placed.width)
+        self.undo_log.append((rows, cols, self.bed.height_map[rows, cols].copy(), self.bed.gap_map[rows, cols].copy()))
+        self.optimizer._occupy(self.bed, placed)
+        
+        weight = item.weight * item.quantity
+        self.extent_weights.append(weight)
+        self.extent_layers.append(position.layer)
+        self.layer_weights[position.layer] = self.layer_weights.get(position.layer, 0) + weight
+
+
 class RouteOptimizer:
-    """配送ルート最適化（Nearest Neighbor）"""
+    """配送ルート最適化（Nearest Neighbor + 2-opt / Or-opt）
+    
+    配送拠点（depot）を出発し、全配送先を回って配送拠点に戻る巡回路を作る
+    """
     
-    def __init__(self):
+    EARTH_RADIUS_KM = 6371  # 地球の半径（km）
+    
+    # 局所探索で近傍として調べる、各地点から近い地点の数
+    NEIGHBOR_COUNT = 10
+    # Or-opt で移動する区間の最大の長さ
+    OR_OPT_MAX_SEGMENT = 3
+    
+    def __init__(self, dtype=np.float64, time_budget_ms: int = 200):
+        """
+        Args:
+            dtype: 距離行列の型。np.float32 の場合はメモリ・計算量が半分になる（誤差は数m程度）
+            time_budget_ms: 2-opt / Or-opt による改善の処理時間の上限(ms)。0の場合は最近傍法のみ
+        """
         self.depot = (35.6762, 139.6503)  # 東京駅を配送拠点とする
+        self.dtype = np.dtype(dtype)
+        self.time_budget_ms = time_budget_ms
     
-    def optimize_route(self, destinations: List[Tuple[float, float]]) -> List[int]:
-        """最近傍法でルートを最適化"""
+    def optimize_route(self, destinations: List[Tuple[float, float]], distances: np.ndarray = None) -> List[int]:
+        """配送拠点から出発・帰着するルートを最適化し、配送先の訪問順を返す
+        
+        最近傍法で初期解を作り、time_budget_ms の範囲で 2-opt / Or-opt により改善する
+        
+        Args:
+            destinations: 配送先の(緯度, 経度)
+            distances: 配送先間の計算済みの距離行列（DistanceCache.matrix など）。Noneの場合は計算する
+        """
         if not destinations:
             return []
         
-        n = len(destinations)
-        visited = [False] * n
-        route = []
-        current = 0  # 最初の配送先から開始
+        # 地点0を配送拠点、地点 i + 1 を配送先 i とした距離行列と空間インデックス
+        matrix = self._depot_distance_matrix(destinations, distances)
+        index = DestinationIndex([self.depot] + list(destinations))
+        tour = self._nearest_neighbor_tour(matrix, index)
+        if self.time_budget_ms and len(tour) > 3:
+            tour = self._improve_tour(tour, matrix, time.perf_counter() + self.time_budget_ms / 1000, index)
+        
+        # 配送拠点を先頭にして配送先の番号に戻す
+        start = tour.index(0)
+        tour = tour[start:] + tour[:start]
+        return [node - 1 for node in tour[1:]]
+    
+    def route_length(self, route: List[int], distances: np.ndarray) -> float:
+        """配送拠点から route の順に回って戻る距離（km）。distances は _depot_distance_matrix の行列"""
+        nodes = [0] + [index + 1 for index in route] + [0]
+        return float(sum(distances[a, b] for a, b in zip(nodes, nodes[1:])))
+    
+    def _depot_distance_matrix(self, destinations: List[Tuple[float, float]],
+                               distances: np.ndarray = None) -> np.ndarray:
+        """配送拠点を地点0として加えた距離行列"""
+        if distances is None:
+            return self._calculate_distance_matrix([self.depot] + list(destinations))
         
-        # 距離行列を計算
-        distances = self._calculate_distance_matrix(destinations)
+        n = len(destinations)
+        matrix = np.zeros((n + 1, n + 1), dtype=self.dtype)
+        matrix[1:, 1:] = distances
+        coords = np.radians(np.asarray(destinations, dtype=self.dtype).reshape(-1, 2))
+        depot = np.radians(np.asarray(self.depot, dtype=self.dtype))
+        matrix[0, 1:] = matrix[1:, 0] = self._haversine_arrays(depot[0], depot[1], coords[:, 0], coords[:, 1])
+        return matrix
+    
+    def _nearest_neighbor_tour(self, distances: np.ndarray, index: DestinationIndex = None) -> List[int]:
+        """配送拠点（地点0）からの最近傍法による巡回路
         
-        route.append(current)
+        index を指定した場合は未訪問の最も近い地点を空間インデックスで探す（全地点の走査を省く）
+        """
+        n = len(distances)
+        visited = np.zeros(n, dtype=bool)
+        current = 0
+        tour = [current]
         visited[current] = True
         
         for _ in range(n - 1):
-            nearest = -1
-            min_distance = float('inf')
-            
-            for i in range(n):
-                if not visited[i] and distances[current][i] < min_distance:
-                    min_distance = distances[current][i]
-                    nearest = i
-            
-            if nearest != -1:
-                route.append(nearest)
-                visited[nearest] = True
-                current = nearest
+            if index is not None:
+                nearest = index.nearest_unvisited(current, visited)
+            else:
+                # 未訪問の地点のうち最も近いもの（同距離なら番号の小さい方）
+                nearest = int(np.argmin(np.where(visited, np.inf, distances[current])))
+            tour.append(nearest)
+            visited[nearest] = True
+            current = nearest
         
-        return route
+        return tour
     
-    def _calculate_distance_matrix(self, destinations: List[Tuple[float, float]]) -> List[List[float]]:
-        """距離行列を計算（ハーバサイン距離）"""
-        n = len(destinations)
-        distances = [[0.0] * n for _ in range(n)]
+    def _improve_tour(self, tour: List[int], distances: np.ndarray, deadline: float,
+                      index: DestinationIndex = None) -> List[int]:
+        """2-opt と Or-opt で巡回路を改善（近傍リスト + don't-look bits）
         
-        for i in range(n):
-            for j in range(n):
-                if i != j:
-                    distances[i][j] = self._haversine_distance(
-                        destinations[i], destinations[j]
-                    )
+        改善のあった地点の周辺のみを再び調べ、改善がなくなるか期限になったら終了。
+        近傍リストは index を指定した場合は空間インデックスから、なければ距離行列から作る
+        """
+        n = len(tour)
+        dist = distances.tolist()
+        neighbor_count = min(self.NEIGHBOR_COUNT, n - 1)
+        if index is not None:
+            nearest = index.neighbors(neighbor_count)
+        else:
+            nearest = np.argpartition(distances + np.diag(np.full(n, np.inf)), neighbor_count - 1, axis=1)
+            nearest = [row[:neighbor_count].tolist() for row in nearest]
+        neighbors = [
+            sorted(row, key=lambda other, a=a: dist[a][other])
+            for a, row in enumerate(nearest)
+        ]
+        
+        position = [0] * n
+        for index, node in enumerate(tour):
+            position[node] = index
         
+        # don't-look bits が立っていない（調べる必要のある）地点
+        active = list(tour)
+        is_active = [True] * n
+        
+        while active:
+            if time.perf_counter() > deadline:
+                break
+            a = active.pop()
+            is_active[a] = False
+            
+            touched = (self._try_two_opt(tour, position, dist, neighbors, a)
+                       or self._try_or_opt(tour, position, dist, neighbors, a))
+            if touched:
+                for node in touched:
+                    if not is_active[node]:
+                        is_active[node] = True
+                        active.append(node)
+        
+        return tour
+    
+    def _try_two_opt(self, tour: List[int], position: List[int], dist: List[List[float]],
+                     neighbors: List[List[int]], a: int) -> Optional[Tuple[int, ...]]:
+        """地点 a に接する辺を、近傍の地点への辺に付け替える 2-opt。改善した場合は関係する地点を返す"""
+        n = len(tour)
+        i = position[a]
+        for direction in (1, -1):
+            b = tour[(i + direction) % n]
+            d_ab = dist[a][b]
+            for c in neighbors[a]:
+                d_ac = dist[a][c]
+                if d_ac >= d_ab:
+                    break
+                j = position[c]
+                d = tour[(j + direction) % n]
+                if c == b or d == a:
+                    continue
+                delta = d_ac + dist[b][d] - d_ab - dist[c][d]
+                if delta < -1e-9:
+                    # 後続方向: a の次から c まで、先行方向: a から c の前までを反転
+                    if direction == 1:
+                        start, end = (i + 1, j) if i < j else (j + 1, i)
+                    else:
+                        start, end = (i, j - 1) if i < j else (j, i - 1)
+                    self._reverse(tour, position, start, end)
+                    return (a, b, c, d)
+        return None
+    
+    def _try_or_opt(self, tour: List[int], position: List[int], dist: List[List[float]],
+                    neighbors: List[List[int]], a: int) -> Optional[Tuple[int, ...]]:
+        """a から始まる短い区間を、近傍の地点の隣へ（必要なら反転して）移す Or-opt"""
+        n = len(tour)
+        i = position[a]
+        for length in range(1, min(self.OR_OPT_MAX_SEGMENT, n - 3) + 1):
+            if i + length > n:
+                break
+            segment = tour[i:i + length]
+            first, last = segment[0], segment[-1]
+            prev, following = tour[i - 1], tour[(i + length) % n]
+            removal_gain = dist[prev][first] + dist[last][following] - dist[prev][following]
+            if removal_gain <= 1e-9:
+                continue
+            
+            for c in neighbors[a]:
+                if c in segment:
+                    continue
+                j = position[c]
+                for e in (tour[(j + 1) % n], tour[j - 1]):
+                    if e in segment:
+                        continue
+                    # c の隣に first が来る向き（c - first ... last - e）で挿入
+                    insertion_cost = dist[c][first] + dist[last][e] - dist[c][e]
+                    if insertion_cost - removal_gain < -1e-9:
+                        self._move_segment(tour, position, i, length, c, e)
+                        return (prev, following, first, last, c, e)
+        return None
+    
+    def _reverse(self, tour: List[int], position: List[int], start: int, end: int):
+        """tour[start..end] を反転"""
+        tour[start:end + 1] = tour[start:end + 1][::-1]
+        for index in range(start, end + 1):
+            position[tour[index]] = index
+    
+    def _move_segment(self, tour: List[int], position: List[int], start: int, length: int, c: int, e: int):
+        """tour[start:start + length] を取り出し、c の隣（e との間）に first が c 側になるよう挿入"""
+        segment = tour[start:start + length]
+        del tour[start:start + length]
+        c_index = tour.index(c)
+        if tour[(c_index + 1) % len(tour)] == e:
+            tour[c_index + 1:c_index + 1] = segment
+        else:
+            tour[c_index:c_index] = segment[::-1]
+        for index, node in enumerate(tour):
+            position[node] = index
+    
+    def _calculate_distance_matrix(self, destinations: List[Tuple[float, float]]) -> np.ndarray:
+        """距離行列を計算（ハーバサイン距離, km）
+        
+        対称行列なので上三角（i < j）の組のみ計算して両側に書き込む
+        """
+        coords = np.radians(np.asarray(destinations, dtype=self.dtype).reshape(-1, 2))
+        n = len(coords)
+        distances = np.zeros((n, n), dtype=self.dtype)
+        if n < 2:
+            return distances
+        
+        i, j = np.triu_indices(n, k=1)
+        upper = self._haversine_arrays(coords[i, 0], coords[i, 1], coords[j, 0], coords[j, 1])
+        distances[i, j] = upper
+        distances[j, i] = upper
         return distances
     
+    def _haversine_arrays(self, lat1, lon1, lat2, lon2) -> np.ndarray:
+        """ハーバサイン距離（km）を配列でまとめて計算（座標はラジアン）"""
+        a = (np.sin((lat2 - lat1) / 2) ** 2 +
+             np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+        return 2 * self.EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    
     def _haversine_distance(self, coord1: Tuple[float, float], 
                            coord2: Tuple[float, float]) -> float:
         """ハーバサイン距離計算（km）"""
         lat1, lon1 = coord1
         lat2, lon2 = coord2
         
-        R = 6371  # 地球の半径（km）
+        R = self.EARTH_RADIUS_KM
         
         dlat = math.radians(lat2 - lat1)
         dlon = math.radians(lon2 - lon1)
@@ -372,20 +1482,140 @@ class RouteOptimizer:
         return R * c
 
 
+class SavingsVRPSolver:
+    """容量制約付き配送ルート計画（Clarke–Wright 節約法）
+    
+    配送先ごとに1台で往復するルートから始め、節約量
+    s(i, j) = d(拠点, i) + d(拠点, j) - d(i, j) の大きい組から順に、
+    合算した積荷がいずれかのトラックに収まる場合にルートの端同士をつなぐ
+    """
+    
+    # 荷台面積のうちパレットを並べられるとみなす割合（隙間の分を差し引く）
+    FLOOR_FILL_RATE = 0.8
+    
+    def __init__(self, route_optimizer: RouteOptimizer = None):
+        self.route_optimizer = route_optimizer or RouteOptimizer()
+    
+    def solve(self, destinations: List[Tuple[float, float]], demands: List[Tuple[float, float]],
+              trucks: List[Tuple[float, float]], distances: np.ndarray = None) -> List[List[int]]:
+        """配送先をトラック1台分ずつのルートに分ける
+        
+        Args:
+            destinations: 配送先の(緯度, 経度)
+            demands: 配送先ごとの積荷の(重量kg, 床面積cm²)
+            trucks: 使用できるトラックの(最大積載量kg, 荷台面積cm²)。同じ車種は何台でも使えるものとする
+            distances: 配送先間の計算済みの距離行列。Noneの場合は計算する
+        
+        Returns:
+            ルートごとの配送先のインデックス（配送拠点から近い端を先頭）
+        """
+        n = len(destinations)
+        if n == 0:
+            return []
+        
+        capacities = [(payload, area * self.FLOOR_FILL_RATE) for payload, area in trucks]
+        matrix = self.route_optimizer._depot_distance_matrix(destinations, distances)
+        
+        # 各配送先を1本のルートとして開始
+        routes = {i: [i] for i in range(n)}
+        route_of = list(range(n))
+        loads = {i: demands[i] for i in range(n)}
+        
+        for i, j in self._savings_order(matrix):
+            ri, rj = route_of[i], route_of[j]
+            if ri == rj:
+                continue
+            route_i, route_j = routes[ri], routes[rj]
+            # ルートの途中の配送先はつなげない
+            if i not in (route_i[0], route_i[-1]) or j not in (route_j[0], route_j[-1]):
+                continue
+            
+            weight = loads[ri][0] + loads[rj][0]
+            area = loads[ri][1] + loads[rj][1]
+            if not any(weight <= payload and area <= floor for payload, floor in capacities):
+                continue
+            
+            # ... i → j ... となる向きにそろえて連結
+            if route_i[-1] != i:
+                route_i.reverse()
+            if route_j[0] != j:
+                route_j.reverse()
+            route_i.extend(route_j)
+            for node in route_j:
+                route_of[node] = ri
+            loads[ri] = (weight, area)
+            del routes[rj], loads[rj]
+        
+        result = []
+        for route in routes.values():
+            if matrix[0, route[-1] + 1] < matrix[0, route[0] + 1]:
+                route.reverse()
+            result.append(route)
+        return result
+    
+    def _savings_order(self, matrix: np.ndarray):
+        """節約量が正の配送先の組 (i, j) を節約量の大きい順に返す（i, j は配送先のインデックス）"""
+        from_depot = matrix[0, 1:]
+        savings = from_depot[:, None] + from_depot[None, :] - matrix[1:, 1:]
+        i, j = np.triu_indices(len(from_depot), k=1)
+        values = savings[i, j]
+        positive = values > 0
+        
+        heap = list(zip((-values[positive]).tolist(), i[positive].tolist(), j[positive].tolist()))
+        heapq.heapify(heap)
+        while heap:
+            _, i, j = heapq.heappop(heap)
+            yield i, j
+
+
 class DeliveryOptimizer:
     """配送最適化メインクラス"""
     
-    def __init__(self):
-        self.pallet_optimizer = PalletOptimizer()
+    # 座標のない配送先への移動時間（分）
+    UNLOCATED_TRAVEL_MINUTES = 20
+    
+    # 出荷依頼をトラックに割り当てる単位の決め方
+    #   region: 住所の都道府県・区部ごと
+    #   savings: 座標と積荷から節約法（SavingsVRPSolver）で作るルートごと
+    #   kmeans: 座標の k-means 法によるクラスタごと
+    #   dbscan: 座標の DBSCAN によるクラスタごと
+    ROUTINGS = ('region', 'savings', 'kmeans', 'dbscan')
+    
+    def __init__(self, speed_profile: Optional[Dict[int, float]] = None, service_minutes: Optional[int] = None,
+                 routing: Optional[str] = None):
+        """
+        Args:
+            speed_profile: 時間帯ごとの平均走行速度(km/h)。キーは適用開始時刻（時）。
+                Noneの場合は settings.DELIVERY_SPEED_PROFILE
+            service_minutes: 配送先1件あたりの荷降ろし時間（分）。Noneの場合は settings.DELIVERY_SERVICE_MINUTES
+            routing: 統一パレット最適化での出荷依頼のまとめ方（ROUTINGS）。Noneの場合は settings.DELIVERY_ROUTING
+        """
+        self.routing = routing or settings.DELIVERY_ROUTING
+        if self.routing not in self.ROUTINGS:
+            raise ValueError(f"未対応の配送ルートの決め方です: {self.routing}")
+        self.pallet_optimizer = PalletOptimizer(placement_strategy='extreme_point', allow_rotation=True)
         self.route_optimizer = RouteOptimizer()
+        self.distance_cache = DistanceCache(self.route_optimizer)
+        self.speed_profile = speed_profile or settings.DELIVERY_SPEED_PROFILE
+        # 作成した配送計画は最適化の最後にまとめて保存する
+        self.plan_writer = PlanWriter()
+        # 品目コード → 製品（最適化の開始時にまとめて取得）
+        self.items_by_code = {}
+        self.service_minutes = settings.DELIVERY_SERVICE_MINUTES if service_minutes is None else service_minutes
     
-    def optimize_with_unified_pallets(self, orders: List[ShippingOrder], target_date) -> List[DeliveryPlan]:
-        """統一パレットシステムを使用した配送最適化"""
+    def optimize_with_unified_pallets(self, orders: List[ShippingOrder], target_date,
+                                      progress=None) -> List[DeliveryPlan]:
+        """統一パレットシステムを使用した配送最適化
+        
+        Args:
+            progress: 進捗の通知先 progress(進捗(%), メッセージ)。地域（配送ルート）ごとに呼ばれる
+        """
         plans = []
         
         print(f"=== 統一パレット最適化開始 ===")
         print(f"注文数: {len(orders)}")
         
+        self.plan_writer = PlanWriter()
         try:
             with transaction.atomic():
                 # 1. 利用可能なUnifiedPalletを取得
@@ -397,13 +1627,20 @@ class DeliveryOptimizer:
                     print("利用可能なパレットがありません。処理を終了します。")
                     return plans
                 
-                # 2. 注文を地域別にグループ化
-                grouped_orders = self._group_orders_by_region(orders)
+                # 2. 注文を地域別（または配送ルート別）にグループ化
+                if self.routing == 'savings':
+                    grouped_orders = self._group_orders_by_savings(orders, available_pallets)
+                elif self.routing in ('kmeans', 'dbscan'):
+                    grouped_orders = self._group_orders_by_cluster(orders, available_pallets)
+                else:
+                    grouped_orders = self._group_orders_by_region(orders)
                 
                 # 3. 各地域に対してパレットを割り当て
                 print(f"地域数: {len(grouped_orders)}")
-                for region, region_orders in grouped_orders.items():
+                for done, (region, region_orders) in enumerate(grouped_orders.items()):
                     print(f"=== 地域 {region} の処理開始 (注文数: {len(region_orders)}) ===")
+                    if progress:
+                        progress(10 + 85 * done // len(grouped_orders), f"{region} のトラック積載を計画しています")
                     
                     region_pallets = self._allocate_pallets_for_region(
                         region_orders, available_pallets
@@ -429,6 +1666,9 @@ class DeliveryOptimizer:
                     else:
                         print(f"警告: 地域 {region} でトラック積載に失敗")
                 
+                # 5. 配送計画をまとめて保存
+                self.plan_writer.flush()
+                
         except Exception as e:
             print(f"統一パレット最適化エラー: {e}")
             import traceback
@@ -441,10 +1681,14 @@ class DeliveryOptimizer:
         """配送最適化を実行"""
         plans = []
         
+        self.plan_writer = PlanWriter()
         try:
             with transaction.atomic():
                 # 1. 全体のパレタイズ設計結果を一度だけ取得
                 all_pallets, all_loose_items = self._get_or_create_palletize_result(orders, target_date)
+                item_codes = {box.item_code for pallet in all_pallets for box in pallet.boxes}
+                item_codes.update(box.item_code for box in all_loose_items)
+                self.items_by_code = Item.objects.in_bulk(item_codes, field_name='item_code')
                 
                 # 2. 注文を地域別にグループ化
                 grouped_orders = self._group_orders_by_region(orders)
@@ -473,6 +1717,9 @@ class DeliveryOptimizer:
                     
                     plans.extend(truck_plans)
                 
+                # 5. 配送計画をまとめて保存
+                self.plan_writer.flush()
+                
         except Exception as e:
             print(f"最適化エラー: {e}")
             import traceback
@@ -559,6 +1806,97 @@ class DeliveryOptimizer:
         
         return groups
     
+    def _group_orders_by_savings(self, orders: List[ShippingOrder],
+                                 pallets: List['UnifiedPallet']) -> Dict[str, List[ShippingOrder]]:
+        """注文を節約法で作った配送ルート別にグループ化（座標のない配送先はまとめて最後）"""
+        trucks = [
+            (truck.payload, truck.floor_area)
+            for truck in Truck.objects.filter(width__gt=0, depth__gt=0)
+        ]
+        order_pallet_groups = self._group_pallets_by_order(pallets)
+        
+        located = [
+            order for order in orders
+            if order.destination.latitude and order.destination.longitude and order.id in order_pallet_groups
+        ]
+        located_ids = {order.id for order in located}
+        unlocated = [order for order in orders if order.id not in located_ids]
+        
+        print(f"=== 配送ルート作成開始 (注文数: {len(located)}, 座標なし: {len(unlocated)}) ===")
+        
+        groups = {}
+        if located and trucks:
+            demands = []
+            for order in located:
+                group_pallets = order_pallet_groups[order.id]
+                demands.append((
+                    sum(pallet.weight for pallet in group_pallets),
+                    sum(pallet.width * pallet.depth for pallet in group_pallets)
+                ))
+            destinations = [
+                (float(order.destination.latitude), float(order.destination.longitude))
+                for order in located
+            ]
+            distances = self.distance_cache.matrix([order.destination for order in located])
+            routes = SavingsVRPSolver(self.route_optimizer).solve(destinations, demands, trucks, distances)
+            for i, route in enumerate(routes):
+                groups[f'ルート{i + 1}'] = [located[index] for index in route]
+        else:
+            unlocated = orders
+        
+        if unlocated:
+            groups['座標なし'] = unlocated
+        
+        for name, route_orders in groups.items():
+            print(f"{name}: {len(route_orders)}件")
+        
+        return groups
+    
+    def _group_orders_by_cluster(self, orders: List[ShippingOrder],
+                                 pallets: List['UnifiedPallet']) -> Dict[str, List[ShippingOrder]]:
+        """注文を配送先の座標のクラスタ別にグループ化（座標のない配送先はまとめて最後）
+        
+        kmeans のクラスタ数は settings.DELIVERY_CLUSTER_COUNT（0の場合はパレット総重量を
+        最大積載量で割った台数）、dbscan の近傍距離は settings.DELIVERY_CLUSTER_RADIUS_KM。
+        DBSCAN でどのクラスタにも属さない配送先は、トラックを1台ずつ使わないよう
+        最も近いクラスタに含める
+        """
+        located = [order for order in orders if order.destination.latitude and order.destination.longitude]
+        located_ids = {order.id for order in located}
+        unlocated = [order for order in orders if order.id not in located_ids]
+        
+        groups = {}
+        if located:
+            # 今回の最適化で使う空間インデックス
+            index = DestinationIndex([
+                (float(order.destination.latitude), float(order.destination.longitude))
+                for order in located
+            ])
+            if self.routing == 'kmeans':
+                clusters = settings.DELIVERY_CLUSTER_COUNT or self._estimate_truck_count(pallets)
+                labels = index.kmeans(clusters)
+            else:
+                labels = index.attach_noise(index.dbscan(settings.DELIVERY_CLUSTER_RADIUS_KM))
+            
+            print(f"=== クラスタリング開始 ({self.routing}, 注文数: {len(located)}) ===")
+            for order, label in zip(located, labels.tolist()):
+                groups.setdefault(f'クラスタ{label + 1}', []).append(order)
+        
+        if unlocated:
+            groups['座標なし'] = unlocated
+        
+        for name, cluster_orders in groups.items():
+            print(f"{name}: {len(cluster_orders)}件")
+        
+        return groups
+    
+    def _estimate_truck_count(self, pallets: List['UnifiedPallet']) -> int:
+        """パレットの総重量を最大のトラックで運ぶ場合の台数"""
+        payload = Truck.objects.filter(width__gt=0, depth__gt=0).aggregate(models.Max('payload'))['payload__max']
+        if not payload:
+            return 1
+        return max(1, math.ceil(sum(pallet.weight for pallet in pallets) / payload))
+    
     def _extract_region(self, address: str) -> str:
         """住所から地域を抽出"""
         # 簡易的な実装：最初の市区町村を抽出
@@ -593,7 +1931,6 @@ class DeliveryOptimizer:
             # パレットを復元
             for pallet_detail in palletize_plan.pallets.all():
                 pallet = Pallet()
-                pallet.current_height = 0
                 
                 # パレット内の商品を復元
                 for pallet_item in pallet_detail.items.all():
@@ -617,13 +1954,13 @@ class DeliveryOptimizer:
                         weight=pallet_item.weight,
                         item_code=item_code,
                         quantity=1,
-                        shipping_order_id=shipping_order_id
+                        shipping_order_id=shipping_order_id,
+                        rotation=pallet_item.rotation
                     )
                     box.x = pallet_item.position_x
                     box.y = pallet_item.position_y
                     box.z = pallet_item.position_z
-                    pallet.boxes.append(box)
-                    pallet.current_height = max(pallet.current_height, box.z + box.height)
+                    pallet.add_box(box)
                 
                 pallets.append(pallet)
             
@@ -663,23 +2000,22 @@ class DeliveryOptimizer:
         """注文商品をパレタイズ"""
         all_boxes = []
         
-        # 注文から箱リストを作成（個別の商品単位で）
+        # 注文から箱リストを作成（出荷商品ごとに数量をまとめて渡し、パレタイズ時に1個単位へ展開）
         for order in orders:
             for order_item in order.order_items.all():
                 item = order_item.item
                 if item.width and item.depth and item.height and item.weight:
-                    # 各商品を個別の箱として作成（quantityの数だけ）
-                    for _ in range(order_item.quantity):
-                        box = Box(
-                            width=item.width,
-                            depth=item.depth,
-                            height=item.height,
-                            weight=item.weight,
-                            item_code=item.item_code,
-                            quantity=1,  # 各箱は個別に扱う
-                            shipping_order_id=order.id  # 出荷依頼IDを設定
-                        )
-                        all_boxes.append(box)
+                    box = Box(
+                        width=item.width,
+                        depth=item.depth,
+                        height=item.height,
+                        weight=item.weight,
+                        item_code=item.item_code,
+                        quantity=order_item.quantity,
+                        shipping_order_id=order.id,  # 出荷依頼IDを設定
+                        this_side_up=item.this_side_up
+                    )
+                    all_boxes.append(box)
                 else:
                     print(f"警告: 商品 {item.name} ({item.item_code}) に寸法または重量が設定されていません")
         
@@ -839,18 +2175,7 @@ class DeliveryOptimizer:
         """配送計画を作成"""
         
         # 配送ルートを最適化
-        destinations = []
-        for order in orders:
-            if order.destination.latitude and order.destination.longitude:
-                destinations.append((
-                    float(order.destination.latitude), 
-                    float(order.destination.longitude)
-                ))
-        
-        if destinations:
-            route_indices = self.route_optimizer.optimize_route(destinations)
-        else:
-            route_indices = list(range(len(orders)))
+        stops = self._plan_stops(orders)
         
         # 重量・体積計算
         total_weight = sum(item.weight * item.quantity for item in items)
@@ -858,34 +2183,23 @@ class DeliveryOptimizer:
         
         # 出発時刻計算（配送時間を逆算）
         departure_time = datetime.combine(target_date, datetime.min.time().replace(hour=8))
+        route_distance_km, schedule = self._route_schedule(stops, departure_time)
         
-        # 配送計画作成
-        plan = DeliveryPlan.objects.create(
+        # 配送計画作成（保存は最適化の最後に plan_writer でまとめて行う）
+        plan = self.plan_writer.add_plan(DeliveryPlan(
             plan_date=target_date,
             truck=truck,
             departure_time=departure_time,
             total_weight=total_weight,
             total_volume=total_volume,
-            route_distance_km=0  # 後で計算
-        )
+            route_distance_km=route_distance_km
+        ))
         
         # 配送順序の作成
-        current_time = departure_time
-        for i, order_idx in enumerate(route_indices):
-            if order_idx < len(orders):
-                order = orders[order_idx]
-                travel_time = 30 if i == 0 else 20  # 分
-                current_time += timedelta(minutes=travel_time)
-                
-                PlanOrderDetail.objects.create(
-                    plan=plan,
-                    shipping_order=order,
-                    delivery_sequence=i + 1,
-                    estimated_arrival=current_time,
-                    travel_time_minutes=travel_time
-                )
+        self._create_order_details(plan, schedule)
         
         # 積載商品の記録（パレットとバラ積みを区別）
+        item_loads = []
         pallet_index = 0
         for i, (item, position) in enumerate(zip(items, positions)):
             if item.item_code == 'PALLET':
@@ -893,40 +2207,39 @@ class DeliveryOptimizer:
                 if truck_pallets and pallet_index < len(truck_pallets):
                     pallet = truck_pallets[pallet_index]
                     for box in pallet.boxes:
-                        try:
-                            item_obj = Item.objects.get(item_code=box.item_code)
-                            # パレット内の商品を適切な出荷依頼に関連付け
-                            related_order = self._find_related_order(orders, item_obj)
-                            if related_order:
-                                PlanItemLoad.objects.create(
-                                    plan=plan,
-                                    shipping_order=related_order,
-                                    item=item_obj,
-                                    quantity=1,
-                                    position_x=position.x + box.x,  # パレット内の相対位置を加算
-                                    position_y=position.y + box.y,
-                                    rotation=position.rotation
-                                )
-                        except Item.DoesNotExist:
-                            pass
+                        item_obj = self.items_by_code.get(box.item_code)
+                        if item_obj is None:
+                            continue
+                        # パレット内の商品を適切な出荷依頼に関連付け
+                        related_order = self._find_related_order(orders, item_obj)
+                        if related_order:
+                            item_loads.append(PlanItemLoad(
+                                plan=plan,
+                                shipping_order=related_order,
+                                item=item_obj,
+                                quantity=1,
+                                position_x=position.x + box.x,  # パレット内の相対位置を加算
+                                position_y=position.y + box.y,
+                                rotation=position.rotation
+                            ))
                     pallet_index += 1
             else:
                 # バラ積み商品の場合
-                try:
-                    item_obj = Item.objects.get(item_code=item.item_code)
-                    related_order = self._find_related_order(orders, item_obj)
-                    if related_order:
-                        PlanItemLoad.objects.create(
-                            plan=plan,
-                            shipping_order=related_order,
-                            item=item_obj,
-                            quantity=item.quantity,
-                            position_x=position.x,
-                            position_y=position.y,
-                            rotation=position.rotation
-                        )
-                except Item.DoesNotExist:
-                    pass
+                item_obj = self.items_by_code.get(item.item_code)
+                if item_obj is None:
+                    continue
+                related_order = self._find_related_order(orders, item_obj)
+                if related_order:
+                    item_loads.append(PlanItemLoad(
+                        plan=plan,
+                        shipping_order=related_order,
+                        item=item_obj,
+                        quantity=item.quantity,
+                        position_x=position.x,
+                        position_y=position.y,
+                        rotation=position.rotation
+                    ))
+        self.plan_writer.add(item_loads)
         
         return plan
     
@@ -937,7 +2250,7 @@ class DeliveryOptimizer:
                 if order_item.item == item:
                     return order
                 # セット品の場合は部品も確認
-                if order_item.item.parts.filter(parts_code=item.item_code).exists():
+                if any(part.parts_code == item.item_code for part in order_item.item.parts.all()):
                     return order
         return orders[0] if orders else None
     
@@ -1005,21 +2318,29 @@ class DeliveryOptimizer:
         return []
     
     def _create_unified_pallets_from_palletize_plan(self, palletize_plan: 'PalletizePlan', orders: List[ShippingOrder]) -> List['UnifiedPallet']:
-        """パレタイズ設計からUnifiedPalletを作成"""
+        """パレタイズ設計からUnifiedPalletを作成（パレット・関連注文はまとめて保存）"""
         created_pallets = []
+        writer = BulkWriter()
         
         try:
             # パレット設定を取得
             pallet_config = PalletConfiguration.get_default()
             
+            # パレット詳細ごとの積載商品（登録順）とバラ積み商品をまとめて取得
+            pallet_details = list(palletize_plan.pallets.prefetch_related(
+                Prefetch('items', queryset=PalletItem.objects.select_related('shipping_order', 'item').order_by('id'))
+            ))
+            loose_items = list(palletize_plan.loose_items.select_related('item', 'shipping_order').order_by('id'))
+            
             # REALパレットの作成
-            for pallet_detail in palletize_plan.pallets.all():
+            related_orders = []  # created_pallets と同じ順の関連注文
+            for pallet_detail in pallet_details:
+                pallet_items = list(pallet_detail.items.all())
                 # パレット詳細の最初の商品の注文を代表として設定
-                first_item = pallet_detail.items.first()
-                representative_order = first_item.shipping_order if first_item else orders[0]
+                representative_order = pallet_items[0].shipping_order if pallet_items else orders[0]
                 
                 # パレット詳細からUnifiedPalletを作成
-                unified_pallet = UnifiedPallet.objects.create(
+                created_pallets.append(UnifiedPallet(
                     pallet_type='REAL',
                     pallet_detail=pallet_detail,
                     delivery_date=palletize_plan.delivery_date,
@@ -1028,29 +2349,20 @@ class DeliveryOptimizer:
                     height=pallet_config.max_height,
                     weight=pallet_detail.total_weight,
                     volume=pallet_detail.total_volume,
-                    shipping_order=representative_order  # 代表的な注文を設定
-                )
-                
+                    shipping_order=representative_order,  # 代表的な注文を設定
+                    # 上積み不可の商品を含むパレットには上に積まない
+                    stackable=all(pallet_item.item.stackable for pallet_item in pallet_items)
+                ))
                 # パレットに含まれる全ての注文を関連付ける
-                pallet_orders = []
-                for pallet_item in pallet_detail.items.all():
-                    if pallet_item.shipping_order not in pallet_orders:
-                        pallet_orders.append(pallet_item.shipping_order)
-                unified_pallet.related_orders.set(pallet_orders)
-                
-                created_pallets.append(unified_pallet)
-                
-                # デバッグ情報を追加
-                pallet_order_ids = list(pallet_detail.items.values_list('shipping_order_id', flat=True).distinct())
-                print(f"REALパレット作成: ID={unified_pallet.id}, 重量={unified_pallet.weight}, 含まれる注文ID: {pallet_order_ids}")
+                related_orders.append(list(dict.fromkeys(pallet_item.shipping_order_id for pallet_item in pallet_items)))
             
             # VIRTUALパレット（バラ積み）の作成
-            for loose_item in palletize_plan.loose_items.all():
+            for loose_item in loose_items:
                 # バラ積み商品の場合、数量は1として扱う
                 # 体積を計算
                 volume = loose_item.width * loose_item.depth * loose_item.height
                 
-                unified_pallet = UnifiedPallet.objects.create(
+                created_pallets.append(UnifiedPallet(
                     pallet_type='VIRTUAL',
                     item=loose_item.item,
                     item_quantity=1,  # バラ積み商品の数量は1
@@ -1060,13 +2372,24 @@ class DeliveryOptimizer:
                     height=loose_item.height,
                     weight=loose_item.weight,
                     volume=volume,
-                    shipping_order=loose_item.shipping_order
-                )
+                    shipping_order=loose_item.shipping_order,
+                    stackable=loose_item.item.stackable
+                ))
                 # VIRTUALパレットも関連注文を設定
-                unified_pallet.related_orders.set([loose_item.shipping_order])
-                
-                created_pallets.append(unified_pallet)
-                print(f"VIRTUALパレット作成: ID={unified_pallet.id}, 商品={loose_item.item.name}")
+                related_orders.append([loose_item.shipping_order_id])
+            
+            writer.create(created_pallets)
+            writer.relate(
+                UnifiedPallet._meta.get_field('related_orders'),
+                [(pallet.id, order_id) for pallet, order_ids in zip(created_pallets, related_orders) for order_id in order_ids]
+            )
+            
+            # デバッグ情報を追加
+            for pallet, order_ids in zip(created_pallets, related_orders):
+                if pallet.pallet_type == 'REAL':
+                    print(f"REALパレット作成: ID={pallet.id}, 重量={pallet.weight}, 含まれる注文ID: {order_ids}")
+                else:
+                    print(f"VIRTUALパレット作成: ID={pallet.id}, 商品={pallet.item.name}")
                 
         except Exception as e:
             print(f"UnifiedPallet作成中にエラー: {e}")
@@ -1091,12 +2414,15 @@ class DeliveryOptimizer:
             print("利用可能なパレットがありません")
             return region_pallets
         
+        # 関連注文はまとめて取得（取得済みのパレットは再取得しない）
+        prefetch_related_objects(available_pallets, 'related_orders')
+        
         # 該当する注文のパレットを選択
         for pallet in available_pallets:
             print(f"パレット ID={pallet.id}, type={pallet.pallet_type}, order_id={pallet.shipping_order_id}")
             
             # related_ordersフィールドを使用して判定
-            pallet_order_ids = set(pallet.related_orders.values_list('id', flat=True))
+            pallet_order_ids = {order.id for order in pallet.related_orders.all()}
             
             print(f"パレット {pallet.id} (type={pallet.pallet_type}) の関連注文ID: {pallet_order_ids}")
             
@@ -1113,10 +2439,12 @@ class DeliveryOptimizer:
     def _group_pallets_by_order(self, pallets: List['UnifiedPallet']) -> dict:
         """パレットを出荷依頼単位でグループ化"""
         order_groups = {}
+        # 関連注文はまとめて取得（取得済みのパレットは再取得しない）
+        prefetch_related_objects(pallets, 'related_orders')
         
         for pallet in pallets:
             # パレットに関連する全ての注文IDを取得
-            related_order_ids = set(pallet.related_orders.values_list('id', flat=True))
+            related_order_ids = {order.id for order in pallet.related_orders.all()}
             
             if related_order_ids:
                 # 複数の注文に関連するパレットは、最初の注文のグループに入れる
@@ -1129,8 +2457,8 @@ class DeliveryOptimizer:
                 print(f"パレット {pallet.id} を注文 {primary_order_id} のグループに追加")
             else:
                 # 関連する注文がない場合は、shipping_orderを使用
-                if pallet.shipping_order:
-                    order_id = pallet.shipping_order.id
+                if pallet.shipping_order_id:
+                    order_id = pallet.shipping_order_id
                     if order_id not in order_groups:
                         order_groups[order_id] = []
                     order_groups[order_id].append(pallet)
@@ -1180,10 +2508,10 @@ class DeliveryOptimizer:
                 current_weight = 0
                 truck_capacity = truck.payload
                 
-                # 2D配置でパッキング可能な出荷依頼グループを選択
-                packer = BinPacking2D(truck.width, truck.depth)
-                test_boxes = []
+                # 荷台に配置可能な出荷依頼グループを選択
+                packer = self._truck_packer(truck)
                 test_pallets = []
+                test_positions = []  # test_pallets と同じ順の配置位置
                 test_group_info = []  # (order_id, group_pallets) のリスト
                 
                 for order_id, group_pallets in remaining_order_groups:
@@ -1201,45 +2529,34 @@ class DeliveryOptimizer:
                     
                     for pallet in group_pallets:
                         if pallet.width <= truck.width and pallet.depth <= truck.depth:
-                            box = Box(
-                                width=pallet.width,
-                                depth=pallet.depth,
-                                height=pallet.height,
-                                weight=pallet.weight,
-                                item_code=f'PALLET_{pallet.id}',
-                                quantity=1
-                            )
-                            group_boxes.append(box)
+                            group_boxes.append(self._unified_pallet_box(pallet))
                         else:
                             can_fit_all = False
                             print(f"注文 {order_id} のパレット {pallet.id} はサイズ制限により積載不可")
                             break
                     
                     if can_fit_all:
-                        # 現在選択中の他のパレットと一緒に2D配置をテスト
-                        temp_boxes = test_boxes + group_boxes
-                        temp_packer = BinPacking2D(truck.width, truck.depth)
-                        temp_positions = temp_packer.pack(temp_boxes)
+                        # 現在選択中の他のパレットの空きに仮配置
+                        checkpoint = packer.try_add(group_boxes)
                         
-                        # 全てのパレットが配置できる場合のみ追加
-                        if temp_positions and len([p for p in temp_positions if p]) == len(temp_boxes):
-                            test_boxes.extend(group_boxes)
+                        # 全てのパレットが配置できる場合のみ確定
+                        if checkpoint.all_placed:
+                            packer.commit(checkpoint)
                             test_pallets.extend(group_pallets)
+                            test_positions.extend(checkpoint.positions)
                             test_group_info.append((order_id, group_pallets))
                             current_weight += group_weight
                             print(f"注文 {order_id} ({len(group_pallets)}個のパレット, {group_weight}kg) を積載候補に追加")
                         else:
-                            print(f"注文 {order_id} は2D配置制限により積載不可")
+                            packer.rollback(checkpoint)
+                            print(f"注文 {order_id} は荷台の配置制限により積載不可")
                     
                     # トラック容量の80%を超えたら次のトラックを検討
                     if current_weight > truck_capacity * 0.8:
                         break
                 
                 if test_group_info:
-                    # 最終的な2D配置を実行
-                    final_positions = packer.pack(test_boxes)
-                    
-                    if final_positions:
+                    if test_positions:
                         # 積載された出荷依頼グループに対応する注文を特定
                         loaded_orders = []
                         for order_id, group_pallets in test_group_info:
@@ -1247,9 +2564,18 @@ class DeliveryOptimizer:
                             if order:
                                 loaded_orders.append(order)
                         
+                        # 配送順を先に決め、後の配送先のパレットほど奥に積む（LIFO）
+                        stops = self._plan_stops(loaded_orders)
+                        loaded = self._load_in_stop_order(truck, stops, test_group_info)
+                        if loaded:
+                            load_pallets, load_positions = loaded
+                        else:
+                            print(f"トラック {truck.id}: 配送順で積み付けできないため、選択時の配置を使用")
+                            load_pallets, load_positions = test_pallets, test_positions
+                        
                         # 配送計画を作成
                         plan = self._create_delivery_plan_with_unified_pallets(
-                            truck, loaded_orders, target_date, test_pallets, final_positions[:len(test_pallets)]
+                            truck, stops, target_date, load_pallets, load_positions
                         )
                         plans.append(plan)
                         
@@ -1292,24 +2618,186 @@ class DeliveryOptimizer:
         
         return plans
     
+    def _truck_packer(self, truck: Truck, strategy: str = 'best_short_side_fit',
+                      door_access: bool = False) -> BinPacking2D:
+        """トラックの積載エンジン（荷台高さが登録されていれば段積みする3D、なければ2D）
+        
+        3Dの段数・上段の重量の上限はトラックの設定（Truck.max_layers・layer_weight_limit）。
+        strategy は2Dの場合の空き矩形の選び方（BinPacking2D.STRATEGIES）、
+        door_access は扉側から積み込める位置のみに配置するか
+        """
+        if truck.height > 0:
+            return TruckLoader3D(truck.width, truck.depth, truck.height, truck.payload,
+                                 max_layers=truck.max_layers, layer_weight_limit=truck.layer_weight_limit,
+                                 door_access=door_access)
+        return BinPacking2D(truck.width, truck.depth, strategy, door_access=door_access)
+    
+    def _unified_pallet_box(self, pallet: 'UnifiedPallet') -> Box:
+        """トラック積載用に統一パレットを箱として表す"""
+        return Box(
+            width=pallet.width,
+            depth=pallet.depth,
+            height=pallet.height,
+            weight=pallet.weight,
+            item_code=f'PALLET_{pallet.id}',
+            quantity=1,
+            stackable=pallet.stackable
+        )
+    
+    def _plan_stops(self, orders: List[ShippingOrder]) -> List[ShippingOrder]:
+        """配送順に並べた出荷依頼（座標のない配送先は最後）"""
+        located = [
+            order for order in orders
+            if order.destination.latitude and order.destination.longitude
+        ]
+        located_ids = {order.id for order in located}
+        unlocated = [order for order in orders if order.id not in located_ids]
+        
+        destinations = [
+            (float(order.destination.latitude), float(order.destination.longitude))
+            for order in located
+        ]
+        distances = self.distance_cache.matrix([order.destination for order in located])
+        route_indices = self.route_optimizer.optimize_route(destinations, distances)
+        return [located[i] for i in route_indices] + unlocated
+    
+    def _route_schedule(self, stops: List[ShippingOrder], departure_time: datetime
+                        ) -> Tuple[float, List[Tuple[ShippingOrder, int, datetime]]]:
+        """配送順の各区間の距離から、走行距離と到着予定時刻を計算
+        
+        配送拠点を出発して stops の順に回り、配送拠点に戻るまでの距離を合計する。
+        区間の移動時間は出発時刻の時間帯の速度（speed_profile）で求め、各配送先で
+        service_minutes の荷降ろし時間を加える。座標のない配送先への区間は距離0、
+        移動時間 UNLOCATED_TRAVEL_MINUTES とする
+        
+        Returns:
+            (走行距離(km), [(出荷依頼, 移動時間(分), 到着予定時刻)])
+        """
+        located = [order for order in stops if order.destination.latitude and order.destination.longitude]
+        index = {id(order): i + 1 for i, order in enumerate(located)}  # 距離行列の地点番号（0は配送拠点）
+        distances = self.route_optimizer._depot_distance_matrix(
+            [(float(order.destination.latitude), float(order.destination.longitude)) for order in located],
+            self.distance_cache.matrix([order.destination for order in located])
+        ) if located else None
+        
+        total_km = 0.0
+        schedule = []
+        current_time = departure_time
+        previous = 0
+        for i, order in enumerate(stops):
+            if i > 0:
+                current_time += timedelta(minutes=self.service_minutes)
+            node = index.get(id(order))
+            if node is None:
+                travel_minutes = self.UNLOCATED_TRAVEL_MINUTES
+            else:
+                distance = float(distances[previous, node])
+                total_km += distance
+                travel_minutes = math.ceil(distance / self._speed_at(current_time) * 60)
+                previous = node
+            current_time += timedelta(minutes=travel_minutes)
+            schedule.append((order, travel_minutes, current_time))
+        
+        if previous:
+            total_km += float(distances[previous, 0])
+        return round(total_km, 1), schedule
+    
+    def _speed_at(self, moment: datetime) -> float:
+        """時刻 moment の平均走行速度(km/h)"""
+        speed = None
+        for hour, kmh in sorted(self.speed_profile.items()):
+            if hour <= moment.hour or speed is None:
+                speed = kmh
+        return speed
+    
+    def _create_order_details(self, plan: DeliveryPlan, schedule: List[Tuple[ShippingOrder, int, datetime]]):
+        """配送順序（PlanOrderDetail）を作成（plan_writer でまとめて保存）"""
+        self.plan_writer.add([
+            PlanOrderDetail(
+                plan=plan,
+                shipping_order=order,
+                delivery_sequence=i + 1,
+                estimated_arrival=arrival,
+                travel_time_minutes=travel_minutes
+            )
+            for i, (order, travel_minutes, arrival) in enumerate(schedule)
+        ])
+    
+    def _load_in_stop_order(self, truck: Truck, stops: List[ShippingOrder],
+                            order_groups: List[Tuple[int, List['UnifiedPallet']]]
+                            ) -> Optional[Tuple[List['UnifiedPallet'], List[Position]]]:
+        """配送順の逆順（最後の配送先から）に荷台の奥から積み付ける
+        
+        荷台は y=0 が奥（運転席側）、y=奥行が荷台の扉側。扉側から積み込める位置のみに
+        配置するため、配置した順がそのまま積み込み順になる。戻り値は積み込み順のパレットと
+        配置位置で、全パレットを配置できない場合や、積み込み順・配送順で出し入れできない
+        配置になった場合（_unloading_conflicts）はNone
+        """
+        groups = dict(order_groups)
+        stop_ids = [order.id for order in stops]
+        # 配送先が特定できないパレットは最初（最も奥）に積む
+        load_order = [order_id for order_id in groups if order_id not in stop_ids] + [
+            order_id for order_id in reversed(stop_ids) if order_id in groups
+        ]
+        
+        packer = self._truck_packer(truck, strategy='bottom_left', door_access=True)
+        load_pallets = []
+        load_positions = []
+        unload_ranks = []  # 荷下ろしの順（小さいほど先に降ろす）
+        for order_id in load_order:
+            group_pallets = groups[order_id]
+            boxes = [self._unified_pallet_box(pallet) for pallet in group_pallets]
+            checkpoint = packer.try_add(boxes)
+            if not checkpoint.all_placed:
+                return None
+            packer.commit(checkpoint)
+            
+            pallets_by_box = {id(box): pallet for box, pallet in zip(boxes, group_pallets)}
+            rank = stop_ids.index(order_id) if order_id in stop_ids else len(stop_ids)
+            for box, position in packer.placed_items[checkpoint.placed_count:]:
+                load_pallets.append(pallets_by_box[id(box)])
+                load_positions.append(position)
+                unload_ranks.append(rank)
+        
+        blocked = self._unloading_conflicts(load_pallets, load_positions, unload_ranks)
+        if blocked:
+            print(f"トラック {truck.id}: 配送順で積み下ろしできない配置です（積み込み順の組: {blocked}）")
+            return None
+        return load_pallets, load_positions
+    
+    def _unloading_conflicts(self, pallets: List['UnifiedPallet'], positions: List[Position],
+                             unload_ranks: List[int]) -> List[Tuple[int, int]]:
+        """積み込み順・荷下ろし順と扉からの出し入れが矛盾するパレットの組を返す
+        
+        pallets / positions は積み込み順、unload_ranks は各パレットを降ろす順（同じ値は同じ配送先）。
+        後に積んだパレットが先に積んだパレットより奥（扉から見て同じ幅の範囲の裏側）にある場合は
+        積み込めず、手前か上にある場合は後に積んだ方を先に（または同じ配送先で）降ろせなければ
+        降ろせないため、いずれも矛盾とする。
+        
+        Returns:
+            (先に積んだパレットの番号, 後に積んだパレットの番号) のリスト（番号は積み込み順）
+        """
+        conflicts = []
+        for i, (pallet, position) in enumerate(zip(pallets, positions)):
+            for j in range(i + 1, len(pallets)):
+                other = positions[j]
+                if not (other.x < position.x + position.width and position.x < other.x + other.width):
+                    continue
+                in_front = other.y >= position.y + position.depth
+                on_top = (other.z >= position.z + pallet.height and
+                          other.y < position.y + position.depth and position.y < other.y + other.depth)
+                behind = position.y >= other.y + other.depth
+                if behind or ((in_front or on_top) and unload_ranks[j] > unload_ranks[i]):
+                    conflicts.append((i, j))
+        return conflicts
+    
     def _create_delivery_plan_with_unified_pallets(self, truck: Truck, orders: List[ShippingOrder], 
                                                  target_date, pallets: List['UnifiedPallet'], 
                                                  positions: List[Position]) -> DeliveryPlan:
-        """統一パレットシステムで配送計画を作成"""
+        """統一パレットシステムで配送計画を作成
         
-        # 配送ルートを最適化
-        destinations = []
-        for order in orders:
-            if order.destination.latitude and order.destination.longitude:
-                destinations.append((
-                    float(order.destination.latitude), 
-                    float(order.destination.longitude)
-                ))
-        
-        if destinations:
-            route_indices = self.route_optimizer.optimize_route(destinations)
-        else:
-            route_indices = list(range(len(orders)))
+        orders は配送順、pallets / positions は積み込み順（load_sequence の順）
+        """
         
         # 重量・体積計算
         total_weight = sum(pallet.weight for pallet in pallets)
@@ -1317,50 +2805,38 @@ class DeliveryOptimizer:
         
         # 出発時刻計算
         departure_time = datetime.combine(target_date, datetime.min.time().replace(hour=8))
+        route_distance_km, schedule = self._route_schedule(orders, departure_time)
         
-        # 配送計画作成
-        plan = DeliveryPlan.objects.create(
+        # 配送計画作成（保存は最適化の最後に plan_writer でまとめて行う）
+        plan = self.plan_writer.add_plan(DeliveryPlan(
             plan_date=target_date,
             truck=truck,
             departure_time=departure_time,
             total_weight=total_weight,
             total_volume=total_volume,
-            route_distance_km=0
-        )
+            route_distance_km=route_distance_km
+        ))
         
         # 配送順序の作成
-        current_time = departure_time
-        for i, order_idx in enumerate(route_indices):
-            if order_idx < len(orders):
-                order = orders[order_idx]
-                travel_time = 30 if i == 0 else 20  # 分
-                current_time += timedelta(minutes=travel_time)
-                
-                PlanOrderDetail.objects.create(
-                    plan=plan,
-                    shipping_order=order,
-                    delivery_sequence=i + 1,
-                    estimated_arrival=current_time,
-                    travel_time_minutes=travel_time
-                )
+        self._create_order_details(plan, schedule)
         
         # LoadPalletとPalletLoadHistoryの作成
-        for i, (pallet, position) in enumerate(zip(pallets, positions)):
-            # LoadPalletを作成
-            LoadPallet.objects.create(
+        self.plan_writer.add(
+            LoadPallet(
                 plan=plan,
                 pallet=pallet,
                 position_x=position.x,
                 position_y=position.y,
+                position_z=position.z,
+                layer=position.layer,
                 rotation=position.rotation,
                 load_sequence=i + 1
             )
-            
-            # PalletLoadHistoryを作成
-            PalletLoadHistory.objects.create(
-                pallet=pallet,
-                plan=plan,
-                status='USED'
-            )
+            for i, (pallet, position) in enumerate(zip(pallets, positions))
+        )
+        self.plan_writer.add(
+            PalletLoadHistory(pallet=pallet, plan=plan, status='USED')
+            for pallet in pallets
+        )
         
         return plan
\ No newline at end of file
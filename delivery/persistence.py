@@ -0,0 +1,117 @@
+"""
+最適化結果の一括保存
+
+パレタイズ設計・統一パレットなど、1回の最適化で数千行になる結果を
+bulk_create でまとめてINSERTする。PostgreSQL では主キーを使わない行を
+COPY で書き込むこともできる（settings.BULK_WRITE_USE_COPY）。
+"""
+
+import io
+from typing import Iterable, Sequence, Tuple
+
+from django.conf import settings
+from django.db import connection, models
+
+
+class BulkWriter:
+    """モデルのインスタンスをまとめて保存する"""
+
+    # 1回のINSERTで保存する行数
+    BATCH_SIZE = 1000
+
+    def __init__(self, batch_size: int = None, use_copy: bool = None):
+        """
+        Args:
+            batch_size: 1回のINSERTで保存する行数。Noneの場合は BATCH_SIZE
+            use_copy: 主キーが不要な行を COPY で保存するか（PostgreSQL のみ）。
+                Noneの場合は settings.BULK_WRITE_USE_COPY
+        """
+        self.batch_size = batch_size or self.BATCH_SIZE
+        if use_copy is None:
+            use_copy = settings.BULK_WRITE_USE_COPY
+        self.use_copy = use_copy and connection.vendor == 'postgresql'
+
+    def create(self, objs: Sequence[models.Model], need_ids: bool = True) -> Sequence[models.Model]:
+        """同じモデルのインスタンスを保存
+
+        Args:
+            need_ids: 保存後に主キーを使うか（外部キーの参照先・多対多の関連付けなど）。
+                False で use_copy の場合は COPY で保存し、インスタンスに主キーは設定されない
+        """
+        if not objs:
+            return objs
+        if self.use_copy and not need_ids:
+            self._copy(objs)
+            return objs
+        return type(objs[0]).objects.bulk_create(objs, batch_size=self.batch_size)
+
+    def relate(self, field: models.ManyToManyField, pairs: Iterable[Tuple[int, int]]):
+        """多対多の関連を (元のID, 関連先のID) の組でまとめて保存
+
+        Args:
+            field: 多対多のフィールド（例: UnifiedPallet._meta.get_field('related_orders')）
+        """
+        through = field.remote_field.through
+        source = field.m2m_field_name() + '_id'
+        target = field.m2m_reverse_field_name() + '_id'
+        rows = [through(**{source: source_id, target: target_id}) for source_id, target_id in dict.fromkeys(pairs)]
+        self.create(rows, need_ids=False)
+
+    def _copy(self, objs: Sequence[models.Model]):
+        """COPY ... FROM STDIN で保存（主キーは自動採番）"""
+        model = type(objs[0])
+        fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+        columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+
+        buffer = io.StringIO()
+        for obj in objs:
+            values = [field.get_db_prep_save(field.pre_save(obj, True), connection) for field in fields]
+            buffer.write('\t'.join(self._copy_value(value) for value in values))
+            buffer.write('\n')
+        buffer.seek(0)
+
+        with connection.cursor() as cursor:
+            cursor.cursor.copy_expert(
+                f'COPY {connection.ops.quote_name(model._meta.db_table)} ({columns}) FROM STDIN', buffer
+            )
+
+    def _copy_value(self, value) -> str:
+        """COPY のテキスト形式の値（NULL は \\N、区切り文字はエスケープ）"""
+        if value is None:
+            return '\\N'
+        if isinstance(value, bool):
+            return 't' if value else 'f'
+        return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+                .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+
+class PlanWriter:
+    """1回の最適化で作成する配送計画と、計画に付随する行をまとめて保存する
+
+    配送計画（DeliveryPlan）は add_plan で未保存のまま登録し、付随する行
+    （PlanOrderDetail・PlanItemLoad・LoadPallet・PalletLoadHistory など）は
+    その配送計画を参照して add で登録する。flush で配送計画を保存して主キーを取得し、
+    付随する行をモデルごとに一括で保存する。
+    """
+
+    def __init__(self, writer: BulkWriter = None):
+        self.writer = writer or BulkWriter()
+        self.plans = []
+        self.rows = {}  # モデル → 行（登録順）
+
+    def add_plan(self, plan: models.Model) -> models.Model:
+        self.plans.append(plan)
+        return plan
+
+    def add(self, rows: Iterable[models.Model]):
+        for row in rows:
+            self.rows.setdefault(type(row), []).append(row)
+
+    def flush(self) -> list:
+        """登録した配送計画と行を保存し、保存した配送計画を返す"""
+        plans = self.writer.create(self.plans)
+        for rows in self.rows.values():
+            self.writer.create(rows, need_ids=False)
+        self.plans, self.rows = [], {}
+        return list(plans)
@@ -0,0 +1,152 @@
+"""
+パレタイズ設計のサービス
+
+画面・最適化ジョブの両方から呼び出すパレタイズ設計の処理（出荷商品の集計、
+PalletOptimizer による積み付け、パレタイズ設計の保存）。
+"""
+
+from typing import Callable, Dict, List, Optional
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import ShippingOrder, PalletizePlan, PalletDetail, PalletItem, LooseItem
+from .optimization import PalletOptimizer, Pallet, Box
+from .persistence import BulkWriter
+
+# 進捗の通知先: (進捗(%), メッセージ)
+ProgressCallback = Callable[[int, str], None]
+
+
+def palletize_orders(delivery_date, progress: Optional[ProgressCallback] = None) -> PalletizePlan:
+    """指定日の出荷依頼をパレタイズし、パレタイズ設計として保存"""
+    progress = progress or (lambda percent, message: None)
+
+    # 指定日の出荷依頼を取得
+    orders = ShippingOrder.objects.filter(
+        delivery_deadline=delivery_date
+    ).select_related('shipper', 'destination').prefetch_related('order_items__item__parts')
+
+    if not orders.exists():
+        raise ValueError(f'{delivery_date}の出荷依頼が見つかりません。')
+
+    progress(5, '出荷商品を集計しています')
+    all_items = collect_palletize_items(orders)
+
+    progress(20, 'パレットに積み付けています')
+
+    # パレタイズ最適化（結果の箱は1個単位に展開される）
+    optimizer = PalletOptimizer(placement_strategy='extreme_point', allow_rotation=True)
+    boxes = [item['box'] for item in all_items]
+    total_items = sum(box.quantity for box in boxes)
+    pallets, remaining_boxes = optimizer.pack_pallet(
+        boxes, time_budget_ms=settings.PALLETIZE_TIME_BUDGET_MS or None
+    )
+
+    progress(80, 'パレタイズ設計を保存しています')
+    return save_palletize_result(delivery_date, all_items, pallets, remaining_boxes, total_items)
+
+
+def collect_palletize_items(orders) -> List[Dict]:
+    """出荷依頼の商品を、出荷商品ごとに数量をまとめた箱と商品情報の組にする
+
+    箱の source_idx は戻り値での番号で、パレタイズ後の箱から all_items[box.source_idx] で商品情報を引ける
+
+    Returns:
+        {'order': 出荷依頼, 'item': 製品, 'part': 部品（単品はNone）, 'box': Box} のリスト
+    """
+    all_items = []
+    for order in orders:
+        for order_item in order.order_items.all():
+            item = order_item.item
+            # セット品の場合は部品を展開
+            parts = list(item.parts.all())
+            for part in parts or [None]:
+                source = part or item
+                all_items.append({
+                    'order': order,
+                    'item': item,
+                    'part': part,
+                    'box': Box(
+                        width=source.width,
+                        depth=source.depth,
+                        height=source.height,
+                        weight=source.weight,
+                        item_code=part.parts_code if part else item.item_code,
+                        quantity=order_item.quantity,
+                        shipping_order_id=order.id,
+                        this_side_up=item.this_side_up,
+                        source_idx=len(all_items)
+                    )
+                })
+    return all_items
+
+
+def save_palletize_result(delivery_date, all_items: List[Dict], pallets: List[Pallet],
+                          remaining_boxes: List[Box], total_items: int) -> PalletizePlan:
+    """パレタイズ結果をパレタイズ設計として保存（パレット・商品ごとの行は一括INSERT）
+
+    Args:
+        all_items: collect_palletize_items の戻り値（箱の source_idx で商品情報を引く）
+    """
+    writer = BulkWriter()
+    with transaction.atomic():
+        # パレタイズ設計を作成
+        palletize_plan = PalletizePlan.objects.create(
+            delivery_date=delivery_date,
+            total_items=total_items,
+            total_pallets=len(pallets),
+            total_loose_items=len(remaining_boxes)
+        )
+
+        # パレット詳細を保存（パレット積載商品の参照先のため主キーを取得）
+        pallet_details = writer.create([
+            PalletDetail(
+                palletize_plan=palletize_plan,
+                pallet_number=i + 1,
+                total_weight=pallet.get_total_weight(),
+                total_volume=pallet.get_used_volume(),
+                utilization=(pallet.get_used_volume() / (pallet.width * pallet.depth * pallet.height)) * 100
+            )
+            for i, pallet in enumerate(pallets)
+        ])
+
+        # パレット積載商品を保存
+        pallet_items = []
+        for pallet_detail, pallet in zip(pallet_details, pallets):
+            for box in pallet.boxes:
+                item_info = all_items[box.source_idx]
+                pallet_items.append(PalletItem(
+                    pallet=pallet_detail,
+                    shipping_order=item_info['order'],
+                    item=item_info['item'],
+                    part=item_info['part'],
+                    position_x=box.x,
+                    position_y=box.y,
+                    position_z=box.z,
+                    width=box.width,
+                    depth=box.depth,
+                    height=box.height,
+                    weight=box.weight,
+                    rotation=box.rotation
+                ))
+        writer.create(pallet_items, need_ids=False)
+
+        # バラ積み商品を保存
+        loose_items = []
+        for box in remaining_boxes:
+            item_info = all_items[box.source_idx]
+            reason = 'パレットサイズ超過' if (box.width > 110 or box.depth > 110) else '積載不可'
+            loose_items.append(LooseItem(
+                palletize_plan=palletize_plan,
+                shipping_order=item_info['order'],
+                item=item_info['item'],
+                width=box.width,
+                depth=box.depth,
+                height=box.height,
+                weight=box.weight,
+                reason=reason
+            ))
+        writer.create(loose_items, need_ids=False)
+
+    return palletize_plan
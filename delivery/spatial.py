@@ -0,0 +1,125 @@
+"""
+配送先の空間インデックス
+
+配送先の緯度・経度を単位球面上の3次元座標に変換して k-d tree（scipy.spatial.cKDTree）に登録し、
+近い配送先の検索と地域のクラスタリングに使う。球面上の直線距離（弦の長さ）は大円距離と
+大小関係が一致するため、近い順はハーバサイン距離で比べた場合と同じになる。
+"""
+
+import math
+from typing import List, Tuple
+
+import numpy as np
+from scipy.cluster.vq import kmeans2
+from scipy.spatial import cKDTree
+
+
+class DestinationIndex:
+    """配送先の座標の k-d tree"""
+
+    EARTH_RADIUS_KM = 6371  # 地球の半径（km）
+
+    # nearest_unvisited で最初に調べる近い地点の数（見つからなければ4倍ずつ広げる）
+    UNVISITED_QUERY_SIZE = 8
+
+    def __init__(self, coordinates: List[Tuple[float, float]]):
+        """
+        Args:
+            coordinates: 地点の(緯度, 経度)。地点番号は並び順
+        """
+        coords = np.radians(np.asarray(coordinates, dtype=np.float64).reshape(-1, 2))
+        lat, lon = coords[:, 0], coords[:, 1]
+        self.points = np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+        self.tree = cKDTree(self.points)
+        self._candidates = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def neighbors(self, count: int) -> List[List[int]]:
+        """地点ごとに近い順の count 地点（自身を除く）。全地点をまとめて検索する"""
+        count = min(count, len(self) - 1)
+        if count <= 0:
+            return [[] for _ in range(len(self))]
+        _, found = self.tree.query(self.points, k=count + 1)
+        return [
+            [other for other in row if other != index][:count]
+            for index, row in enumerate(found.tolist())
+        ]
+
+    def nearest_unvisited(self, index: int, visited: np.ndarray) -> int:
+        """地点 index から最も近い未訪問の地点。全て訪問済みの場合は -1
+
+        近い UNVISITED_QUERY_SIZE 地点を初回に全地点分まとめて検索しておき、
+        それらが全て訪問済みの場合のみ k-d tree を検索し直す
+        """
+        if self._candidates is None:
+            self._candidates = self.neighbors(self.UNVISITED_QUERY_SIZE)
+        for other in self._candidates[index]:
+            if not visited[other]:
+                return other
+
+        n = len(self)
+        k = min(self.UNVISITED_QUERY_SIZE * 4, n)
+        while True:
+            _, found = self.tree.query(self.points[index], k=k)
+            for other in np.atleast_1d(found):
+                if other < n and not visited[other]:
+                    return int(other)
+            if k >= n:
+                return -1
+            k = min(k * 4, n)
+
+    def kmeans(self, clusters: int, seed: int = 0) -> np.ndarray:
+        """k-means 法で clusters 個に分けた地点ごとのクラスタ番号"""
+        clusters = max(1, min(clusters, len(self)))
+        if clusters == 1:
+            return np.zeros(len(self), dtype=int)
+        _, labels = kmeans2(self.points, clusters, minit='++', seed=seed)
+        return labels
+
+    def dbscan(self, radius_km: float, min_samples: int = 2) -> np.ndarray:
+        """DBSCAN で分けた地点ごとのクラスタ番号（どのクラスタにも属さない地点は -1）
+
+        Args:
+            radius_km: 近傍とみなす距離（km）
+            min_samples: 中心点とみなす、近傍の地点数（自身を含む）
+        """
+        chord = 2 * math.sin(min(radius_km / self.EARTH_RADIUS_KM, math.pi) / 2)
+        neighborhoods = self.tree.query_ball_point(self.points, chord)
+        core = np.array([len(neighbors) >= min_samples for neighbors in neighborhoods], dtype=bool)
+
+        labels = np.full(len(self), -1, dtype=int)
+        cluster = 0
+        for start in range(len(self)):
+            if labels[start] != -1 or not core[start]:
+                continue
+            # 中心点から近傍をたどってクラスタを広げる（中心点でない地点の先へは広げない）
+            labels[start] = cluster
+            stack = [start]
+            while stack:
+                point = stack.pop()
+                if not core[point]:
+                    continue
+                for other in neighborhoods[point]:
+                    if labels[other] == -1:
+                        labels[other] = cluster
+                        stack.append(other)
+            cluster += 1
+        return labels
+
+    def attach_noise(self, labels: np.ndarray) -> np.ndarray:
+        """どのクラスタにも属さない地点（-1）を、最も近いクラスタ所属の地点と同じクラスタにする
+
+        クラスタが1つもない場合は全地点を1つのクラスタ（0）にする
+        """
+        noise = labels < 0
+        if not noise.any():
+            return labels
+        if noise.all():
+            return np.zeros(len(self), dtype=int)
+        clustered = np.flatnonzero(~noise)
+        _, nearest = cKDTree(self.points[clustered]).query(self.points[noise])
+        labels = labels.copy()
+        labels[noise] = labels[clustered[nearest]]
+        return labels
@@ -0,0 +1,406 @@
+import contextlib
+import io
+import time
+from dataclasses import replace
+from datetime import date, timedelta
+from unittest import mock
+
+import numpy as np
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .distances import DistanceCache
+from .jobs import JobHeartbeat, run_job
+from .management.commands.benchmark_palletize import Command as BenchmarkPalletizeCommand
+from .models import (
+    Destination, DestinationDistance, DeliveryPlan, Item, LoadPallet, OptimizationJob, OrderItem, PalletConfiguration,
+    PalletDetail, PalletItem, PalletizePlan, Part, PlanOrderDetail, Shipper, ShippingOrder, Truck, UnifiedPallet
+)
+from .optimization import Box, DeliveryOptimizer, Pallet, PalletOptimizer, Position, TruckLoader3D
+
+
+class PalletTotalsTests(SimpleTestCase):
+    """パレットが保持する集計（重量・体積・個数）"""
+
+    def _assert_totals_match_boxes(self, pallet):
+        boxes = pallet.boxes
+        self.assertAlmostEqual(pallet.total_weight, sum(box.weight * box.quantity for box in boxes))
+        self.assertEqual(pallet.used_volume, sum(box.width * box.depth * box.height * box.quantity for box in boxes))
+        self.assertEqual(pallet.box_count, sum(box.quantity for box in boxes))
+        self.assertEqual(pallet.current_height, max((box.z + box.height for box in boxes), default=0))
+
+    def test_totals_equal_sums_after_add_box_and_copy(self):
+        pallet = Pallet(width=110, depth=110, height=150, max_weight=1000)
+        pallet.add_box(Box(width=40, depth=30, height=20, weight=7.5, item_code='A', quantity=3))
+        pallet.add_box(Box(width=25, depth=25, height=35, weight=2.3, item_code='B', x=40, z=0))
+        self._assert_totals_match_boxes(pallet)
+
+        # 複製に積んだ箱は複製元の集計に含まれない
+        copied = pallet.copy()
+        copied.add_box(Box(width=40, depth=30, height=15, weight=4.1, item_code='C', z=20))
+        self._assert_totals_match_boxes(copied)
+        self._assert_totals_match_boxes(pallet)
+        self.assertEqual(len(pallet.boxes), 2)
+
+
+class PlacementStrategyTests(SimpleTestCase):
+    """配置方法ごとのパレット数"""
+
+    # extreme_point の候補点のみでは grid より多くのパレットを使っていた出荷依頼（benchmark_palletize の生成条件）
+    WORKLOADS = [
+        ({'orders': 1, 'lines': 4, 'max_quantity': 50}, (5, 17, 18, 25, 27, 28)),
+        ({'orders': 2, 'lines': 4, 'max_quantity': 20}, (5, 10)),
+        ({'orders': 2, 'lines': 4, 'max_quantity': 30}, (9,)),
+    ]
+
+    def _pallet_count(self, boxes, placement_strategy):
+        config = PalletConfiguration(width=110, depth=110, max_height=150, max_weight=1000.0)
+        optimizer = PalletOptimizer(config, placement_strategy=placement_strategy)
+        with contextlib.redirect_stdout(io.StringIO()):
+            pallets, _ = optimizer.pack_pallet([replace(box) for box in boxes])
+        return len(pallets)
+
+    def test_extreme_point_does_not_use_more_pallets_than_grid(self):
+        for options, seeds in self.WORKLOADS:
+            for seed in seeds:
+                with self.subTest(seed=seed, **options):
+                    boxes = BenchmarkPalletizeCommand()._generate_boxes(dict(options, seed=seed))
+                    self.assertLessEqual(
+                        self._pallet_count(boxes, 'extreme_point'), self._pallet_count(boxes, 'grid')
+                    )
+
+
+class LoadInStopOrderTests(TestCase):
+    """配送順の積み付け（後の配送先ほど奥に積む）"""
+
+    def setUp(self):
+        self.optimizer = DeliveryOptimizer()
+
+    def _pallets(self, count):
+        return [
+            UnifiedPallet(pallet_type='REAL', width=110, depth=110, height=100, weight=100, volume=110 * 110 * 100)
+            for _ in range(count)
+        ]
+
+    def test_first_stop_is_not_stacked_behind_later_stops(self):
+        # 2列 × 4行 × 2段に収まる荷台に、3か所分のパレットを4枚ずつ積む
+        truck = Truck(width=240, depth=500, height=240, payload=10000, max_layers=2)
+        stops = [ShippingOrder(id=order_id) for order_id in (1, 2, 3)]
+        order_groups = [(order.id, self._pallets(4)) for order in reversed(stops)]
+        stop_of = {id(pallet): order_id for order_id, pallets in order_groups for pallet in pallets}
+
+        pallets, positions = self.optimizer._load_in_stop_order(truck, stops, order_groups)
+
+        unload_ranks = [stop_of[id(pallet)] - 1 for pallet in pallets]
+        self.assertEqual(self.optimizer._unloading_conflicts(pallets, positions, unload_ranks), [])
+        # 積み込み順は最後の配送先から
+        self.assertEqual(unload_ranks, sorted(unload_ranks, reverse=True))
+        # 最初の配送先のパレットは扉側の列にある
+        first_stop_rows = {position.y for position, rank in zip(positions, unload_ranks) if rank == 0}
+        self.assertEqual(first_stop_rows, {max(position.y for position in positions)})
+
+    def test_conflicts_detect_first_stop_stacked_behind_later_stop(self):
+        # 積み込み順: 最後の配送先(C)を奥に、中間の配送先(B)を手前に、最初の配送先(A)を C の上に
+        pallets = self._pallets(3)
+        positions = [
+            Position(x=0, y=0, width=110, depth=110),
+            Position(x=0, y=220, width=110, depth=110),
+            Position(x=0, y=0, width=110, depth=110, z=100, layer=2),
+        ]
+
+        conflicts = self.optimizer._unloading_conflicts(pallets, positions, [2, 1, 0])
+        self.assertEqual(conflicts, [(1, 2)])
+
+
+class TruckLoader3DRollbackTests(SimpleTestCase):
+    """3Dトラック積載の仮配置の取り消し"""
+
+    def _state(self, loader):
+        bed = loader.bed
+        return (
+            bed.height_map.copy(), bed.gap_map.copy(), sorted(bed.extreme_points), bed.placed_extents().copy(),
+            len(bed.boxes), bed.total_weight, bed.used_volume, bed.box_count, bed.current_height,
+            list(loader.extent_weights), list(loader.extent_layers), dict(loader.layer_weights),
+        )
+
+    def _assert_same_state(self, actual, expected):
+        for actual_value, expected_value in zip(actual, expected):
+            if hasattr(expected_value, 'shape'):
+                self.assertTrue((actual_value == expected_value).all())
+            else:
+                self.assertEqual(actual_value, expected_value)
+
+    def _boxes(self, count, **options):
+        return [Box(width=110, depth=110, height=100, weight=100 - i, item_code=f'P{i}', **options) for i in range(count)]
+
+    def test_rollback_restores_bed_after_nested_try_add(self):
+        loader = TruckLoader3D(240, 500, 240, 10000, max_layers=2)
+        loader.commit(loader.try_add(self._boxes(4)))
+        before = self._state(loader)
+
+        outer = loader.try_add(self._boxes(3))
+        after_outer = self._state(loader)
+        inner = loader.try_add(self._boxes(2, stackable=False))
+        self.assertTrue(inner.all_placed)
+        loader.rollback(inner)
+        self._assert_same_state(self._state(loader), after_outer)
+
+        loader.rollback(outer)
+        self._assert_same_state(self._state(loader), before)
+        self.assertEqual(loader.undo_log, [])
+
+        # 取り消した後も同じ位置に配置できる
+        again = loader.try_add(self._boxes(3))
+        self.assertEqual(again.positions, outer.positions)
+
+
+class DistanceCacheTests(TestCase):
+    """配送先間距離のキャッシュ（プロセス内 + DB）"""
+
+    def setUp(self):
+        DistanceCache.clear()
+        self.addCleanup(DistanceCache.clear)
+        self.destinations = [
+            Destination.objects.create(name=f'配送先{i}', address='東京都', latitude=35.6 + i / 100, longitude=139.7)
+            for i in range(4)
+        ]
+        self.route_optimizer = DeliveryOptimizer().route_optimizer
+        self.cache = DistanceCache(self.route_optimizer)
+
+    def _expected(self, destinations):
+        return self.route_optimizer._calculate_distance_matrix(
+            [(float(destination.latitude), float(destination.longitude)) for destination in destinations]
+        )
+
+    def test_distances_are_shared_through_db_and_recomputed_when_moved(self):
+        self.assertTrue(np.allclose(self.cache.matrix(self.destinations), self._expected(self.destinations)))
+        self.assertEqual(DestinationDistance.objects.count(), 6)
+
+        # 他のプロセス（プロセス内のキャッシュなし）はDBから読み込み、計算・保存しない
+        DistanceCache.clear()
+        destinations = self.destinations[1:] + self.destinations[:1]
+        with self.assertNumQueries(1):
+            distances = self.cache.matrix(destinations)
+        self.assertTrue(np.allclose(distances, self._expected(destinations)))
+        with self.assertNumQueries(0):
+            self.cache.matrix(self.destinations[:2])
+
+        # 座標が変わった配送先の組のみ再計算して上書き
+        moved = self.destinations[0]
+        moved.latitude = 36
+        moved.save()
+        self.assertTrue(np.allclose(self.cache.matrix(self.destinations), self._expected(self.destinations)))
+        self.assertEqual(DestinationDistance.objects.count(), 6)
+        self.assertEqual(
+            DestinationDistance.objects.filter(origin=moved, origin_latitude=36.0).count(), 3
+        )
+
+
+class OptimizationJobTests(TestCase):
+    """最適化ジョブの実行と、応答のないジョブの中断"""
+
+    def setUp(self):
+        OptimizationJob.enqueue('PALLETIZE', date(2026, 10, 18))
+        self.job = OptimizationJob.claim_next()
+
+    def _fail_stale_jobs(self):
+        call_command('run_optimization_jobs', once=True, stale_minutes=60, stdout=io.StringIO())
+        self.job.refresh_from_db()
+
+    def test_stale_check_uses_last_progress_report(self):
+        # 開始から時間が経っていても、進捗を報告していれば中断しない
+        OptimizationJob.objects.filter(id=self.job.id).update(started_at=timezone.now() - timedelta(hours=2))
+        self.job.report_progress(50, '積み付け中')
+        self._fail_stale_jobs()
+        self.assertEqual(self.job.status, 'RUNNING')
+
+        OptimizationJob.objects.filter(id=self.job.id).update(heartbeat_at=timezone.now() - timedelta(hours=2))
+        self._fail_stale_jobs()
+        self.assertEqual(self.job.status, 'FAILED')
+
+    def test_result_does_not_overwrite_job_failed_as_stale(self):
+        plan = PalletizePlan.objects.create(
+            delivery_date=self.job.target_date, total_items=0, total_pallets=0, total_loose_items=0
+        )
+
+        def palletize(target_date, progress):
+            # 実行中に他のワーカーが応答なしとして中断する
+            OptimizationJob.objects.filter(id=self.job.id).update(status='FAILED', error='中断')
+            return plan
+
+        with mock.patch('delivery.jobs.palletize_orders', palletize):
+            run_job(self.job)
+
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, 'FAILED')
+        self.assertIsNone(self.job.palletize_plan)
+
+    def test_plans_are_not_linked_to_job_failed_as_stale(self):
+        job = OptimizationJob.objects.create(job_type='DELIVERY', target_date=date(2026, 10, 18), status='RUNNING')
+        plan = DeliveryPlan.objects.create(
+            plan_date=job.target_date, truck=Truck.objects.create(width=240, depth=960, height=240, payload=10000),
+            departure_time=timezone.now(), total_weight=0, total_volume=0
+        )
+
+        def optimize(target_date, progress):
+            OptimizationJob.objects.filter(id=job.id).update(status='FAILED', error='中断')
+            return [plan]
+
+        with mock.patch('delivery.jobs.optimize_delivery', optimize):
+            run_job(job)
+
+        self.assertEqual(job.status, 'FAILED')
+        self.assertFalse(job.delivery_plans.exists())
+
+
+class JobHeartbeatTests(TransactionTestCase):
+    """実行に時間のかかるジョブの最終応答日時（ワーカーとは別の接続で保存）"""
+
+    def test_slow_job_is_not_failed_as_stale(self):
+        OptimizationJob.enqueue('PALLETIZE', date(2026, 10, 18))
+        job = OptimizationJob.claim_next()
+        plan = PalletizePlan.objects.create(
+            delivery_date=job.target_date, total_items=0, total_pallets=0, total_loose_items=0
+        )
+
+        def palletize(target_date, progress):
+            # 最後の応答から時間が経った状態で、進捗を報告しながら処理を続ける
+            OptimizationJob.objects.filter(id=job.id).update(heartbeat_at=timezone.now() - timedelta(hours=2))
+            progress(50, '積み付け中')
+            time.sleep(0.5)
+            call_command('run_optimization_jobs', once=True, stale_minutes=60, stdout=io.StringIO())
+            return plan
+
+        with mock.patch.object(JobHeartbeat, 'INTERVAL', 0.05), \
+                mock.patch('delivery.jobs.palletize_orders', palletize):
+            run_job(job)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'SUCCEEDED')
+        self.assertEqual(job.palletize_plan, plan)
+
+
+class PalletizeViewTests(TestCase):
+    """パレタイズ設計のジョブ登録はPOSTのみ"""
+
+    @classmethod
+    def setUpTestData(cls):
+        ShippingOrder.objects.create(
+            order_number='TEST-ORDER-1',
+            shipper=Shipper.objects.create(shipper_code='S1', name='テスト荷主', address='東京都'),
+            destination=Destination.objects.create(name='テスト配送先', address='東京都'),
+            delivery_deadline=date(2026, 10, 18)
+        )
+
+    def test_get_does_not_enqueue_job(self):
+        response = self.client.get(reverse('delivery:palletize_result', args=['2026-10-18']))
+        self.assertRedirects(response, reverse('delivery:palletize_design'))
+        self.assertFalse(OptimizationJob.objects.exists())
+
+    def test_post_enqueues_job(self):
+        response = self.client.post(reverse('delivery:palletize_design'), {'delivery_date': '2026-10-18'})
+        job = OptimizationJob.objects.get()
+        self.assertRedirects(response, reverse('delivery:job_detail', args=[job.pk]), fetch_redirect_response=False)
+        self.assertEqual((job.job_type, job.target_date), ('PALLETIZE', date(2026, 10, 18)))
+
+
+class OptimizeDeliveryViewTests(TestCase):
+    """配送最適化のジョブ登録（商品の寸法チェックのクエリ数）"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Truck.objects.create(width=240, depth=960, height=240, payload=10000)
+        cls.shipper = Shipper.objects.create(shipper_code='S1', name='テスト荷主', address='東京都')
+        cls.destination = Destination.objects.create(name='テスト配送先', address='東京都')
+
+    def _create_day(self, delivery_date, item_count):
+        """商品 item_count 種類（セット品を含む）の出荷依頼とパレタイズ設計のある配送日"""
+        PalletizePlan.objects.create(delivery_date=delivery_date, total_items=0, total_pallets=0, total_loose_items=0)
+        order = ShippingOrder.objects.create(
+            order_number=f'TEST-{delivery_date}', shipper=self.shipper, destination=self.destination,
+            delivery_deadline=delivery_date
+        )
+        for number in range(item_count):
+            item = Item.objects.create(item_code=f'{delivery_date}-{number}', name=f'商品{number}',
+                                       width=30, depth=30, height=30, weight=5)
+            Part.objects.create(item=item, parts_code=f'P{number}', width=10, depth=10, height=10, weight=1)
+            OrderItem.objects.create(shipping_order=order, item=item)
+
+    def _post_query_count(self, delivery_date):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('delivery:optimize_delivery'), {'target_date': str(delivery_date)})
+        job = OptimizationJob.objects.get(target_date=delivery_date)
+        self.assertRedirects(response, reverse('delivery:job_detail', args=[job.pk]), fetch_redirect_response=False)
+        return len(queries)
+
+    def test_query_count_does_not_depend_on_item_count(self):
+        self._create_day(date(2026, 10, 18), 1)
+        self._create_day(date(2026, 10, 19), 8)
+        self.assertEqual(self._post_query_count(date(2026, 10, 19)), self._post_query_count(date(2026, 10, 18)))
+
+
+class PlanDetailViewTests(TestCase):
+    """配送計画詳細のクエリ数"""
+
+    # 配送計画・配送順序・積載パレット・パレット内の商品・従来の積載商品・パレタイズ設計
+    EXPECTED_QUERIES = 6
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.truck = Truck.objects.create(width=240, depth=960, height=240, payload=10000)
+        cls.item = Item.objects.create(item_code='TEST-1', name='テスト商品', width=30, depth=30, height=30, weight=5)
+        cls.order = ShippingOrder.objects.create(
+            order_number='TEST-ORDER-1',
+            shipper=Shipper.objects.create(shipper_code='S1', name='テスト荷主', address='東京都'),
+            destination=Destination.objects.create(name='テスト配送先', address='東京都', latitude=35.68, longitude=139.76),
+            delivery_deadline=date(2026, 10, 18)
+        )
+        cls.palletize_plan = PalletizePlan.objects.create(
+            delivery_date=date(2026, 10, 18), total_items=0, total_pallets=0, total_loose_items=0
+        )
+
+    def _create_plan(self, pallet_count):
+        """REALパレット pallet_count 枚（各3商品）とバラ積み1個を積んだ配送計画"""
+        plan = DeliveryPlan.objects.create(
+            plan_date=date(2026, 10, 18), truck=self.truck, departure_time=timezone.now(),
+            total_weight=0, total_volume=0
+        )
+        PlanOrderDetail.objects.create(
+            plan=plan, shipping_order=self.order, delivery_sequence=1,
+            estimated_arrival=timezone.now(), travel_time_minutes=10
+        )
+        for number in range(pallet_count):
+            detail = PalletDetail.objects.create(
+                palletize_plan=self.palletize_plan, pallet_number=plan.id * 100 + number + 1,
+                total_weight=15, total_volume=81000, utilization=10
+            )
+            PalletItem.objects.bulk_create([
+                PalletItem(pallet=detail, shipping_order=self.order, item=self.item, position_x=30 * i,
+                           position_y=0, position_z=0, width=30, depth=30, height=30, weight=5)
+                for i in range(3)
+            ])
+            pallet = UnifiedPallet.objects.create(
+                pallet_type='REAL', pallet_detail=detail, delivery_date=plan.plan_date, width=110, depth=110,
+                height=150, weight=15, volume=81000, shipping_order=self.order
+            )
+            LoadPallet.objects.create(plan=plan, pallet=pallet, position_x=0, position_y=110 * number,
+                                      load_sequence=number + 1)
+        loose = UnifiedPallet.objects.create(
+            pallet_type='VIRTUAL', item=self.item, item_quantity=1, delivery_date=plan.plan_date, width=30,
+            depth=30, height=30, weight=5, volume=27000, shipping_order=self.order
+        )
+        LoadPallet.objects.create(plan=plan, pallet=loose, position_x=120, position_y=0, load_sequence=pallet_count + 1)
+        return plan
+
+    def test_query_count_does_not_depend_on_pallet_count(self):
+        for pallet_count in (1, 8):
+            plan = self._create_plan(pallet_count)
+            with self.assertNumQueries(self.EXPECTED_QUERIES):
+                response = self.client.get(reverse('delivery:plan_detail', args=[plan.pk]))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context['pallet_count'], pallet_count)
+            self.assertEqual(response.context['loose_items_count'], 1)
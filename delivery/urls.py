@@ -59,4 +59,8 @@ urlpatterns = [
     path('palletize/<int:pk>/delete/', views.palletize_delete, name='palletize_delete'),
     path('palletize/delete-all/', views.palletize_delete_all, name='palletize_delete_all'),
     path('palletize/result/<str:delivery_date>/', views.palletize_result, name='palletize_result'),
+    
+    # 最適化ジョブ
+    path('jobs/<int:pk>/', views.job_detail, name='job_detail'),
+    path('jobs/<int:pk>/progress/', views.job_progress, name='job_progress'),
 ]
\ No newline at end of file
@@ -1,9 +1,10 @@
 from django.shortcuts import render, get_object_or_404, redirect
+from django.urls import reverse
 from django.contrib import messages
 from django.http import JsonResponse, HttpResponse
 from django.db import transaction
 from django.core.paginator import Paginator
-from django.db.models import Q, Sum, Count
+from django.db.models import Q, Sum, Count, Prefetch
 from django.utils import timezone
 from datetime import datetime, date
 import json
@@ -11,11 +12,10 @@ import json
 from .models import (
     Item, Part, Shipper, Destination, ShippingOrder, OrderItem,
     Truck, DeliveryPlan, PlanOrderDetail, PlanItemLoad,
-    PalletizePlan, PalletDetail, PalletItem, LooseItem, PalletConfiguration,
-    UnifiedPallet, LoadPallet, PalletLoadHistory
+    PalletizePlan, PalletItem, PalletConfiguration,
+    UnifiedPallet, LoadPallet, PalletLoadHistory, OptimizationJob
 )
 from .forms import ShippingOrderForm, TruckForm, ItemForm, ShipperForm, DestinationForm
-from .optimization import DeliveryOptimizer
 from .reports import generate_plan_report
 
 
@@ -131,14 +131,28 @@ def plan_list(request):
 
 
 def plan_detail(request, pk):
-    """配送計画詳細"""
-    plan = get_object_or_404(DeliveryPlan, pk=pk)
-    order_details = plan.order_details.select_related('shipping_order__destination').all()
-    # 新しいLoadPalletモデルを使用
-    load_pallets = plan.load_pallets.select_related('pallet__item', 'pallet__shipping_order').all()
-    
-    # 後方互換性のため、従来のitem_loadsも取得
-    item_loads = plan.item_loads.select_related('item', 'shipping_order').all()
+    """配送計画詳細
+    
+    配送計画に付随する行（配送順序・積載パレットとパレット内の商品・従来の積載商品）は
+    Prefetch でまとめて取得し、パレット数によらず一定のクエリ数で表示する
+    """
+    plan = get_object_or_404(
+        DeliveryPlan.objects.select_related('truck').prefetch_related(
+            Prefetch('order_details', queryset=PlanOrderDetail.objects.select_related('shipping_order__destination')),
+            # 新しいLoadPalletモデルを使用
+            Prefetch('load_pallets', queryset=LoadPallet.objects.select_related(
+                'pallet__item', 'pallet__shipping_order', 'pallet__pallet_detail'
+            )),
+            Prefetch('load_pallets__pallet__pallet_detail__items',
+                     queryset=PalletItem.objects.select_related('item', 'shipping_order').order_by('id')),
+            # 後方互換性のため、従来のitem_loadsも取得
+            Prefetch('item_loads', queryset=PlanItemLoad.objects.select_related('item', 'shipping_order')),
+        ),
+        pk=pk
+    )
+    order_details = list(plan.order_details.all())
+    load_pallets = list(plan.load_pallets.all())
+    item_loads = list(plan.item_loads.all())
     
     # 関連するパレタイズ計画を取得
     palletize_plan = None
@@ -148,34 +162,64 @@ def plan_detail(request, pk):
     except Exception as e:
         print(f"パレタイズ計画取得エラー: {e}")
     
-    # パレット概要を作成
+    # パレット概要とトラック積載の可視化データ（パレットとバラ積みを区別）を1回の走査で作成
     pallet_summary = []
     loose_items_summary = []
+    truck_layout = {
+        'width': plan.truck.width,
+        'depth': plan.truck.depth,
+        'pallets': [],
+        'loose_items': []
+    }
     
     try:
-        # 新しいシステムでパレット情報を取得
-        if load_pallets.exists():
-            print(f"LoadPallet数: {load_pallets.count()}")
+        # 新しいシステム: LoadPalletから直接作成
+        if load_pallets:
+            print(f"LoadPallet数: {len(load_pallets)}")
             
             for load_pallet in load_pallets:
                 pallet = load_pallet.pallet
+                position = f"({load_pallet.position_x}, {load_pallet.position_y}, {load_pallet.position_z})"
                 
                 if pallet.pallet_type == 'REAL':
                     # REALパレットの場合：パレット詳細から商品情報を取得
+                    pallet_items = list(pallet.pallet_detail.items.all()) if pallet.pallet_detail else []
+                    
                     if pallet.pallet_detail:
-                        pallet_items = pallet.pallet_detail.items.select_related('item', 'shipping_order').all()
-                        
                         pallet_summary.append({
                             'pallet_number': f"P{pallet.id}",
-                            'item_count': pallet_items.count(),
+                            'item_count': len(pallet_items),
                             'total_weight': pallet.weight,
                             'total_volume': pallet.volume,
                             'items': pallet_items,
-                            'position': f"({load_pallet.position_x}, {load_pallet.position_y})",
+                            'position': position,
+                            'layer': load_pallet.layer,
                             'pallet_type': 'REAL'
                         })
-                        
-                        print(f"REALパレット #{pallet.id}: 位置({load_pallet.position_x}, {load_pallet.position_y}) - 商品数: {pallet_items.count()}")
+                    
+                    truck_layout['pallets'].append({
+                        'x': load_pallet.position_x,
+                        'y': load_pallet.position_y,
+                        'z': load_pallet.position_z,
+                        'layer': load_pallet.layer,
+                        'width': pallet.width,
+                        'depth': pallet.depth,
+                        'name': f'パレット#{pallet.id}',
+                        'pallet_number': pallet.id,
+                        'rotation': load_pallet.rotation,
+                        'type': 'REAL',
+                        'items': [
+                            {
+                                'name': pallet_item.item.name,
+                                'x': pallet_item.position_x,
+                                'y': pallet_item.position_y,
+                                'width': pallet_item.width,
+                                'depth': pallet_item.depth,
+                                'quantity': 1  # PalletItemには個別の数量がないため1とする
+                            }
+                            for pallet_item in pallet_items
+                        ]
+                    })
                 
                 elif pallet.pallet_type == 'VIRTUAL':
                     # VIRTUALパレット（バラ積み）の場合
@@ -187,29 +231,35 @@ def plan_detail(request, pk):
                         'weight': pallet.weight,
                         'volume': pallet.volume,
                         'quantity': pallet.item_quantity,
-                        'position': f"({load_pallet.position_x}, {load_pallet.position_y})"
+                        'position': position,
+                        'layer': load_pallet.layer
                     })
                     
-                    print(f"VIRTUALパレット #{pallet.id}: バラ積み商品 {pallet.item.name}")
+                    truck_layout['loose_items'].append({
+                        'x': load_pallet.position_x,
+                        'y': load_pallet.position_y,
+                        'z': load_pallet.position_z,
+                        'layer': load_pallet.layer,
+                        'width': pallet.width,
+                        'depth': pallet.depth,
+                        'name': pallet.item.name,
+                        'quantity': pallet.item_quantity,
+                        'rotation': load_pallet.rotation,
+                        'type': 'VIRTUAL'
+                    })
         
-        # 後方互換性：従来のitem_loadsがある場合（旧システムでの計画）
-        elif item_loads.exists():
-            print(f"従来のitem_loads数: {item_loads.count()}")
+        # 後方互換性：従来のitem_loadsがある場合（旧システムでの計画）は位置からパレットを推定
+        elif item_loads:
+            print(f"従来のitem_loads数: {len(item_loads)}")
             
-            # 従来のロジックを使用
+            # パレット設定を取得
             pallet_config = PalletConfiguration.get_default()
             pallet_width = pallet_config.width
             pallet_depth = pallet_config.depth
             
-            # 位置ベースでパレットを検出
+            # 商品の位置をパレットのグリッドに割り当てる
             pallet_grid = {}
-            processed_item_loads = set()
-            
             for load in item_loads:
-                if load.id in processed_item_loads:
-                    continue
-                    
-                # 商品の位置をパレットグリッドに変換
                 grid_x = (load.position_x // pallet_width) * pallet_width
                 grid_y = (load.position_y // pallet_depth) * pallet_depth
                 grid_key = f"{grid_x},{grid_y}"
@@ -218,46 +268,58 @@ def plan_detail(request, pk):
                     pallet_grid[grid_key] = {
                         'x': grid_x,
                         'y': grid_y,
+                        'width': pallet_width,
+                        'depth': pallet_depth,
                         'items': [],
                         'pallet_number': len(pallet_grid) + 1
                     }
-                
                 pallet_grid[grid_key]['items'].append(load)
-                processed_item_loads.add(load.id)
             
-            # 検出されたパレットの概要を作成
-            for grid_key, grid_info in pallet_grid.items():
-                items = grid_info['items']
-                if len(items) > 1:  # 複数の商品がある場合のみパレットとして扱う
-                    total_weight = sum(item.item.weight * item.quantity for item in items if item.item.weight)
+            for grid_info in pallet_grid.values():
+                loads = grid_info['items']
+                
+                # パレット配置をトラックレイアウトに追加（商品はパレット内の相対位置）
+                truck_layout['pallets'].append(dict(grid_info, items=[
+                    {
+                        'name': load.item.name,
+                        'quantity': load.quantity,
+                        'x': load.position_x - grid_info['x'],
+                        'y': load.position_y - grid_info['y'],
+                        'width': load.item.width or 50,
+                        'depth': load.item.depth or 50
+                    }
+                    for load in loads
+                ]))
+                
+                if len(loads) > 1:  # 複数の商品がある場合のみパレットとして扱う
+                    total_weight = sum(load.item.weight * load.quantity for load in loads if load.item.weight)
                     total_volume = sum(
-                        (item.item.width or 50) * (item.item.depth or 50) * (item.item.height or 50) * item.quantity 
-                        for item in items
+                        (load.item.width or 50) * (load.item.depth or 50) * (load.item.height or 50) * load.quantity
+                        for load in loads
                     )
                     
                     pallet_summary.append({
                         'pallet_number': grid_info['pallet_number'],
-                        'item_count': len(items),
+                        'item_count': len(loads),
                         'total_weight': total_weight,
                         'total_volume': total_volume,
-                        'items': items,
+                        'items': loads,
                         'position': f"({grid_info['x']}, {grid_info['y']})",
                         'pallet_type': 'LEGACY'
                     })
                 else:
                     # 単一商品はバラ積みとして扱う
-                    item = items[0]
-                    volume = (item.item.width or 50) * (item.item.depth or 50) * (item.item.height or 50) * item.quantity
-                    weight = (item.item.weight or 0) * item.quantity
+                    load = loads[0]
+                    volume = (load.item.width or 50) * (load.item.depth or 50) * (load.item.height or 50) * load.quantity
                     
                     loose_items_summary.append({
-                        'item': item.item,
-                        'width': item.item.width or 50,
-                        'depth': item.item.depth or 50,
-                        'height': item.item.height or 50,
-                        'weight': item.item.weight or 0,
+                        'item': load.item,
+                        'width': load.item.width or 50,
+                        'depth': load.item.depth or 50,
+                        'height': load.item.height or 50,
+                        'weight': load.item.weight or 0,
                         'volume': volume,
-                        'quantity': item.quantity,
+                        'quantity': load.quantity,
                         'position': f"({grid_info['x']}, {grid_info['y']})"
                     })
             
@@ -268,140 +330,6 @@ def plan_detail(request, pk):
         print(f"パレット概要作成エラー: {e}")
         messages.warning(request, f'パレット概要の作成でエラーが発生しました: {e}')
     
-    # トラック積載の可視化データ（パレットとバラ積みを区別）
-    truck_layout = {
-        'width': plan.truck.width,
-        'depth': plan.truck.depth,
-        'pallets': [],
-        'loose_items': []
-    }
-    
-    # パレット配置の正確な表示のため、より単純なアプローチを採用
-    # 新システムではload_palletsから直接取得、旧システムではitem_loadsから推定
-    if load_pallets.exists():
-        # 新システム: LoadPalletから直接可視化データを作成
-        for load_pallet in load_pallets:
-            pallet = load_pallet.pallet
-            
-            if pallet.pallet_type == 'REAL':
-                # REALパレットの場合
-                # パレット内の商品情報を取得
-                pallet_items = []
-                if pallet.pallet_detail:
-                    detail_items = pallet.pallet_detail.items.select_related('item').all()
-                    for detail_item in detail_items:
-                        pallet_items.append({
-                            'name': detail_item.item.name,
-                            'x': detail_item.position_x,
-                            'y': detail_item.position_y,
-                            'width': detail_item.width,
-                            'depth': detail_item.depth,
-                            'quantity': 1  # PalletItemには個別の数量がないため1とする
-                        })
-                
-                truck_layout['pallets'].append({
-                    'x': load_pallet.position_x,
-                    'y': load_pallet.position_y,
-                    'width': pallet.width,
-                    'depth': pallet.depth,
-                    'name': f'パレット#{pallet.id}',
-                    'pallet_number': pallet.id,
-                    'rotation': load_pallet.rotation,
-                    'type': 'REAL',
-                    'items': pallet_items
-                })
-            elif pallet.pallet_type == 'VIRTUAL':
-                # VIRTUALパレット（バラ積み）の場合
-                truck_layout['loose_items'].append({
-                    'x': load_pallet.position_x,
-                    'y': load_pallet.position_y,
-                    'width': pallet.width,
-                    'depth': pallet.depth,
-                    'name': pallet.item.name,
-                    'quantity': pallet.item_quantity,
-                    'rotation': load_pallet.rotation,
-                    'type': 'VIRTUAL'
-                })
-    
-    elif item_loads.exists():
-        # 旧システム: item_loadsから推定
-        # パレット設定を取得
-        pallet_config = PalletConfiguration.get_default()
-        pallet_width = pallet_config.width
-        pallet_depth = pallet_config.depth
-        
-        print(f"積載商品数: {item_loads.count()}")
-        
-        # 商品の位置から自動的にパレットを検出
-        # 110cm x 110cm のグリッドに基づいてパレットを配置
-        pallet_grid = {}
-        processed_item_loads = set()
-        
-        for load in item_loads:
-            if load.id in processed_item_loads:
-                continue
-                
-            # 商品の位置をパレットグリッドに変換
-            grid_x = (load.position_x // pallet_width) * pallet_width
-            grid_y = (load.position_y // pallet_depth) * pallet_depth
-            grid_key = f"{grid_x},{grid_y}"
-            
-            if grid_key not in pallet_grid:
-                pallet_grid[grid_key] = {
-                    'x': grid_x,
-                    'y': grid_y,
-                    'width': pallet_width,
-                    'depth': pallet_depth,
-                    'items': [],
-                    'pallet_number': len(pallet_grid) + 1
-                }
-            
-            # 商品をパレットに追加
-            pallet_grid[grid_key]['items'].append({
-                'name': load.item.name,
-                'quantity': load.quantity,
-                'x': load.position_x - grid_x,  # パレット内の相対位置
-                'y': load.position_y - grid_y,
-                'width': load.item.width or 50,
-                'depth': load.item.depth or 50
-            })
-            
-            processed_item_loads.add(load.id)
-            print(f"商品 {load.item.name} を グリッド ({grid_x}, {grid_y}) に配置")
-        
-        # パレット配置をトラックレイアウトに追加
-        truck_layout['pallets'] = list(pallet_grid.values())
-        print(f"\n最終的なパレット配置数: {len(truck_layout['pallets'])}")
-        
-        # パレットの詳細を表示
-        for pallet in truck_layout['pallets']:
-            print(f"パレット #{pallet['pallet_number']}: 位置({pallet['x']}, {pallet['y']}) - 商品数: {len(pallet['items'])}")
-        
-        # 残りの商品（バラ積み）を処理
-        for load in item_loads:
-            if load.id not in processed_item_loads:
-                truck_layout['loose_items'].append({
-                    'x': load.position_x,
-                    'y': load.position_y,
-                    'width': load.item.width or 50,
-                    'depth': load.item.depth or 50,
-                    'name': load.item.name,
-                    'quantity': load.quantity,
-                    'rotation': load.rotation
-                })
-    else:
-        # パレタイズ設計結果がない場合は全てバラ積みとして扱う
-        for load in item_loads:
-            truck_layout['loose_items'].append({
-                'x': load.position_x,
-                'y': load.position_y,
-                'width': load.item.width or 50,
-                'depth': load.item.depth or 50,
-                'name': load.item.name,
-                'quantity': load.quantity,
-                'rotation': load.rotation
-            })
-    
     # バラ積み商品の統計を計算
     total_loose_weight = sum(item.get('weight', 0) * item.get('quantity', 1) for item in loose_items_summary)
     total_loose_volume = sum(item.get('volume', 0) for item in loose_items_summary)
@@ -480,11 +408,11 @@ def optimize_delivery(request):
                 messages.error(request, f'{target_date} のパレタイズ設計が完了していません。先にパレタイズ設計を実行してください。')
                 return redirect('delivery:optimize_delivery')
             
-            # 対象日の未配送依頼を取得
+            # 対象日の未配送依頼を取得（寸法チェック用に商品の部品もまとめて取得）
             pending_orders = ShippingOrder.objects.filter(
                 delivery_deadline=target_date,
                 planorderdetail__isnull=True
-            ).select_related('shipper', 'destination').prefetch_related('order_items__item')
+            ).select_related('shipper', 'destination').prefetch_related('order_items__item__parts')
             
             if not pending_orders.exists():
                 messages.warning(request, f'{target_date} の未配送依頼はありません。')
@@ -500,9 +428,10 @@ def optimize_delivery(request):
             for order in pending_orders:
                 for order_item in order.order_items.all():
                     item = order_item.item
-                    if item.parts.exists():
+                    parts = item.parts.all()
+                    if parts:
                         # セット品の場合、部品をチェック
-                        for part in item.parts.all():
+                        for part in parts:
                             if not all([part.width, part.depth, part.height, part.weight]):
                                 items_without_dimensions.append(f"{item.name}の部品{part.parts_code}")
                     else:
@@ -527,17 +456,9 @@ def optimize_delivery(request):
                 print(f"パレット数: {palletize_plan.pallets.count()}")
                 print(f"バラ積み商品数: {palletize_plan.loose_items.count()}")
             
-            # 最適化実行（統一パレットシステムを使用）
-            optimizer = DeliveryOptimizer()
-            plans = optimizer.optimize_with_unified_pallets(pending_orders, target_date)
-            
-            print(f"作成された配送計画数: {len(plans) if plans else 0}")
-            
-            if plans:
-                messages.success(request, f'{len(plans)} 件の配送計画を作成しました。')
-                return redirect('delivery:plan_list')
-            else:
-                messages.error(request, '最適化に失敗しました。詳細はサーバーログをご確認ください。')
+            # 最適化はワーカーで実行（統一パレットシステムを使用）
+            job = OptimizationJob.enqueue('DELIVERY', target_date)
+            return redirect('delivery:job_detail', pk=job.pk)
                 
         except Exception as e:
             print(f"最適化エラー: {str(e)}")
@@ -910,7 +831,7 @@ def palletize_design(request):
     if request.method == 'POST':
         delivery_date = request.POST.get('delivery_date')
         if delivery_date:
-            return redirect('delivery:palletize_result', delivery_date=delivery_date)
+            return _enqueue_palletize(request, delivery_date)
     
     # 配送日の選択肢を取得（出荷依頼のある日付）
     delivery_dates = ShippingOrder.objects.values_list(
@@ -923,163 +844,55 @@ def palletize_design(request):
 
 
 def palletize_result(request, delivery_date):
-    """パレタイズ設計結果"""
-    from .optimization import PalletOptimizer, Box
-    
-    # 指定日の出荷依頼を取得
-    orders = ShippingOrder.objects.filter(
-        delivery_deadline=delivery_date
-    ).select_related('shipper', 'destination')
+    """パレタイズ設計の実行（POSTのみ。GETの場合はパレタイズ設計画面へ）"""
+    if request.method != 'POST':
+        return redirect('delivery:palletize_design')
+    return _enqueue_palletize(request, delivery_date)
+
+
+def _enqueue_palletize(request, delivery_date):
+    """パレタイズ設計のジョブを登録し、進捗画面へ（ワーカーで実行）"""
+    try:
+        delivery_date = datetime.strptime(delivery_date, '%Y-%m-%d').date()
+    except ValueError:
+        messages.error(request, f'{delivery_date}は日付として正しくありません。')
+        return redirect('delivery:palletize_design')
     
-    if not orders.exists():
+    if not ShippingOrder.objects.filter(delivery_deadline=delivery_date).exists():
         messages.error(request, f'{delivery_date}の出荷依頼が見つかりません。')
         return redirect('delivery:palletize_design')
     
-    # 商品情報を収集
-    all_items = []
-    for order in orders:
-        order_items = order.order_items.select_related('item').all()
-        for order_item in order_items:
-            item = order_item.item
-            # セット品の場合は部品を展開
-            if item.parts.exists():
-                for part in item.parts.all():
-                    for _ in range(order_item.quantity):
-                        all_items.append({
-                            'order': order,
-                            'item': item,
-                            'part': part,
-                            'box': Box(
-                                width=part.width,
-                                depth=part.depth,
-                                height=part.height,
-                                weight=part.weight,
-                                item_code=part.parts_code,
-                                shipping_order_id=order.id
-                            )
-                        })
-            else:
-                # 単品の場合
-                for _ in range(order_item.quantity):
-                    all_items.append({
-                        'order': order,
-                        'item': item,
-                        'part': None,
-                        'box': Box(
-                            width=item.width,
-                            depth=item.depth,
-                            height=item.height,
-                            weight=item.weight,
-                            item_code=item.item_code,
-                            shipping_order_id=order.id
-                        )
-                    })
-    
-    # パレタイズ最適化
-    optimizer = PalletOptimizer()
-    boxes = [item['box'] for item in all_items]
-    pallets, remaining_boxes = optimizer.pack_pallet(boxes)
-    
-    # 結果をデータベースに保存
-    with transaction.atomic():
-        # パレタイズ設計を作成
-        palletize_plan = PalletizePlan.objects.create(
-            delivery_date=delivery_date,
-            total_items=len(boxes),
-            total_pallets=len(pallets),
-            total_loose_items=len(remaining_boxes)
-        )
-        
-        # パレット詳細を保存
-        for i, pallet in enumerate(pallets):
-            pallet_detail = PalletDetail.objects.create(
-                palletize_plan=palletize_plan,
-                pallet_number=i + 1,
-                total_weight=pallet.get_total_weight(),
-                total_volume=pallet.get_used_volume(),
-                utilization=(pallet.get_used_volume() / (pallet.width * pallet.depth * pallet.height)) * 100
-            )
-            
-            # パレット積載商品を保存
-            for box in pallet.boxes:
-                item_info = next(item for item in all_items if item['box'] == box)
-                PalletItem.objects.create(
-                    pallet=pallet_detail,
-                    shipping_order=item_info['order'],
-                    item=item_info['item'],
-                    part=item_info['part'],
-                    position_x=box.x,
-                    position_y=box.y,
-                    position_z=box.z,
-                    width=box.width,
-                    depth=box.depth,
-                    height=box.height,
-                    weight=box.weight
-                )
-        
-        # バラ積み商品を保存
-        for box in remaining_boxes:
-            item_info = next(item for item in all_items if item['box'] == box)
-            reason = 'パレットサイズ超過' if (box.width > 110 or box.depth > 110) else '積載不可'
-            LooseItem.objects.create(
-                palletize_plan=palletize_plan,
-                shipping_order=item_info['order'],
-                item=item_info['item'],
-                width=box.width,
-                depth=box.depth,
-                height=box.height,
-                weight=box.weight,
-                reason=reason
-            )
-    
-    messages.success(request, f'パレタイズ設計を保存しました。（ID: {palletize_plan.id}）')
-    
-    # 結果を整理（表示用）
-    pallet_results = []
-    for i, pallet in enumerate(pallets):
-        pallet_info = {
-            'number': i + 1,
-            'items': [],
-            'total_weight': pallet.get_total_weight(),
-            'total_volume': pallet.get_used_volume(),
-            'utilization': (pallet.get_used_volume() / (pallet.width * pallet.depth * pallet.height)) * 100
-        }
-        
-        for box in pallet.boxes:
-            # 該当する商品情報を検索
-            item_info = next(item for item in all_items if item['box'] == box)
-            
-            pallet_info['items'].append({
-                'item': item_info['item'],
-                'part': item_info['part'],
-                'order': item_info['order'],
-                'position': (box.x, box.y, box.z),
-                'rotation': 0  # 今回は回転なし
-            })
-        
-        pallet_results.append(pallet_info)
-    
-    # パレットに載らない商品（バラ積み）
-    loose_items = []
-    for box in remaining_boxes:
-        item_info = next(item for item in all_items if item['box'] == box)
-        loose_items.append(item_info)
-    
-    # パレット設定を取得
-    pallet_config = PalletConfiguration.get_default()
+    job = OptimizationJob.enqueue('PALLETIZE', delivery_date)
+    return redirect('delivery:job_detail', pk=job.pk)
+
+
+# 最適化ジョブ
+def job_detail(request, pk):
+    """最適化ジョブの進捗"""
+    job = get_object_or_404(OptimizationJob, pk=pk)
+    return render(request, 'delivery/job_detail.html', {'job': job})
+
+
+def job_progress(request, pk):
+    """最適化ジョブの進捗（進捗画面からポーリングされる）"""
+    job = get_object_or_404(OptimizationJob, pk=pk)
     
-    context = {
-        'delivery_date': delivery_date,
-        'orders': orders,
-        'pallets': pallet_results,
-        'loose_items': loose_items,
-        'total_pallets': len(pallets),
-        'total_items': len(boxes),
-        'palletize_plan': palletize_plan,
-        'pallet_config': pallet_config
-    }
+    result_url = None
+    if job.status == 'SUCCEEDED':
+        if job.job_type == 'PALLETIZE' and job.palletize_plan_id:
+            result_url = reverse('delivery:palletize_detail', args=[job.palletize_plan_id])
+        elif job.job_type == 'DELIVERY':
+            result_url = reverse('delivery:plan_list')
     
-    return render(request, 'delivery/palletize_result.html', context)
+    return JsonResponse({
+        'status': job.status,
+        'status_display': job.get_status_display(),
+        'progress': job.progress,
+        'message': job.message,
+        'error': job.error,
+        'finished': job.is_finished,
+        'result_url': result_url,
+    })
 
 
 def palletize_list(request):
@@ -116,4 +116,24 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Crispy Forms
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap5"
-CRISPY_TEMPLATE_PACK = "bootstrap5"
\ No newline at end of file
+CRISPY_TEMPLATE_PACK = "bootstrap5"
+
+# パレタイズ結果画面の処理時間の上限(ms)。0の場合はFFDの結果のみ（詰め直しを行わない）
+PALLETIZE_TIME_BUDGET_MS = env.int('PALLETIZE_TIME_BUDGET_MS', default=0)
+
+# 配送計画の到着予定時刻の計算
+# 時間帯ごとの平均走行速度(km/h)。キーはその速度を適用し始める時刻（時）
+DELIVERY_SPEED_PROFILE = {0: 40, 7: 25, 10: 30, 16: 25, 19: 35}
+# 配送先1件あたりの荷降ろし時間（分）
+DELIVERY_SERVICE_MINUTES = env.int('DELIVERY_SERVICE_MINUTES', default=15)
+
+# 統一パレット最適化で出荷依頼をトラックに割り当てる単位
+# （region: 地域別, savings: 節約法による配送ルート別, kmeans / dbscan: 配送先の座標のクラスタ別）
+DELIVERY_ROUTING = env.str('DELIVERY_ROUTING', default='region')
+# kmeans のクラスタ数（0の場合はパレット総重量から必要なトラック台数を見積もる）
+DELIVERY_CLUSTER_COUNT = env.int('DELIVERY_CLUSTER_COUNT', default=0)
+# dbscan で同じクラスタとみなす配送先間の距離(km)
+DELIVERY_CLUSTER_RADIUS_KM = env.float('DELIVERY_CLUSTER_RADIUS_KM', default=5.0)
+
+# 最適化結果の一括保存で、主キーが不要な行を COPY で書き込む（PostgreSQL のみ）
+BULK_WRITE_USE_COPY = env.bool('BULK_WRITE_USE_COPY', default=False)